@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Carnegie Mellon University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Simulate many OpenScout clients from one process to load test a server.
+
+Every simulated client has its own websocket connection, client_id, frame
+source (a directory of images or a video file), frame rate and location.
+The clients speak the Gabriel websocket protocol themselves, so that they
+can share one event loop.
+Like the camera of a real client, a client that has no token when its next
+frame is due drops that frame instead of queueing it. Each response is
+matched to its frame by frame id, which gives the end-to-end latency.
+
+    ./load_generator.py -s localhost -n 8 --fps 5 15 --source frames/ \\
+        --duration 60 --output load.json
+
+reports per-client and aggregate latency percentiles, goodput (fresh
+successful results per second), dropped, stale and lost frame counts.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+import cv2
+import numpy as np
+import websockets
+from gabriel_protocol import gabriel_pb2
+
+import openscout_pb2
+
+DEFAULT_SOURCE_NAME = 'openscout'
+URI_FORMAT = 'ws://{host}:{port}'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+logger = logging.getLogger(__name__)
+
+
+def load_frames(source, max_frames):
+    '''JPEG encoded frames of an image directory or a video file'''
+    if os.path.isdir(source):
+        paths = sorted(
+            os.path.join(source, name) for name in os.listdir(source)
+            if name.lower().endswith(IMAGE_EXTENSIONS))[:max_frames]
+        frames = []
+        for path in paths:
+            if path.lower().endswith(('.jpg', '.jpeg')):
+                with open(path, 'rb') as f:
+                    frames.append(f.read())
+            else:
+                _, jpeg = cv2.imencode('.jpg', cv2.imread(path))
+                frames.append(jpeg.tobytes())
+    else:
+        capture = cv2.VideoCapture(source)
+        frames = []
+        while len(frames) < max_frames:
+            ok, image = capture.read()
+            if not ok:
+                break
+            _, jpeg = cv2.imencode('.jpg', image)
+            frames.append(jpeg.tobytes())
+        capture.release()
+
+    if not frames:
+        raise ValueError(f'No frames found in {source}')
+    return frames
+
+
+def percentiles(latencies):
+    if not latencies:
+        return None
+    values = np.asarray(latencies) * 1000
+    return {
+        'mean': float(values.mean()),
+        'p50': float(np.percentile(values, 50)),
+        'p90': float(np.percentile(values, 90)),
+        'p99': float(np.percentile(values, 99)),
+        'max': float(values.max()),
+    }
+
+
+class SimulatedClient:
+    '''A Gabriel websocket client sending frames at a fixed rate that records
+    the latency of every response.
+
+    The server welcomes a client with the sources it consumes and the number
+    of tokens per source. A client may only send a frame of a source while
+    it holds a token, which responses with return_token give back.'''
+
+    def __init__(self, host, port, frames, fps, location, model,
+                 stale_after, source_name=DEFAULT_SOURCE_NAME):
+        self.uri = URI_FORMAT.format(host=host, port=port)
+        self.tokens = {}  # source name -> tokens held
+        self.client_id = str(uuid.uuid4())
+        self.frames = frames
+        self.fps = fps
+        self.location = location
+        self.model = model
+        self.stale_after = stale_after
+        self.source_name = source_name
+
+        self.sent_at = {}  # frame_id -> send time
+        self.latencies = []
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.stale = 0
+        self.errors = {}
+
+    def input_frame(self, index):
+        input_frame = gabriel_pb2.InputFrame()
+        input_frame.payload_type = gabriel_pb2.PayloadType.IMAGE
+        input_frame.payloads.append(self.frames[index % len(self.frames)])
+
+        extras = openscout_pb2.Extras()
+        extras.client_id = self.client_id
+        extras.location.latitude = self.location[0]
+        extras.location.longitude = self.location[1]
+        extras.model = self.model
+        input_frame.extras.Pack(extras)
+        return input_frame
+
+    async def run(self, duration, warmup, delay=0):
+        await asyncio.sleep(delay)
+        websocket = await websockets.connect(self.uri)
+        welcome = asyncio.Event()
+        receiver = asyncio.ensure_future(self.receive(websocket, welcome))
+        try:
+            await asyncio.wait_for(welcome.wait(), 10)
+            if self.source_name not in self.tokens:
+                raise Exception(
+                    f'No engines consume frames from source: {self.source_name}')
+
+            start = time.monotonic()
+            end = start + warmup + duration
+            index = 0
+            frame_id = 0
+            while not receiver.done():
+                due = start + index / self.fps
+                if due >= end:
+                    break
+                await asyncio.sleep(max(0, due - time.monotonic()))
+                measuring = due >= start + warmup
+
+                # like a camera, skip the frame if the server has no room
+                if self.tokens[self.source_name] < 1:
+                    if measuring:
+                        self.dropped += 1
+                    index += 1
+                    continue
+                self.tokens[self.source_name] -= 1
+
+                from_client = gabriel_pb2.FromClient()
+                from_client.frame_id = frame_id
+                from_client.source_name = self.source_name
+                from_client.input_frame.CopyFrom(self.input_frame(index))
+                if measuring:
+                    self.sent_at[frame_id] = time.monotonic()
+                    self.sent += 1
+                await websocket.send(from_client.SerializeToString())
+                frame_id += 1
+                index += 1
+
+            # give the responses of the last frames a chance to arrive
+            await asyncio.sleep(self.stale_after)
+        finally:
+            receiver.cancel()
+            await websocket.close()
+
+    async def receive(self, websocket, welcome):
+        try:
+            async for message in websocket:
+                to_client = gabriel_pb2.ToClient()
+                to_client.ParseFromString(message)
+                if to_client.HasField('welcome'):
+                    for source_name in to_client.welcome.sources_consumed:
+                        self.tokens[source_name] = (
+                            to_client.welcome.num_tokens_per_source)
+                    welcome.set()
+                elif to_client.HasField('response'):
+                    self.process_response(to_client.response)
+        except websockets.exceptions.ConnectionClosed:
+            logger.warning(f'Client {self.client_id[:8]} was disconnected')
+
+    def process_response(self, response):
+        sent_at = self.sent_at.pop(response.frame_id, None)
+        if response.return_token:
+            self.tokens[response.source_name] += 1
+        if sent_at is None:
+            return  # sent during warm-up
+
+        status = response.result_wrapper.status
+        if status != gabriel_pb2.ResultWrapper.SUCCESS:
+            name = gabriel_pb2.ResultWrapper.Status.Name(status)
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return
+
+        latency = time.monotonic() - sent_at
+        self.received += 1
+        self.latencies.append(latency)
+        if latency > self.stale_after:
+            self.stale += 1
+
+    def report(self, duration):
+        fresh = self.received - self.stale
+        return {
+            'client_id': self.client_id,
+            'fps': self.fps,
+            'sent': self.sent,
+            'received': self.received,
+            'dropped': self.dropped,
+            'stale': self.stale,
+            'lost': len(self.sent_at),
+            'errors': self.errors,
+            'goodput_fps': fresh / duration,
+            'latency_ms': percentiles(self.latencies),
+        }
+
+
+def aggregate(clients, duration):
+    latencies = [latency for client in clients for latency in client.latencies]
+    errors = {}
+    for client in clients:
+        for name, count in client.errors.items():
+            errors[name] = errors.get(name, 0) + count
+    received = sum(client.received for client in clients)
+    stale = sum(client.stale for client in clients)
+    return {
+        'clients': len(clients),
+        'offered_fps': sum(client.fps for client in clients),
+        'sent': sum(client.sent for client in clients),
+        'received': received,
+        'dropped': sum(client.dropped for client in clients),
+        'stale': stale,
+        'lost': sum(len(client.sent_at) for client in clients),
+        'errors': errors,
+        'goodput_fps': (received - stale) / duration,
+        'latency_ms': percentiles(latencies),
+    }
+
+
+def print_report(report):
+    fmt = '{:>8} {:>6} {:>7} {:>8} {:>8} {:>6} {:>5} {:>9} {:>8} {:>8}'
+    print(fmt.format('client', 'fps', 'sent', 'received', 'dropped', 'stale',
+                     'lost', 'goodput', 'p50 ms', 'p99 ms'))
+    rows = [(client['client_id'][:8], client) for client in report['clients']]
+    rows.append(('total', report['aggregate']))
+    for name, row in rows:
+        latency = row['latency_ms'] or {'p50': float('nan'),
+                                        'p99': float('nan')}
+        fps = row.get('fps', row.get('offered_fps'))
+        print(fmt.format(name, f'{fps:g}', row['sent'], row['received'],
+                         row['dropped'], row['stale'], row['lost'],
+                         f"{row['goodput_fps']:.1f}", f"{latency['p50']:.1f}",
+                         f"{latency['p99']:.1f}"))
+
+
+async def run_clients(args, sources):
+    # created on the loop that runs them, asyncio primitives bind to the
+    # loop current at creation before Python 3.10
+    clients = []
+    for i in range(args.clients):
+        location = (args.location[0] + random.uniform(-0.01, 0.01),
+                    args.location[1] + random.uniform(-0.01, 0.01))
+        clients.append(SimulatedClient(
+            args.server, args.port,
+            sources[args.source[i % len(args.source)]],
+            args.fps[i % len(args.fps)], location, args.model,
+            args.stale_ms / 1000))
+
+    logger.info(f'Starting {len(clients)} clients against '
+                f'{URI_FORMAT.format(host=args.server, port=args.port)}')
+    await asyncio.gather(*[
+        # stagger the connections over the ramp up time
+        client.run(args.duration, args.warmup, args.ramp * i / len(clients))
+        for i, client in enumerate(clients)
+    ])
+    return clients
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate many OpenScout clients to load test a server',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--server', default='localhost',
+                        help='Address of the OpenScout server')
+    parser.add_argument('-p', '--port', type=int, default=9099,
+                        help='Websocket port')
+    parser.add_argument('-n', '--clients', type=int, default=4,
+                        help='Number of simulated clients')
+    parser.add_argument('--source', nargs='+', required=True,
+                        help='Image directories or video files, assigned to '
+                        'the clients round robin')
+    parser.add_argument('--fps', type=float, nargs='+', default=[10.0],
+                        help='Target frame rates, assigned to the clients '
+                        'round robin')
+    parser.add_argument('--model', default='coco',
+                        help='Model the clients request')
+    parser.add_argument('--location', type=float, nargs=2,
+                        default=[40.4433, -79.9436],
+                        metavar=('LATITUDE', 'LONGITUDE'),
+                        help='Clients are placed randomly within ~1km of it')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=5,
+                        help='Seconds to send frames before measuring')
+    parser.add_argument('--ramp', type=float, default=2,
+                        help='Seconds over which the clients connect')
+    parser.add_argument('--stale-ms', type=float, default=1000,
+                        help='Results arriving later than this are stale')
+    parser.add_argument('--max-frames', type=int, default=300,
+                        help='Frames loaded per source, they are looped')
+    parser.add_argument('-o', '--output', help='Write a JSON report here')
+    parser.add_argument('-l', '--loglevel', default='INFO',
+                        help='Set the log level')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=args.loglevel)
+
+    sources = {source: load_frames(source, args.max_frames)
+               for source in args.source}
+    clients = asyncio.run(run_clients(args, sources))
+
+    report = {
+        'server': args.server,
+        'duration_s': args.duration,
+        'clients': [client.report(args.duration) for client in clients],
+        'aggregate': aggregate(clients, args.duration),
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Compare the per-frame cost of annotating stored images through PIL (and
+yolov5's render()) with openscout.annotate. Saving the images is left out,
+it costs the same either way.
+
+    poetry run python benchmarks/annotate.py
+"""
+
+import argparse
+import timeit
+from io import BytesIO
+
+import cv2
+import importlib_resources
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+from yolov5.models.common import Detections
+from yolov5.utils.general import Profile
+
+from openscout.annotate import Annotator
+from openscout.decode import decode_rgb
+from openscout.postprocess import to_detections
+
+NAMES = {i: f"class{i}" for i in range(80)}
+
+
+def make_frame(width, height, rng):
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    image = cv2.GaussianBlur(image, (0, 0), 5)
+    _, jpeg = cv2.imencode(".jpg", image)
+    return image, jpeg.tobytes()
+
+
+def make_pred(num_boxes, width, height, rng):
+    xy = rng.uniform(0, [width * 0.8, height * 0.8], size=(num_boxes, 2))
+    wh = rng.uniform(20, [width * 0.2, height * 0.2], size=(num_boxes, 2))
+    pred = np.concatenate(
+        [
+            xy,
+            xy + wh,
+            rng.uniform(0.5, 1, size=(num_boxes, 1)),
+            rng.integers(0, 80, size=(num_boxes, 1)),
+        ],
+        axis=1,
+    )
+    return pred.astype(np.float32)
+
+
+def pil_objects(image, pred, watermark):
+    times = (Profile(), Profile(), Profile())
+    results = Detections(
+        [image.copy()], [torch.from_numpy(pred)], ["image0.jpg"], times, NAMES, (1, 3)
+    )
+    results.render()
+    img = Image.fromarray(results.ims[0])
+    draw = ImageDraw.Draw(img)
+    draw.bitmap((0, 0), watermark, fill=None)
+    return img
+
+
+def array_objects(image, detections, annotator):
+    return annotator.detections(image.copy(), detections, NAMES)
+
+
+def text_size(draw, text):
+    # ImageDraw.textsize was removed in Pillow 10
+    if hasattr(draw, "textsize"):
+        return draw.textsize(text)
+    left, top, right, bottom = draw.textbbox((0, 0), text)
+    return right - left, bottom - top
+
+
+def pil_faces(jpeg, boxes, labels, watermark):
+    img = Image.open(BytesIO(jpeg))
+    draw = ImageDraw.Draw(img)
+    for (x1, y1, x2, y2), text in zip(boxes, labels):
+        draw.rectangle(((x1, y1), (x2, y2)), width=4, outline="red")
+        w, h = text_size(draw, text)
+        draw.rectangle(((x1, y1), (x1 + w, y1 + h)), width=4, outline="red", fill="red")
+        draw.text((x1, y1), text, fill="black")
+    draw.bitmap((0, 0), watermark, fill=None)
+    img.load()
+    return img
+
+
+def array_faces(jpeg, boxes, labels, annotator):
+    return annotator.faces(decode_rgb(jpeg), boxes, labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=200, help="Iterations per measurement"
+    )
+    parser.add_argument("--width", type=int, default=1280, help="Frame width")
+    parser.add_argument("--height", type=int, default=720, help="Frame height")
+    parser.add_argument(
+        "--boxes",
+        default="1,10,50",
+        help="Comma separated list of box counts per frame",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    watermark = Image.open(
+        importlib_resources.files("openscout").joinpath("watermark.png")
+    )
+    annotator = Annotator()
+    image, jpeg = make_frame(args.width, args.height, rng)
+
+    print(
+        f"{'path':>8} {'boxes':>6} {'PIL (ms)':>10} {'annotate (ms)':>14}"
+        f" {'speedup':>8}"
+    )
+    for num_boxes in map(int, args.boxes.split(",")):
+        pred = make_pred(num_boxes, args.width, args.height, rng)
+        detections = to_detections(pred)
+        boxes = pred[:, :4].astype(int).tolist()
+        labels = [f"person{i} ({score:.3f})" for i, score in enumerate(pred[:, 4])]
+
+        cases = [
+            (
+                "objects",
+                lambda pred=pred: pil_objects(image, pred, watermark),
+                lambda detections=detections: array_objects(
+                    image, detections, annotator
+                ),
+            ),
+            (
+                "faces",
+                lambda boxes=boxes, labels=labels: pil_faces(
+                    jpeg, boxes, labels, watermark
+                ),
+                lambda boxes=boxes, labels=labels: array_faces(
+                    jpeg, boxes, labels, annotator
+                ),
+            ),
+        ]
+        for name, before_path, after_path in cases:
+            before = timeit.timeit(before_path, number=args.number)
+            after = timeit.timeit(after_path, number=args.number)
+            print(
+                f"{name:>8} {num_boxes:>6} {before / args.number * 1e3:>10.2f}"
+                f" {after / args.number * 1e3:>14.2f} {before / after:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
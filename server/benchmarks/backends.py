@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Compare CPU inference latency of the object engine backends.
+
+Run from the directory containing models/, e.g.
+
+    poetry run python benchmarks/backends.py -m coco --images ~/frames
+"""
+
+import argparse
+import os
+import statistics
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from openscout.backends import BACKENDS
+from openscout.object_engine import model_path
+
+
+def load_images(directory, count):
+    if directory is None:
+        rng = np.random.default_rng(0)
+        return [
+            rng.integers(0, 256, size=(1080, 1920, 3), dtype=np.uint8)
+            for _ in range(count)
+        ]
+    images = []
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix.lower() in (".jpg", ".jpeg", ".png"):
+            img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+            images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-m", "--model", default="coco", help="Model under models/")
+    parser.add_argument(
+        "--images", help="Directory of frames to use instead of random noise"
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=50, help="Frames to run per backend"
+    )
+    parser.add_argument("-s", "--size", type=int, default=640, help="Input size")
+    parser.add_argument(
+        "-r", "--threshold", type=float, default=0.85, help="Confidence threshold"
+    )
+    parser.add_argument(
+        "--threads", type=int, help="Number of torch intra-op threads to use"
+    )
+    args = parser.parse_args()
+
+    # compare on the CPU only, CUDA is initialized lazily so this still works
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    if args.threads:
+        import torch
+
+        torch.set_num_threads(args.threads)
+
+    images = load_images(args.images, 8)
+    path = model_path(args.model)
+
+    print(
+        f"{'backend':>8} {'load (s)':>9} {'mean (ms)':>10} {'p95 (ms)':>9} {'dets':>6}"
+    )
+    for name, backend_class in BACKENDS.items():
+        start = time.perf_counter()
+        backend = backend_class(path, args.threshold)
+        load_time = time.perf_counter() - start
+
+        backend.infer(images[:1], args.size)  # warm up
+        latencies = []
+        detections = 0
+        for i in range(args.number):
+            start = time.perf_counter()
+            (result,) = backend.infer([images[i % len(images)]], args.size)
+            latencies.append(time.perf_counter() - start)
+            detections += len(result.pred[0])
+
+        latencies.sort()
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(
+            f"{name:>8} {load_time:>9.2f} {statistics.mean(latencies) * 1000:>10.1f}"
+            f" {p95 * 1000:>9.1f} {detections:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
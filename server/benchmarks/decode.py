@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Compare the full resolution decode the object engine used to do with the
+scaled, pooled decode in openscout.decode.
+
+    poetry run python benchmarks/decode.py
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from openscout.decode import FrameDecoder
+
+RESOLUTIONS = {"1080p": (1080, 1920), "4k": (2160, 3840)}
+
+
+def make_frame(height, width, rng):
+    noise = rng.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+    frame = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    return cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def full_decode(payload):
+    np_data = np.frombuffer(payload, dtype=np.uint8)
+    img = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def measure(func, payload, number):
+    func(payload)  # warm up
+    start = time.perf_counter()
+    for _ in range(number):
+        func(payload)
+    elapsed = (time.perf_counter() - start) / number
+
+    tracemalloc.start()
+    func(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=50, help="Iterations per measurement"
+    )
+    parser.add_argument("-s", "--size", type=int, default=640, help="Model input size")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    decoder = FrameDecoder()
+
+    def scaled_decode(payload):
+        img, _ = decoder.decode(payload, args.size)
+        decoder.release(img)
+        return img
+
+    print(
+        f"{'frame':>6} {'full (ms)':>10} {'full (MB)':>10}"
+        f" {'scaled (ms)':>12} {'scaled (MB)':>12}"
+    )
+    for name, (height, width) in RESOLUTIONS.items():
+        payload = make_frame(height, width, rng)
+        before, before_mem = measure(full_decode, payload, args.number)
+        after, after_mem = measure(scaled_decode, payload, args.number)
+        print(
+            f"{name:>6} {before * 1000:>10.2f} {before_mem / 2**20:>10.1f}"
+            f" {after * 1000:>12.2f} {after_mem / 2**20:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Compare the logging.FileHandler CSV detection log the engines used to
+write with the buffered NDJSON DetectionSink under a burst of detections.
+
+    poetry run python benchmarks/detection_log.py --rate 10000
+"""
+
+import argparse
+import logging
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from openscout.sink import DetectionSink
+
+
+def file_handler_writer(path):
+    log = logging.getLogger("benchmark-detections")
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(handler)
+
+    def write(record):
+        log.info(
+            "{},{},{},{},{},{:.3f},{}".format(
+                record["detection_time"],
+                record["client_id"],
+                record["latitude"],
+                record["longitude"],
+                record["entity"],
+                record["confidence"],
+                record["image"],
+            )
+        )
+
+    def close():
+        log.removeHandler(handler)
+        handler.close()
+
+    return write, close
+
+
+def sink_writer(path):
+    sink = DetectionSink(path, flush_interval=1.0, max_bytes=64 * 2**20)
+    return sink.write, sink.close
+
+
+def run(make_writer, path, rate, duration):
+    """Write rate records per second for duration seconds, in bursts of one
+    frame worth of detections every millisecond. Returns the per-record cost
+    in the calling thread, the achieved rate and the time to close."""
+    write, close = make_writer(path)
+    per_tick = max(1, rate // 1000)
+    costs = []
+    start = time.perf_counter()
+    count = 0
+    while count < rate * duration:
+        tick = time.perf_counter()
+        for _ in range(per_tick):
+            write(
+                {
+                    "detection_time": int(time.time() * 1000),
+                    "client_id": "client-1",
+                    "latitude": 40.4433,
+                    "longitude": -79.9436,
+                    "entity": "car",
+                    "confidence": 0.912,
+                    "image": "http://localhost/detected/1697650000000.jpg",
+                }
+            )
+        count += per_tick
+        costs.append((time.perf_counter() - tick) / per_tick)
+        # pace to the target rate, but never wait if we are behind
+        delay = start + count / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    elapsed = time.perf_counter() - start
+    close_start = time.perf_counter()
+    close()
+    return costs, count / elapsed, time.perf_counter() - close_start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--rate", type=int, default=10000, help="Detections per second to write"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds to write for"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'writer':>13} {'rate (/s)':>10} {'mean (us)':>10} {'p99 (us)':>9}"
+        f" {'close (ms)':>11}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, make_writer, filename in (
+            ("FileHandler", file_handler_writer, "detections.log"),
+            ("DetectionSink", sink_writer, "detections.ndjson"),
+        ):
+            costs, rate, close_time = run(
+                make_writer, Path(tmp) / filename, args.rate, args.duration
+            )
+            costs.sort()
+            p99 = costs[int(len(costs) * 0.99) - 1]
+            print(
+                f"{name:>13} {rate:>10.0f} {statistics.mean(costs) * 1e6:>10.1f}"
+                f" {p99 * 1e6:>9.1f} {close_time * 1000:>11.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Measure object engine workers end to end, through a Gabriel server.
+
+For 1, 2, 4, ... up to --max-workers engines, starts a Gabriel server and
+that many object engine processes connected to it under the same source, as
+--workers does, and --clients websocket clients that send frames as fast as
+their tokens allow for --duration seconds. Reports per second the frames the
+clients sent, the frames the engines handled, the responses the clients got
+and the distinct frames they got a response for, and the engine calls and
+responses per frame sent. Arguments after -- are passed to the engines, e.g.
+
+    poetry run python benchmarks/dispatch.py --images ~/frames --stub \\
+        --max-workers 4 -- --threads 1
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import websockets
+from gabriel_protocol import gabriel_pb2
+from gabriel_server.network_engine import engine_runner, server_runner
+from replay import StubBackend, create_engine, load_frames
+
+SOURCE = "openscout"
+INPUT_QUEUE_MAXSIZE = 60  # as the openscout server
+STARTUP_TIMEOUT = 120  # seconds for the engines to load their model
+
+
+def run_server(port, zmq_port, tokens):
+    server_runner.run(
+        websocket_port=port,
+        zmq_address=f"tcp://*:{zmq_port}",
+        num_tokens=tokens,
+        input_queue_maxsize=INPUT_QUEUE_MAXSIZE,
+    )
+
+
+def run_engine(args, engine_argv, zmq_port, log_dir, ready, handled):
+    StubBackend.latency = args.stub_latency / 1000
+    engine = create_engine(
+        "object",
+        args.stub,
+        ["--log-dir", log_dir, "--trace-dir", log_dir] + engine_argv,
+    )
+    logging.disable(logging.INFO)
+    handle = engine.handle
+
+    def counted(input_frame):
+        result = handle(input_frame)
+        with handled.get_lock():
+            handled.value += 1
+        return result
+
+    engine.handle = counted
+    ready.release()
+    engine_runner.run(
+        engine=engine,
+        source_name=SOURCE,
+        server_address=f"tcp://localhost:{zmq_port}",
+        all_responses_required=True,
+    )
+
+
+async def run_client(uri, client, frames, duration, counts):
+    """Send frames whenever a token is available, count the responses"""
+    websocket = await websockets.connect(uri)
+    tokens = asyncio.Queue()
+
+    async def receive():
+        async for message in websocket:
+            to_client = gabriel_pb2.ToClient()
+            to_client.ParseFromString(message)
+            if to_client.HasField("welcome"):
+                for _ in range(to_client.welcome.num_tokens_per_source):
+                    tokens.put_nowait(None)
+            elif to_client.HasField("response"):
+                response = to_client.response
+                counts["responses"] += 1
+                counts["answered"].add((client, response.frame_id))
+                if response.return_token:
+                    tokens.put_nowait(None)
+
+    receiver = asyncio.ensure_future(receive())
+    deadline = time.monotonic() + duration
+    frame_id = 0
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(tokens.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            from_client = gabriel_pb2.FromClient()
+            from_client.frame_id = frame_id
+            from_client.source_name = SOURCE
+            from_client.input_frame.CopyFrom(frames[frame_id % len(frames)])
+            await websocket.send(from_client.SerializeToString())
+            counts["sent"] += 1
+            frame_id += 1
+        # responses to frames still in flight are not counted
+    finally:
+        receiver.cancel()
+        await websocket.close()
+
+
+async def run_clients(args, port):
+    counts = {"sent": 0, "responses": 0, "answered": set()}
+    clients = [
+        run_client(
+            f"ws://localhost:{port}",
+            client,
+            load_frames(args.images, 1),
+            args.duration,
+            counts,
+        )
+        for client in range(args.clients)
+    ]
+    await asyncio.gather(*clients)
+    return counts
+
+
+def measure(args, engine_argv, workers, port, log_dir):
+    context = multiprocessing.get_context("spawn")
+    zmq_port = port + 1
+    server = context.Process(
+        target=run_server, args=(port, zmq_port, args.tokens), daemon=True
+    )
+    server.start()
+
+    ready = context.Semaphore(0)
+    handled = context.Value("l", 0)
+    engines = []
+    for index in range(workers):
+        engine_dir = Path(log_dir) / f"{port}-{index}"
+        engine_dir.mkdir()
+        engines.append(
+            context.Process(
+                target=run_engine,
+                args=(args, engine_argv, zmq_port, str(engine_dir), ready, handled),
+                daemon=True,
+            )
+        )
+    try:
+        for engine in engines:
+            engine.start()
+        for _ in engines:
+            if not ready.acquire(timeout=STARTUP_TIMEOUT):
+                sys.exit("Engines did not start in time")
+        time.sleep(1)  # for the welcome messages to reach the server
+
+        start = time.monotonic()
+        counts = asyncio.run(run_clients(args, port))
+        elapsed = time.monotonic() - start
+        calls = handled.value
+    finally:
+        for process in engines + [server]:
+            process.terminate()
+            process.join()
+
+    return counts["sent"], calls, counts["responses"], len(counts["answered"]), elapsed
+
+
+def main():
+    argv = sys.argv[1:]
+    engine_argv = []
+    if "--" in argv:
+        index = argv.index("--")
+        argv, engine_argv = argv[:index], argv[index + 1 :]
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--images", required=True, help="Directory of JPEG frames")
+    parser.add_argument(
+        "--max-workers", type=int, default=4, help="Largest number of engines"
+    )
+    parser.add_argument(
+        "--clients", type=int, default=4, help="Number of websocket clients"
+    )
+    parser.add_argument(
+        "--tokens", type=int, default=2, help="Tokens per client, as the server"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=20, help="Seconds to measure per step"
+    )
+    parser.add_argument(
+        "--port", type=int, default=9399, help="First port of the Gabriel servers"
+    )
+    parser.add_argument(
+        "--stub", action="store_true", help="Replace the detector with a stub"
+    )
+    parser.add_argument(
+        "--stub-latency", type=float, default=20, help="Stub inference time in ms"
+    )
+    args = parser.parse_args(argv)
+
+    counts = [1]
+    while counts[-1] * 2 <= args.max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != args.max_workers:
+        counts.append(args.max_workers)
+
+    print(
+        f"{'workers':>7} {'sent/s':>7} {'handled/s':>9} {'responses/s':>11}"
+        f" {'answered/s':>10} {'calls/frame':>11} {'responses/frame':>15}"
+    )
+    with tempfile.TemporaryDirectory() as log_dir:
+        for step, workers in enumerate(counts):
+            # fresh ports, the last server's may still be lingering
+            port = args.port + 2 * step
+            sent, calls, responses, answered, elapsed = measure(
+                args, engine_argv, workers, port, log_dir
+            )
+            print(
+                f"{workers:>7} {sent / elapsed:>7.1f} {calls / elapsed:>9.1f}"
+                f" {responses / elapsed:>11.1f} {answered / elapsed:>10.1f}"
+                f" {calls / max(sent, 1):>11.2f} {responses / max(sent, 1):>15.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
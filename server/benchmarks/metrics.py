@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Measure the per-frame cost of the engine instrumentation.
+
+    poetry run python benchmarks/metrics.py
+"""
+
+import argparse
+import timeit
+
+from openscout.metrics import EngineMetrics, Registry, instrumented
+
+
+class Engine:
+    def __init__(self, registry):
+        self.metrics = EngineMetrics("benchmark", registry)
+
+    def plain(self, frame):
+        return frame
+
+    @instrumented
+    def handle(self, frame):
+        with self.metrics.time("decode"):
+            pass
+        self.metrics.stage("inference").observe(0.02)
+        self.metrics.detections.inc(3)
+        return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=200000, help="Iterations per measurement"
+    )
+    args = parser.parse_args()
+
+    registry = Registry()
+    engine = Engine(registry)
+    histogram = engine.metrics.stage("inference")
+
+    measurements = {
+        "histogram observe": lambda: histogram.observe(0.02),
+        "counter inc": lambda: engine.metrics.frames.inc(),
+        "timer block": lambda: engine.metrics.time("decode")
+        .__enter__()
+        .__exit__(None, None, None),
+        # what the object engine records for every frame
+        "instrumented frame": lambda: engine.handle(None),
+        "uninstrumented frame": lambda: engine.plain(None),
+    }
+    for name, func in measurements.items():
+        seconds = timeit.timeit(func, number=args.number) / args.number
+        print(f"{name:>22} {seconds * 1e6:6.2f} us")
+
+    scrape = timeit.timeit(registry.expose, number=1000) / 1000
+    print(f"{'scrape':>22} {scrape * 1e6:6.2f} us")
+
+
+if __name__ == "__main__":
+    main()
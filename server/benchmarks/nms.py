@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Compare the per-frame post-processing cost of filtering excluded classes
+and low scores after NMS with handing the DetectionFilter to NMS, on raw
+YOLOv5 output of synthetic dense scenes. Both run with the same --max-det,
+the effect of lowering it to --cap is reported separately.
+
+    poetry run python benchmarks/nms.py --objects 50,200,500
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+
+from openscout.backends import non_max_suppression
+from openscout.postprocess import MAX_DETECTIONS, DetectionFilter, to_detections
+
+ANCHORS = 25200  # output rows of a 640x640 input
+NUM_CLASSES = 80
+THRESHOLD = 0.5
+
+
+def make_prediction(num_objects, anchors_per_object, excluded, rng):
+    """Raw (anchors, 5 + classes) output with num_objects objects, each seen
+    by anchors_per_object overlapping anchors, a share of them of the
+    excluded classes, over a background of low scoring anchors"""
+    prediction = np.zeros((ANCHORS, 5 + NUM_CLASSES), dtype=np.float32)
+    prediction[:, :2] = rng.uniform(0, 640, size=(ANCHORS, 2))
+    prediction[:, 2:4] = rng.uniform(4, 64, size=(ANCHORS, 2))
+    prediction[:, 4] = rng.uniform(0, 0.3, size=ANCHORS)
+    prediction[:, 5:] = rng.uniform(0, 0.3, size=(ANCHORS, NUM_CLASSES))
+
+    kept = np.setdiff1d(np.arange(NUM_CLASSES), excluded)
+    rows = rng.choice(ANCHORS, size=num_objects * anchors_per_object, replace=False)
+    for i, object_rows in enumerate(rows.reshape(num_objects, anchors_per_object)):
+        classes = excluded if i % 2 == 0 else kept
+        cls = rng.choice(classes)
+        center = rng.uniform(32, 608, size=2)
+        size = rng.uniform(16, 96, size=2)
+        jitter = rng.normal(0, 2, size=(anchors_per_object, 4))
+        prediction[object_rows, :2] = center + jitter[:, :2]
+        prediction[object_rows, 2:4] = size + jitter[:, 2:]
+        prediction[object_rows, 4] = rng.uniform(0.6, 1, size=anchors_per_object)
+        prediction[object_rows, 5 + cls] = rng.uniform(0.5, 1, size=anchors_per_object)
+    return prediction
+
+
+def after_nms(prediction, exclusions, max_det):
+    """Filtering as the engine did before the filter was applied in NMS"""
+    detections = to_detections(
+        non_max_suppression(prediction, THRESHOLD, max_det=max_det)
+    )
+    mask = detections["confidence"] > THRESHOLD
+    mask &= ~np.isin(detections["class"], exclusions)
+    return detections[mask]
+
+
+def in_nms(prediction, detection_filter, class_thresholds):
+    pred = non_max_suppression(
+        prediction,
+        detection_filter.min_threshold,
+        class_thresholds=class_thresholds,
+        max_det=detection_filter.max_det,
+    )
+    return detection_filter.apply(to_detections(pred))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=20, help="Iterations per measurement"
+    )
+    parser.add_argument(
+        "--objects",
+        default="50,200,500",
+        help="Comma separated list of object counts per frame, half of them"
+        " of excluded classes",
+    )
+    parser.add_argument(
+        "--anchors-per-object",
+        type=int,
+        default=20,
+        help="Overlapping candidates per object",
+    )
+    parser.add_argument(
+        "--exclude",
+        default="0,2,3,5,7",
+        help="Comma separated list of excluded class ids",
+    )
+    parser.add_argument(
+        "--max-det",
+        type=int,
+        default=MAX_DETECTIONS,
+        help="Maximum detections per frame of both ways of filtering",
+    )
+    parser.add_argument(
+        "--cap",
+        type=int,
+        default=100,
+        help="Lower maximum to measure filtering in NMS with",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    exclusions = np.array(list(map(int, args.exclude.split(","))))
+    detection_filter = DetectionFilter(
+        THRESHOLD, exclusions=exclusions, max_det=args.max_det
+    )
+    capped_filter = DetectionFilter(THRESHOLD, exclusions=exclusions, max_det=args.cap)
+    class_thresholds = detection_filter.thresholds(NUM_CLASSES)
+
+    def measure(function, *arguments):
+        seconds = timeit.timeit(lambda: function(*arguments), number=args.number)
+        return seconds / args.number * 1e3, len(function(*arguments))
+
+    print(
+        f"{'objects':>8} {'after NMS (ms)':>15} {'in NMS (ms)':>12} {'speedup':>8}"
+        f" {'kept':>6} {f'cap {args.cap} (ms)':>14} {'speedup':>8} {'kept':>6}"
+    )
+    for num_objects in map(int, args.objects.split(",")):
+        prediction = make_prediction(
+            num_objects, args.anchors_per_object, exclusions, rng
+        )
+        before, kept_before = measure(after_nms, prediction, exclusions, args.max_det)
+        after, kept_after = measure(
+            in_nms, prediction, detection_filter, class_thresholds
+        )
+        assert kept_before == kept_after
+        capped, kept_capped = measure(
+            in_nms, prediction, capped_filter, class_thresholds
+        )
+        print(
+            f"{num_objects:>8} {before:>15.2f} {after:>12.2f} {before / after:>7.1f}x"
+            f" {kept_after:>6} {capped:>14.2f} {after / capped:>7.1f}x"
+            f" {kept_capped:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Compare per-frame cost of the pandas based detection post-processing with
+the structured array path in openscout.postprocess.
+
+    poetry run python benchmarks/postprocess.py
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+import torch
+from yolov5.models.common import Detections
+from yolov5.utils.general import Profile
+
+from openscout.postprocess import DetectionFilter, to_detections
+
+NAMES = {i: f"class{i}" for i in range(80)}
+THRESHOLD = 0.5
+EXCLUSIONS = [1, 2, 3]
+DETECTION_FILTER = DetectionFilter(THRESHOLD, exclusions=EXCLUSIONS)
+
+
+def make_results(num_boxes, rng):
+    image = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    xy = rng.uniform(0, 1000, size=(num_boxes, 2))
+    wh = rng.uniform(10, 500, size=(num_boxes, 2))
+    pred = np.concatenate(
+        [
+            xy,
+            xy + wh,
+            rng.uniform(0, 1, size=(num_boxes, 1)),
+            rng.integers(0, 80, size=(num_boxes, 1)),
+        ],
+        axis=1,
+    )
+    pred = torch.from_numpy(pred.astype(np.float32))
+    times = (Profile(), Profile(), Profile())
+    return Detections([image], [pred], ["image0.jpg"], times, NAMES, (1, 3))
+
+
+def pandas_path(results):
+    df = results.pandas().xyxy[0]
+    classes = df["class"].values.tolist()
+    scores = df["confidence"].values.tolist()
+    names = df["name"].values.tolist()
+    r = []
+    for i in range(0, len(classes)):
+        if scores[i] > THRESHOLD:
+            if classes[i] not in EXCLUSIONS:
+                r.append(f"Detected {names[i]} ({scores[i]:.3f})")
+    return r
+
+
+def array_path(results):
+    detections = DETECTION_FILTER.apply(to_detections(results.pred[0]))
+    r = []
+    for detection in detections:
+        name = results.names[int(detection["class"])]
+        r.append(f"Detected {name} ({float(detection['confidence']):.3f})")
+    return r
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "-n", "--number", type=int, default=1000, help="Iterations per measurement"
+    )
+    parser.add_argument(
+        "--boxes",
+        default="0,10,300",
+        help="Comma separated list of box counts per frame",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'boxes':>6} {'pandas (us)':>12} {'array (us)':>12} {'speedup':>8}")
+    for num_boxes in map(int, args.boxes.split(",")):
+        results = make_results(num_boxes, rng)
+        assert pandas_path(results) == array_path(results)
+
+        before = timeit.timeit(
+            lambda results=results: pandas_path(results), number=args.number
+        )
+        after = timeit.timeit(
+            lambda results=results: array_path(results), number=args.number
+        )
+        print(
+            f"{num_boxes:>6} {before / args.number * 1e6:>12.1f}"
+            f" {after / args.number * 1e6:>12.1f} {before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
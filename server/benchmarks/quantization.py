@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Measure what INT8 quantization gains and costs for a model on this CPU.
+
+Runs the FP32 ONNX model and its quantized version on the same frames and
+reports latency, throughput and how well their detections agree. Run from the
+directory containing models/, e.g.
+
+    poetry run python benchmarks/quantization.py -m coco --images ~/frames \\
+        --quantize static --calibration-dir ~/calibration
+"""
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from openscout.backends import OnnxBackend
+from openscout.object_engine import model_path
+from openscout.postprocess import box_iou
+from openscout.quantize import IMAGE_SUFFIXES, QUANTIZATION_MODES
+
+MATCH_IOU = 0.5
+
+
+def load_images(directory):
+    images = []
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix.lower() in IMAGE_SUFFIXES:
+            img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+            images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+    return images
+
+
+def run(backend, images, size):
+    backend.infer(images[:1], size)  # warm up
+    latencies, preds = [], []
+    for image in images:
+        start = time.perf_counter()
+        (result,) = backend.infer([image], size)
+        latencies.append(time.perf_counter() - start)
+        preds.append(result.pred[0])
+    return latencies, preds
+
+
+def match(reference, candidate):
+    """Greedily pair same-class detections with IoU >= MATCH_IOU, returns the
+    number of pairs and their absolute confidence differences."""
+    if len(reference) == 0 or len(candidate) == 0:
+        return 0, []
+    iou = box_iou(reference[:, :4], candidate[:, :4])
+    iou[reference[:, 5][:, None] != candidate[:, 5][None, :]] = 0
+    pairs, diffs = 0, []
+    while True:
+        i, j = np.unravel_index(iou.argmax(), iou.shape)
+        if iou[i, j] < MATCH_IOU:
+            break
+        pairs += 1
+        diffs.append(abs(reference[i, 4] - candidate[j, 4]))
+        iou[i, :] = 0
+        iou[:, j] = 0
+    return pairs, diffs
+
+
+def summarize(name, latencies):
+    mean = statistics.mean(latencies)
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(
+        f"{name:>6} mean {mean * 1000:7.1f} ms  p95 {p95 * 1000:7.1f} ms"
+        f"  {1 / mean:6.1f} frames/s"
+    )
+    return mean
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-m", "--model", default="coco", help="Model under models/")
+    parser.add_argument("--images", required=True, help="Directory of test frames")
+    parser.add_argument(
+        "--quantize", choices=QUANTIZATION_MODES, default="static", help="INT8 mode"
+    )
+    parser.add_argument(
+        "--calibration-dir",
+        help="Calibration frames for static quantization, defaults to --images",
+    )
+    parser.add_argument("-s", "--size", type=int, default=640, help="Input size")
+    parser.add_argument(
+        "-r", "--threshold", type=float, default=0.5, help="Confidence threshold"
+    )
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    path = model_path(args.model)
+    fp32 = OnnxBackend(path, args.threshold)
+    int8 = OnnxBackend(
+        path,
+        args.threshold,
+        quantize=args.quantize,
+        calibration_dir=args.calibration_dir or args.images,
+    )
+
+    fp32_latencies, fp32_preds = run(fp32, images, args.size)
+    int8_latencies, int8_preds = run(int8, images, args.size)
+
+    print(f"{len(images)} frames, {args.quantize} quantization")
+    fp32_mean = summarize("fp32", fp32_latencies)
+    int8_mean = summarize("int8", int8_latencies)
+    print(f"speedup {fp32_mean / int8_mean:.2f}x")
+
+    fp32_count = sum(len(p) for p in fp32_preds)
+    int8_count = sum(len(p) for p in int8_preds)
+    pairs, diffs = 0, []
+    for reference, candidate in zip(fp32_preds, int8_preds):
+        n, d = match(reference, candidate)
+        pairs += n
+        diffs.extend(d)
+    total = fp32_count + int8_count
+    print(f"detections fp32 {fp32_count}, int8 {int8_count}, matched {pairs}")
+    print(f"agreement (F1) {2 * pairs / total if total else 1.0:.3f}")
+    if diffs:
+        print(f"mean confidence difference {statistics.mean(diffs):.3f}")
+
+
+if __name__ == "__main__":
+    main()
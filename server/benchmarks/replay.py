@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Replay a directory of JPEGs through an engine's handle() and write a JSON
+report with throughput, latency percentiles and a per-stage breakdown.
+
+Frames are fed in-process, without a Gabriel server, either as fast as the
+engine handles them or at a fixed --rate. With --stub the detector (or the
+face service) is replaced by a stub with a fixed latency, so the rest of the
+pipeline can be measured on any CPU. Arguments after -- are passed to the
+engine, e.g.
+
+    poetry run python benchmarks/replay.py object --images ~/frames --stub \\
+        -o report.json -- --cache-distance 4
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+from gabriel_protocol import gabriel_pb2
+
+from openscout import metrics
+from openscout.backends import BACKENDS, Detections
+from openscout.protocol import openscout_pb2
+
+STUB_NAMES = {0: "person", 1: "car", 2: "dog"}
+
+
+class StubBackend:
+    """Detector backend that sleeps for a fixed time and returns fixed boxes"""
+
+    latency = 0.02
+    detections = 3
+
+    def __init__(self, model_path, threshold, **options):
+        self.threshold = threshold
+
+    def infer(self, images, size):
+        time.sleep(self.latency)
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            pred = np.array(
+                [
+                    [
+                        width * i / 8,
+                        height * i / 8,
+                        width * (i + 2) / 8,
+                        height * (i + 2) / 8,
+                        0.99,
+                        i % len(STUB_NAMES),
+                    ]
+                    for i in range(self.detections)
+                ],
+                dtype=np.float32,
+            ).reshape(-1, 6)
+            results.append(Detections(image, pred, STUB_NAMES))
+        return results
+
+    def memory_footprint(self):
+        return 0
+
+    @staticmethod
+    def exists(model_path):
+        return True
+
+
+class StubOpenFaceClient:
+    """Stands in for the OpenFace service client"""
+
+    def __init__(self, endpoint, *args):
+        pass
+
+    def train(self):
+        return {"status": "trained"}
+
+    def infer(self, payload):
+        time.sleep(StubBackend.latency)
+        return json.dumps(
+            [
+                {
+                    "name": "stub",
+                    "confidence": 0.99,
+                    "bb-tl-x": 10,
+                    "bb-tl-y": 10,
+                    "bb-br-x": 60,
+                    "bb-br-y": 60,
+                }
+            ]
+        )
+
+    def close(self):
+        pass
+
+
+class StubFaceClient:
+    """Stands in for the MS Face FaceClient"""
+
+    def __init__(self, endpoint, credentials):
+        from azure.cognitiveservices.vision.face.models import TrainingStatusType
+
+        status = SimpleNamespace(status=TrainingStatusType.succeeded)
+        person = SimpleNamespace(name="stub", person_id="stub-person")
+        self.person_group = SimpleNamespace(
+            create=lambda **kwargs: None,
+            train=lambda group: None,
+            get_training_status=lambda group: status,
+        )
+        self.person_group_person = SimpleNamespace(
+            list=lambda group: [],
+            create=lambda group, name: person,
+            add_face_from_stream=lambda group, person_id, stream: None,
+            get=lambda group, person_id: person,
+        )
+        self.face = SimpleNamespace(
+            detect_with_stream=self.detect, identify=self.identify
+        )
+
+    def detect(self, image):
+        time.sleep(StubBackend.latency / 2)
+        rectangle = SimpleNamespace(left=10, top=10, width=50, height=50)
+        return [SimpleNamespace(face_id="stub-face", face_rectangle=rectangle)]
+
+    def identify(self, face_ids, group):
+        time.sleep(StubBackend.latency / 2)
+        candidate = SimpleNamespace(confidence=0.99, person_id="stub-person")
+        return [SimpleNamespace(candidates=[candidate]) for _ in face_ids]
+
+
+def create_engine(name, stub, engine_argv):
+    if name == "object":
+        from openscout import obj
+        from openscout.object_engine import OpenScoutObjectEngine
+
+        if stub:
+            BACKENDS["stub"] = StubBackend
+            engine_argv = ["--backend", "stub"] + engine_argv
+        args = obj.create_parser().parse_args(engine_argv)
+        return OpenScoutObjectEngine(args)
+
+    from openscout import face
+
+    args = face.create_parser().parse_args(engine_argv)
+    if name == "openface":
+        from openscout import openface_engine
+
+        if stub:
+            openface_engine.OpenFaceClient = StubOpenFaceClient
+        return openface_engine.OpenFaceEngine(args)
+
+    from openscout import msface_engine
+
+    if stub:
+        msface_engine.FaceClient = StubFaceClient
+    return msface_engine.MSFaceEngine(args)
+
+
+def load_frames(directory, clients):
+    payloads = [
+        path.read_bytes()
+        for path in sorted(Path(directory).iterdir())
+        if path.suffix.lower() in (".jpg", ".jpeg")
+    ]
+    if not payloads:
+        sys.exit(f"No JPEG images found in {directory}")
+
+    client_ids = [f"replay-{uuid.uuid4().hex[:8]}" for _ in range(clients)]
+    frames = []
+    for i, payload in enumerate(payloads):
+        frame = gabriel_pb2.InputFrame()
+        frame.payload_type = gabriel_pb2.PayloadType.IMAGE
+        frame.payloads.append(payload)
+        extras = openscout_pb2.Extras()
+        extras.client_id = client_ids[i % clients]
+        extras.location.latitude = 40.4433
+        extras.location.longitude = -79.9436
+        frame.extras.Pack(extras)
+        frames.append(frame)
+    return frames
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+def bucket_quantile(counts, q):
+    """Upper bound in ms of the histogram bucket holding quantile q"""
+    target = q * sum(counts)
+    cumulative = 0
+    for bound, count in zip(metrics.LATENCY_BUCKETS + (float("inf"),), counts):
+        cumulative += count
+        if cumulative >= target:
+            return bound * 1000
+    return float("inf")
+
+
+def stage_breakdown(engine, before):
+    stages = {}
+    for (name, stage), histogram in engine.metrics.latency.children.items():
+        if name != engine.metrics.engine:
+            continue
+        counts, total = histogram.snapshot()
+        start_counts, start_total = before.get(stage, ([0] * len(counts), 0.0))
+        counts = [a - b for a, b in zip(counts, start_counts)]
+        count = sum(counts)
+        if count == 0:
+            continue
+        stages[stage] = {
+            "count": count,
+            "mean": (total - start_total) / count * 1000,
+            # bucket upper bounds, accurate to a factor of sqrt(2)
+            "p50": bucket_quantile(counts, 0.50),
+            "p95": bucket_quantile(counts, 0.95),
+            "p99": bucket_quantile(counts, 0.99),
+        }
+    return stages
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    argv = sys.argv[1:]
+    engine_argv = []
+    if "--" in argv:
+        index = argv.index("--")
+        argv, engine_argv = argv[:index], argv[index + 1 :]
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("engine", choices=("object", "openface", "msface"))
+    parser.add_argument("--images", required=True, help="Directory of JPEG frames")
+    parser.add_argument(
+        "-n", "--frames", type=int, default=500, help="Frames to measure"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=10, help="Frames to handle before measuring"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Frames per second, 0 for max rate"
+    )
+    parser.add_argument(
+        "--clients", type=int, default=1, help="Number of client ids to cycle"
+    )
+    parser.add_argument(
+        "--stub", action="store_true", help="Replace the detector with a stub"
+    )
+    parser.add_argument(
+        "--stub-latency", type=float, default=20, help="Stub inference time in ms"
+    )
+    parser.add_argument(
+        "--stub-detections", type=int, default=3, help="Detections per stub frame"
+    )
+    parser.add_argument(
+        "--trace-dir",
+        help=(
+            "Directory to write the traces of the engine to, sampled with"
+            " -- --trace-rate. Traces are discarded if unset."
+        ),
+    )
+    parser.add_argument("-o", "--output", help="Write the report here, not stdout")
+    args = parser.parse_args(argv)
+
+    StubBackend.latency = args.stub_latency / 1000
+    StubBackend.detections = args.stub_detections
+    frames = load_frames(args.images, args.clients)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # keep detection logs and traces of the replay out of the deployment
+        trace_dir = args.trace_dir or tmp
+        engine_argv = ["--log-dir", tmp, "--trace-dir", trace_dir] + engine_argv
+        start = time.perf_counter()
+        engine = create_engine(args.engine, args.stub, engine_argv)
+        startup = time.perf_counter() - start
+
+        warmup = []
+        for i in range(args.warmup):
+            frame_start = time.perf_counter()
+            engine.handle(frames[i % len(frames)])
+            warmup.append(time.perf_counter() - frame_start)
+
+        before = {
+            stage: histogram.snapshot()
+            for (name, stage), histogram in engine.metrics.latency.children.items()
+            if name == engine.metrics.engine
+        }
+        latencies = []
+        lag = 0.0
+        start = time.perf_counter()
+        for i in range(args.frames):
+            if args.rate:
+                # fixed rate, frames that are late are sent right away
+                scheduled = start + i / args.rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    lag = max(lag, -delay)
+            frame_start = time.perf_counter()
+            engine.handle(frames[i % len(frames)])
+            latencies.append(time.perf_counter() - frame_start)
+        duration = time.perf_counter() - start
+        # write out buffered detections and traces before tmp is removed,
+        # instead of at exit
+        engine.detection_log.close()
+        engine.tracer.close()
+
+        report = {
+            "engine": args.engine,
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "argv": sys.argv[1:],
+            "stub": args.stub,
+            "startup_s": startup,
+            "first_frame_ms": warmup[0] * 1000 if warmup else None,
+            "frames": args.frames,
+            "target_rate": args.rate or None,
+            "duration_s": duration,
+            "throughput_fps": args.frames / duration,
+            "max_lag_ms": lag * 1000 if args.rate else None,
+            "latency_ms": percentiles(latencies),
+            "stages_ms": stage_breakdown(engine, before),
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Measure how the object engine pipeline (decode, inference, filtering)
+scales with the number of worker processes on this host.
+
+Every worker runs the pipeline on the same frames as fast as it can for
+--duration seconds, the aggregate throughput is reported for 1, 2, 4, ... up
+to --max-workers processes. Frames do not go through Gabriel, so this is the
+scaling a deployment gets only once frames are dispatched across workers,
+see dispatch.py for how they are dispatched today. Run from the directory containing models/, e.g.
+
+    poetry run python benchmarks/workers.py -m coco --max-workers 8 --pin-cpus
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from openscout.workers import partition_cpus
+
+
+def make_frames(directory):
+    if directory is not None:
+        return [
+            path.read_bytes()
+            for path in sorted(Path(directory).iterdir())
+            if path.suffix.lower() in (".jpg", ".jpeg")
+        ]
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(8):
+        noise = rng.integers(0, 256, size=(135, 240, 3), dtype=np.uint8)
+        frame = cv2.resize(noise, (1920, 1080), interpolation=cv2.INTER_CUBIC)
+        frames.append(cv2.imencode(".jpg", frame)[1].tobytes())
+    return frames
+
+
+def worker(args, cpus, frames, barrier, results):
+    import torch
+
+    from openscout.decode import FrameDecoder
+    from openscout.object_engine import PytorchPredictor
+    from openscout.postprocess import DetectionFilter, to_detections
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    threads = args.threads or (len(cpus) if cpus else None)
+    options = {}
+    if threads:
+        torch.set_num_threads(threads)
+        if args.backend == "onnx":
+            options["threads"] = threads
+
+    predictor = PytorchPredictor(args.model, args.threshold, args.backend, **options)
+    decoder = FrameDecoder()
+    detection_filter = DetectionFilter(args.threshold)
+
+    def process(payload):
+        img, scale = decoder.decode(payload, predictor.size)
+        results = predictor.infer(img)
+        detection_filter.apply(to_detections(results.pred[0], scale))
+        decoder.release(img)
+
+    process(frames[0])  # warm up
+    barrier.wait()
+
+    count = 0
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        process(frames[count % len(frames)])
+        count += 1
+    results.put(count)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-m", "--model", default="coco", help="Model under models/")
+    parser.add_argument(
+        "--backend", choices=("torch", "onnx"), default="torch", help="Backend"
+    )
+    parser.add_argument(
+        "--images", help="Directory of JPEG frames to use instead of random noise"
+    )
+    parser.add_argument(
+        "-r", "--threshold", type=float, default=0.85, help="Confidence threshold"
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Largest number of worker processes to measure",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=20, help="Seconds to measure per step"
+    )
+    parser.add_argument(
+        "--pin-cpus", action="store_true", help="Pin workers to their own CPUs"
+    )
+    parser.add_argument("--threads", type=int, help="Inference threads per worker")
+    args = parser.parse_args()
+
+    frames = make_frames(args.images)
+    context = multiprocessing.get_context("spawn")
+
+    counts = [1]
+    while counts[-1] * 2 <= args.max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != args.max_workers:
+        counts.append(args.max_workers)
+
+    print(f"{'workers':>7} {'frames/s':>9} {'speedup':>8} {'efficiency':>11}")
+    baseline = None
+    for count in counts:
+        cpus = partition_cpus(count) if args.pin_cpus else [None] * count
+        barrier = context.Barrier(count)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=worker, args=(args, cpus[i], frames, barrier, results)
+            )
+            for i in range(count)
+        ]
+        for process in processes:
+            process.start()
+        total = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+
+        throughput = total / args.duration
+        baseline = baseline or throughput
+        speedup = throughput / baseline
+        print(
+            f"{count:>7} {throughput:>9.1f} {speedup:>7.2f}x {speedup / count:>10.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 30  # seconds
+
+
+class ResolutionController:
+    """Step the inference size between levels to keep the p95 inference
+    latency under target_ms.
+
+    The p95 is taken over the last window measurements. The size goes down a
+    level when it exceeds the target and up a level when it drops below
+    headroom * target. After every change the window is cleared, so the next
+    decision is based only on frames inferred at the new size; together with
+    the gap between the two thresholds this keeps the size from flapping.
+    """
+
+    def __init__(self, levels, target_ms, window=50, headroom=0.7):
+        self.levels = sorted(levels)
+        self.target = target_ms / 1000
+        self.headroom = headroom
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        # start at full quality and back off if we cannot keep up
+        self.level = len(self.levels) - 1
+        self.changes = 0
+        self.frames = Counter()
+        self.lastreport = time.monotonic()
+        logger.info(
+            f"Adapting inference size between {self.levels} for a p95 latency"
+            f" of {target_ms} ms"
+        )
+
+    @property
+    def size(self):
+        return self.levels[self.level]
+
+    def record(self, size, latency):
+        """Record the latency in seconds of a frame inferred at size"""
+        with self.lock:
+            self.frames[size] += 1
+            if size == self.size:
+                # frames still in flight at the previous size do not count
+                self.latencies.append(latency)
+                if len(self.latencies) == self.latencies.maxlen:
+                    self._adjust(np.percentile(self.latencies, 95))
+
+            now = time.monotonic()
+            if now - self.lastreport > REPORT_INTERVAL:
+                logger.info(f"Adaptive resolution stats: {self._stats()}")
+                self.lastreport = now
+
+    def _adjust(self, p95):
+        if p95 > self.target and self.level > 0:
+            self.level -= 1
+        elif p95 < self.target * self.headroom and self.level < len(self.levels) - 1:
+            self.level += 1
+        else:
+            return
+        self.changes += 1
+        self.latencies.clear()
+        logger.info(
+            f"Inference size changed to {self.size} (p95 latency"
+            f" {p95 * 1000:.1f} ms, target {self.target * 1000:.1f} ms)"
+        )
+
+    def _stats(self):
+        p95 = (
+            float(np.percentile(self.latencies, 95)) * 1000 if self.latencies else None
+        )
+        return {
+            "size": self.size,
+            "p95_ms": p95,
+            "target_ms": self.target * 1000,
+            "changes": self.changes,
+            "frames_per_size": dict(self.frames),
+        }
+
+    def stats(self):
+        with self.lock:
+            return self._stats()
@@ -0,0 +1,166 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Draw boxes, labels and the watermark onto images that are stored.
+
+Everything is drawn in place on the decoded RGB array with OpenCV, there is
+no round trip through PIL. The watermark is converted once into an alpha
+mask and rendered labels are cached, so annotating a frame only costs a few
+rectangles, copies and one blend.
+"""
+
+import threading
+from collections import OrderedDict
+
+import cv2
+import importlib_resources
+import numpy as np
+from PIL import Image
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5
+FONT_THICKNESS = 1
+LABEL_PADDING = 3
+MAX_LABELS = 1024  # rendered labels kept in the cache
+
+# the yolov5 color palette, one color per class id
+PALETTE = [
+    tuple(int(h[i : i + 2], 16) for i in (0, 2, 4))
+    for h in (
+        "FF3838 FF9D97 FF701F FFB21D CFD231 48F90A 92CC17 3DDB86 1A9334 00D4BB"
+        " 2C99A8 00C2FF 344593 6473FF 0018EC 8438FF 520085 CB38FF FF95C8 FF37C7"
+    ).split()
+]
+RED = (255, 0, 0)
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+
+def class_color(cls):
+    return PALETTE[int(cls) % len(PALETTE)]
+
+
+class Watermark:
+    """The watermark image blended onto the top left corner of a frame, with
+    the alpha channel as the mask of a white overlay, like
+    ImageDraw.bitmap(watermark, fill=None) did."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = importlib_resources.files("openscout").joinpath("watermark.png")
+        with Image.open(path) as image:
+            rgba = np.asarray(image.convert("RGBA"))
+        alpha = rgba[..., 3:].astype(np.uint16)
+        self.inverse_alpha = 255 - alpha
+        # white ink, pre-multiplied and rounded for the integer blend
+        self.overlay = alpha * 255 + 127
+        self.height, self.width = alpha.shape[:2]
+
+    def apply(self, image):
+        h = min(self.height, image.shape[0])
+        w = min(self.width, image.shape[1])
+        roi = image[:h, :w]
+        blended = roi * self.inverse_alpha[:h, :w] + self.overlay[:h, :w]
+        roi[...] = blended // 255
+
+
+class Annotator:
+    """Draw detections onto RGB images in place"""
+
+    def __init__(self, watermark_path=None):
+        self.watermark = Watermark(watermark_path)
+        self.labels = OrderedDict()  # (text, background, foreground) -> array
+        self.lock = threading.Lock()
+
+    def label(self, text, background, foreground):
+        """Rendered label, cached as most labels repeat from frame to frame"""
+        key = (text, background, foreground)
+        with self.lock:
+            patch = self.labels.get(key)
+            if patch is not None:
+                self.labels.move_to_end(key)
+                return patch
+
+        (w, h), baseline = cv2.getTextSize(text, FONT, FONT_SCALE, FONT_THICKNESS)
+        patch = np.empty(
+            (h + baseline + 2 * LABEL_PADDING, w + 2 * LABEL_PADDING, 3), np.uint8
+        )
+        patch[...] = background
+        cv2.putText(
+            patch,
+            text,
+            (LABEL_PADDING, LABEL_PADDING + h),
+            FONT,
+            FONT_SCALE,
+            foreground,
+            FONT_THICKNESS,
+            cv2.LINE_AA,
+        )
+        with self.lock:
+            self.labels[key] = patch
+            if len(self.labels) > MAX_LABELS:
+                self.labels.popitem(last=False)
+        return patch
+
+    def paste(self, image, patch, x, y):
+        """Copy patch onto image with its top left corner at x, y, clipped to
+        the image"""
+        height, width = image.shape[:2]
+        x0, y0 = max(x, 0), max(y, 0)
+        x1 = min(x + patch.shape[1], width)
+        y1 = min(y + patch.shape[0], height)
+        if x1 <= x0 or y1 <= y0:
+            return
+        image[y0:y1, x0:x1] = patch[y0 - y : y1 - y, x0 - x : x1 - x]
+
+    def draw(self, image, boxes, labels, colors, thickness=2, text_color=WHITE):
+        """Draw xyxy boxes with their labels, the label goes above the box if
+        there is room and inside it otherwise."""
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4).round()
+        for (x1, y1, x2, y2), text, color in zip(boxes.astype(int), labels, colors):
+            cv2.rectangle(image, (x1, y1), (x2, y2), color, thickness)
+            patch = self.label(text, color, text_color)
+            y = y1 - patch.shape[0] if y1 >= patch.shape[0] else y1
+            self.paste(image, patch, x1, y)
+
+    def detections(self, image, detections, names, scale=(1.0, 1.0)):
+        """Draw object detections (DETECTION_DTYPE records), whose boxes are
+        in coordinates scaled by scale, and the watermark."""
+        sx, sy = scale
+        boxes = np.stack(
+            [
+                detections["xmin"] / sx,
+                detections["ymin"] / sy,
+                detections["xmax"] / sx,
+                detections["ymax"] / sy,
+            ],
+            axis=1,
+        )
+        labels = [
+            f"{names[int(cls)]} {confidence:.2f}"
+            for cls, confidence in zip(detections["class"], detections["confidence"])
+        ]
+        colors = [class_color(cls) for cls in detections["class"]]
+        self.draw(image, boxes, labels, colors)
+        self.watermark.apply(image)
+        return image
+
+    def faces(self, image, boxes, labels):
+        """Draw recognized faces in red with black labels, and the watermark"""
+        self.draw(image, boxes, labels, [RED] * len(labels), 4, BLACK)
+        self.watermark.apply(image)
+        return image
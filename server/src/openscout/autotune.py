@@ -0,0 +1,337 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Execution profiles of the object engine on CPU nodes.
+
+With --autotune the engine measures the detector on sample frames for
+different torch intra- and inter-op thread counts, OpenCV thread counts
+and, if asked to, inference sizes. It keeps the configuration
+with the highest throughput whose 90th percentile latency stays within
+--autotune-max-latency. The sweep changes one setting at a time, keeping
+the best value found for the others, and every configuration runs in a
+fresh process as thread pool sizes are fixed per process.
+
+The result is saved in profiles/<cpu model>-<cpus>cpu.json, keyed by backend
+and model, and applied at later starts on the same kind of node to the
+settings that are not given on the command line. Frames are measured one
+at a time, as the engine receives them from Gabriel, and settings a profile
+holds that are not tuned any more are ignored.
+"""
+
+import json
+import logging
+import os
+import platform
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+from .decode import FrameDecoder
+from .object_engine import PytorchPredictor, backend_options
+from .quantize import IMAGE_SUFFIXES
+
+logger = logging.getLogger(__name__)
+
+SETTINGS = ("threads", "interop_threads", "opencv_threads", "size")
+MIN_FRAMES = 5  # measured per configuration, however long they take
+MAX_PASSES = 2  # sweeps over all settings
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help=(
+            "Measure the detector with different thread counts on this node,"
+            " save the fastest configuration as its profile and exit."
+        ),
+    )
+    parser.add_argument(
+        "--autotune-frames",
+        help="Directory of sample frames to autotune on, synthetic frames if unset.",
+    )
+    parser.add_argument(
+        "--autotune-max-latency",
+        type=float,
+        default=500,
+        help="Highest 90th percentile latency in ms a configuration may have.",
+    )
+    parser.add_argument(
+        "--autotune-seconds",
+        type=float,
+        default=5,
+        help="Seconds each configuration is measured for.",
+    )
+    parser.add_argument(
+        "--autotune-sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        help=(
+            "Comma separated inference sizes to try. Smaller sizes are faster but"
+            " less accurate, so only the model size is used unless given."
+        ),
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default="profiles",
+        help="Directory of the execution profiles.",
+    )
+    parser.add_argument(
+        "--no-profile",
+        action="store_true",
+        help="Do not apply the execution profile of this node.",
+    )
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def cpu_count():
+    return len(os.sched_getaffinity(0))
+
+
+def profile_path(directory):
+    """Profile of this kind of node, by CPU model and number of CPUs"""
+    name = re.sub(r"[^a-z0-9]+", "-", cpu_model().lower()).strip("-")
+    return Path(directory) / f"{name}-{cpu_count()}cpu.json"
+
+
+def profile_key(args):
+    key = f"{args.backend}:{args.model}"
+    if args.quantize:
+        key += f":{args.quantize}"
+    return key
+
+
+def set_thread_counts(args):
+    """Size the thread pools of this process, before any inference runs"""
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.interop_threads:
+        torch.set_num_interop_threads(args.interop_threads)
+    if args.opencv_threads is not None:
+        cv2.setNumThreads(args.opencv_threads)
+
+
+def apply_profile(parser, args):
+    """Take the settings of the profile of this node that are left at their
+    defaults on the command line"""
+    path = profile_path(args.profile_dir)
+    if args.no_profile or not path.exists():
+        return
+    entry = json.loads(path.read_text()).get(profile_key(args))
+    if entry is None:
+        logger.info(f"No profile for {profile_key(args)} in {path}")
+        return
+
+    applied = {}
+    for name, value in entry["settings"].items():
+        if name not in SETTINGS:
+            # e.g. batch_size of older profiles
+            continue
+        if value is None or getattr(args, name) != parser.get_default(name):
+            continue
+        if name == "threads" and args.workers > 1:
+            # workers size their thread pools by their share of the CPUs
+            continue
+        setattr(args, name, value)
+        applied[name] = value
+    logger.info(f"Applied execution profile {path}: {applied}")
+
+
+def load_frames(directory):
+    """Payloads of the frames in directory, as a client would send them"""
+    frames = [
+        path.read_bytes()
+        for path in sorted(Path(directory).iterdir())
+        if path.suffix.lower() in IMAGE_SUFFIXES
+    ]
+    if not frames:
+        raise ValueError(f"No frames found in {directory}")
+    return frames
+
+
+def synthetic_frames(count=8, width=1280, height=720):
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(count):
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        _, jpeg = cv2.imencode(".jpg", cv2.GaussianBlur(image, (0, 0), 3))
+        frames.append(jpeg.tobytes())
+    return frames
+
+
+def measure(args, config, payloads, seconds):
+    """Throughput and latency of the detector with the settings of config,
+    decoding included. Runs in its own process."""
+    vars(args).update(config)
+    set_thread_counts(args)
+    predictor = PytorchPredictor(
+        args.model, args.threshold, args.backend, **backend_options(args)
+    )
+    size = args.size or predictor.size
+    decoder = FrameDecoder()
+    predictor.warmup([size], 2)
+
+    latencies = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds or len(latencies) < MIN_FRAMES:
+        payload = payloads[len(latencies) % len(payloads)]
+        frame_start = time.perf_counter()
+        image, _ = decoder.decode(payload, size)
+        predictor.infer(image, size)
+        decoder.release(image)
+        latencies.append(time.perf_counter() - frame_start)
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "throughput_fps": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)),
+        },
+    }
+
+
+def describe(config):
+    return ", ".join(f"{name} {config[name]}" for name in SETTINGS)
+
+
+class Autotuner:
+    """Coordinate descent over the settings, measuring each configuration
+    once in a fresh process"""
+
+    def __init__(self, args, payloads):
+        self.args = args
+        self.payloads = payloads
+        self.results = {}  # settings tuple -> (config, result)
+
+    def space(self):
+        cpus = cpu_count()
+        threads = sorted({n for n in (1, 2, 4, 8, 16, 32) if n < cpus} | {cpus})
+        return {
+            "threads": threads,
+            # inter-op threads only matter to torch
+            "interop_threads": (
+                [n for n in (1, 2, 4) if n <= cpus]
+                if self.args.backend == "torch"
+                else [None]
+            ),
+            "opencv_threads": sorted({1, min(2, cpus), cpus}),
+            "size": self.args.autotune_sizes or [self.args.size],
+        }
+
+    def evaluate(self, config):
+        key = tuple(config[name] for name in SETTINGS)
+        if key not in self.results:
+            with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+                result = executor.submit(
+                    measure,
+                    self.args,
+                    config,
+                    self.payloads,
+                    self.args.autotune_seconds,
+                ).result()
+            logger.info(
+                f"{describe(config)}: {result['throughput_fps']:.1f} fps,"
+                f" p90 {result['latency_ms']['p90']:.1f} ms"
+            )
+            self.results[key] = (dict(config), result)
+        return self.results[key][1]
+
+    def better(self, a, b):
+        """Whether result a beats result b: the highest throughput within
+        the latency bound, or the lowest latency if neither is within it"""
+        bound = self.args.autotune_max_latency
+        a_ok = a["latency_ms"]["p90"] <= bound
+        b_ok = b["latency_ms"]["p90"] <= bound
+        if a_ok != b_ok:
+            return a_ok
+        if a_ok:
+            return a["throughput_fps"] > b["throughput_fps"]
+        return a["latency_ms"]["p90"] < b["latency_ms"]["p90"]
+
+    def run(self):
+        space = self.space()
+        config = {name: values[-1] for name, values in space.items()}
+        best = self.evaluate(config)
+        for _ in range(MAX_PASSES):
+            changed = False
+            for name, values in space.items():
+                for value in values:
+                    candidate = dict(config, **{name: value})
+                    result = self.evaluate(candidate)
+                    if self.better(result, best):
+                        config, best, changed = candidate, result, True
+            if not changed:
+                break
+        return config, best
+
+
+def autotune(args):
+    if args.autotune_frames:
+        payloads = load_frames(args.autotune_frames)
+    else:
+        logger.warning("No --autotune-frames given, tuning on synthetic frames")
+        payloads = synthetic_frames()
+
+    path = profile_path(args.profile_dir)
+    logger.info(f"Autotuning {profile_key(args)} for {path.stem}...")
+    tuner = Autotuner(args, payloads)
+    config, best = tuner.run()
+    if best["latency_ms"]["p90"] > args.autotune_max_latency:
+        logger.warning(
+            f"No configuration is within {args.autotune_max_latency} ms, keeping"
+            " the one with the lowest latency"
+        )
+    logger.info(
+        f"Best configuration: {describe(config)}, {best['throughput_fps']:.1f} fps,"
+        f" p90 {best['latency_ms']['p90']:.1f} ms"
+    )
+
+    profiles = json.loads(path.read_text()) if path.exists() else {}
+    profiles[profile_key(args)] = {
+        "settings": config,
+        "throughput_fps": best["throughput_fps"],
+        "latency_ms": best["latency_ms"],
+        "max_latency_ms": args.autotune_max_latency,
+        "cpu": cpu_model(),
+        "cpus": cpu_count(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": [
+            dict(config, **result) for config, result in tuner.results.values()
+        ],
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(".tmp")
+    temporary.write_text(json.dumps(profiles, indent=2) + "\n")
+    os.replace(temporary, path)
+    logger.info(f"Saved execution profile to {path}")
@@ -0,0 +1,319 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import ast
+import logging
+import math
+
+import cv2
+import numpy as np
+import torch
+
+from .postprocess import MAX_DETECTIONS, DetectionFilter
+from .quantize import quantize_model
+
+logger = logging.getLogger(__name__)
+
+IOU_THRESHOLD = 0.45
+MAX_NMS = 30000  # maximum number of boxes going into NMS
+STRIDE = 32
+PAD_VALUE = 114
+
+
+def load_torch_hub_model(model_path):
+    return torch.hub.load("ultralytics/yolov5", "custom", path=model_path)
+
+
+class TorchHubBackend:
+    """YOLOv5 through torch.hub, pre- and post-processing done by AutoShape.
+
+    AutoShape drops excluded classes before NMS and caps the detections at
+    max_det, per class thresholds are left to the engine as AutoShape only
+    has one threshold.
+    """
+
+    def __init__(self, model_path, threshold, detection_filter=None):
+        detection_filter = detection_filter or DetectionFilter(threshold)
+        self.model = load_torch_hub_model(model_path)
+        self.model.conf = detection_filter.min_threshold
+        self.model.classes = detection_filter.kept_classes(len(self.model.names))
+        self.model.max_det = detection_filter.max_det
+
+    def infer(self, images, size):
+        return self.model(images, size=size).tolist()
+
+    def memory_footprint(self):
+        tensors = list(self.model.parameters())
+        tensors.extend(self.model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    @staticmethod
+    def exists(model_path):
+        return model_path.exists()
+
+
+def export_onnx(model_path, onnx_path, size=640):
+    """Export the YOLOv5 network in model_path to ONNX with dynamic batch
+    and image dimensions, storing the class names in the model metadata."""
+    import onnx
+
+    hub_model = load_torch_hub_model(model_path)
+    network = hub_model.model
+    if hasattr(network, "pt"):  # DetectMultiBackend wrapper
+        network = network.model
+    network = network.float().cpu().eval()
+    for module in network.modules():
+        if type(module).__name__ == "Detect":
+            module.inplace = False
+            module.dynamic = True
+            module.export = True  # only return the concatenated predictions
+
+    logger.info(f"Exporting {model_path} to {onnx_path}...")
+    torch.onnx.export(
+        network,
+        torch.zeros(1, 3, size, size),
+        str(onnx_path),
+        opset_version=12,
+        input_names=["images"],
+        output_names=["output0"],
+        dynamic_axes={
+            "images": {0: "batch", 2: "height", 3: "width"},
+            "output0": {0: "batch", 1: "anchors"},
+        },
+    )
+
+    names = hub_model.names
+    if isinstance(names, list):
+        names = dict(enumerate(names))
+    exported = onnx.load(str(onnx_path))
+    meta = exported.metadata_props.add()
+    meta.key = "names"
+    meta.value = str(dict(names))
+    onnx.save(exported, str(onnx_path))
+
+
+def letterbox(image, shape):
+    """Resize image to fit shape (height, width) keeping its aspect ratio and
+    pad the remainder. Returns the padded image, the gain and the (x, y)
+    padding."""
+    height, width = image.shape[:2]
+    gain = min(shape[0] / height, shape[1] / width)
+    new_height, new_width = round(height * gain), round(width * gain)
+    if (new_height, new_width) != (height, width):
+        image = cv2.resize(
+            image, (new_width, new_height), interpolation=cv2.INTER_LINEAR
+        )
+
+    top = (shape[0] - new_height) // 2
+    left = (shape[1] - new_width) // 2
+    padded = np.full((shape[0], shape[1], 3), PAD_VALUE, dtype=np.uint8)
+    padded[top : top + new_height, left : left + new_width] = image
+    return padded, gain, (left, top)
+
+
+def nms(boxes, scores, iou_threshold, max_det=MAX_DETECTIONS):
+    """Greedy non-maximum suppression, returns indices of the at most max_det
+    kept boxes"""
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0 and len(keep) < max_det:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]))
+        h = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]))
+        inter = w * h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def non_max_suppression(
+    prediction,
+    threshold,
+    iou_threshold=IOU_THRESHOLD,
+    class_thresholds=None,
+    max_det=MAX_DETECTIONS,
+):
+    """Turn raw (anchors, 5 + classes) YOLOv5 output for one image into an
+    (n, 6) array of xyxy, confidence, class detections.
+
+    class_thresholds optionally holds a threshold per class, infinite for
+    classes to drop, which replaces threshold once the class of a candidate
+    is known. threshold then has to be the lowest of them.
+    """
+    x = prediction[prediction[:, 4] > threshold]
+    if len(x) == 0:
+        return np.zeros((0, 6), dtype=np.float32)
+
+    class_scores = x[:, 5:] * x[:, 4:5]
+    classes = class_scores.argmax(1)
+    confidence = class_scores[np.arange(len(x)), classes]
+    if class_thresholds is None:
+        mask = confidence > threshold
+    else:
+        mask = confidence > class_thresholds[classes]
+    x, classes, confidence = x[mask], classes[mask], confidence[mask]
+    if len(x) > MAX_NMS:
+        top = confidence.argsort()[::-1][:MAX_NMS]
+        x, classes, confidence = x[top], classes[top], confidence[top]
+
+    boxes = np.empty((len(x), 4), dtype=np.float32)
+    boxes[:, :2] = x[:, :2] - x[:, 2:4] / 2
+    boxes[:, 2:] = x[:, :2] + x[:, 2:4] / 2
+
+    # offset boxes by class so that only boxes of the same class suppress
+    # each other
+    offsets = classes[:, None].astype(np.float32) * 4096
+    keep = nms(boxes + offsets, confidence, iou_threshold, max_det)
+    return np.concatenate(
+        [boxes[keep], confidence[keep, None], classes[keep, None]], axis=1
+    ).astype(np.float32)
+
+
+class Detections:
+    """Detections for a single image, providing the parts of the yolov5
+    Detections interface used by the object engine."""
+
+    def __init__(self, image, pred, names):
+        self.ims = [image]
+        self.pred = [pred]
+        self.names = names
+
+
+class OnnxBackend:
+    """YOLOv5 exported to ONNX, run by ONNX Runtime on the CPU.
+
+    The .onnx file is looked up next to the .pt file and exported from it if
+    it does not exist yet. With quantize set to "dynamic" or "static" an INT8
+    version of it is used instead, static quantization is calibrated on the
+    frames in calibration_dir.
+    """
+
+    def __init__(
+        self,
+        model_path,
+        threshold,
+        quantize=None,
+        calibration_dir=None,
+        threads=None,
+        detection_filter=None,
+    ):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                "The onnx backend requires onnxruntime, install the onnx extra"
+                " with 'poetry install -E onnx'"
+            ) from None
+
+        onnx_path = self.prepare(model_path, quantize, calibration_dir)
+        self.onnx_path = onnx_path
+        self.filter = detection_filter or DetectionFilter(threshold)
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            str(onnx_path), options, providers=["CPUExecutionProvider"]
+        )
+        meta = self.session.get_modelmeta().custom_metadata_map
+        names = ast.literal_eval(meta["names"])
+        self.names = {int(k): v for k, v in names.items()}
+        self.class_thresholds = self.filter.thresholds(len(self.names))
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        batch, _, height, width = model_input.shape
+        # models exported by yolov5's export.py default to static shapes
+        self.fixed_batch = batch if isinstance(batch, int) else None
+        self.fixed_shape = (
+            (height, width)
+            if isinstance(height, int) and isinstance(width, int)
+            else None
+        )
+
+    def input_shape(self, images, size):
+        """Padded input shape for the batch, following AutoShape"""
+        if self.fixed_shape is not None:
+            return self.fixed_shape
+        shape = np.array(
+            [[int(y * size / max(im.shape[:2])) for y in im.shape[:2]] for im in images]
+        ).max(0)
+        return tuple(int(math.ceil(y / STRIDE) * STRIDE) for y in shape)
+
+    def infer(self, images, size):
+        if self.fixed_batch is not None and len(images) != self.fixed_batch:
+            # run batches of the static size, padding the last one with its
+            # last image and dropping the results of the padding
+            results = []
+            for first in range(0, len(images), self.fixed_batch):
+                batch = list(images[first : first + self.fixed_batch])
+                padding = [batch[-1]] * (self.fixed_batch - len(batch))
+                results.extend(self.infer(batch + padding, size)[: len(batch)])
+            return results
+
+        shape = self.input_shape(images, size)
+        batch = np.empty((len(images), 3, shape[0], shape[1]), dtype=np.float32)
+        transforms = []
+        for i, image in enumerate(images):
+            padded, gain, pad = letterbox(image, shape)
+            batch[i] = padded.transpose(2, 0, 1)
+            transforms.append((gain, pad))
+        batch /= 255
+
+        output = self.session.run(None, {self.input_name: batch})[0]
+
+        results = []
+        for image, prediction, (gain, (left, top)) in zip(images, output, transforms):
+            pred = non_max_suppression(
+                prediction,
+                self.filter.min_threshold,
+                class_thresholds=self.class_thresholds,
+                max_det=self.filter.max_det,
+            )
+            pred[:, [0, 2]] = ((pred[:, [0, 2]] - left) / gain).clip(0, image.shape[1])
+            pred[:, [1, 3]] = ((pred[:, [1, 3]] - top) / gain).clip(0, image.shape[0])
+            results.append(Detections(image, pred, self.names))
+        return results
+
+    def memory_footprint(self):
+        # the weights dominate, so the file size is a reasonable estimate
+        return self.onnx_path.stat().st_size
+
+    @staticmethod
+    def prepare(model_path, quantize=None, calibration_dir=None):
+        """Export and quantize the model if needed, returns the .onnx path"""
+        onnx_path = model_path.with_suffix(".onnx")
+        if not onnx_path.exists():
+            export_onnx(model_path, onnx_path)
+        if quantize:
+            onnx_path = quantize_model(onnx_path, quantize, calibration_dir)
+        return onnx_path
+
+    @staticmethod
+    def exists(model_path):
+        return model_path.exists() or model_path.with_suffix(".onnx").exists()
+
+
+BACKENDS = {
+    "torch": TorchHubBackend,
+    "onnx": OnnxBackend,
+}
@@ -0,0 +1,178 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import logging
+import queue
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+REPORT_INTERVAL = 30  # seconds
+
+
+class BatchStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.frames = 0
+        self.batch_sizes = Counter()
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, waits):
+        with self.lock:
+            self.batches += 1
+            self.frames += len(waits)
+            self.batch_sizes[len(waits)] += 1
+            self.total_wait += sum(waits)
+            self.max_wait = max(self.max_wait, max(waits))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "batches": self.batches,
+                "frames": self.frames,
+                "mean_batch_size": self.frames / self.batches if self.batches else 0.0,
+                "batch_sizes": dict(self.batch_sizes),
+                "mean_wait_ms": (
+                    self.total_wait / self.frames * 1000 if self.frames else 0.0
+                ),
+                "max_wait_ms": self.max_wait * 1000,
+            }
+
+
+class BatchingPredictor:
+    """Collect frames from concurrent handle() calls and run them through the
+    wrapped predictor as a single batched forward pass.
+
+    A batch is dispatched when it reaches max_batch_size or when the oldest
+    frame in it has waited max_wait_ms, whichever comes first.
+
+    The object engine does not use it yet. gabriel-server 2.1.1 sends each
+    frame of a source to every idle engine connection of that source, so
+    extra connections receive copies of the same frame rather than frames of
+    other clients, and one connection has only one frame in flight.
+    """
+
+    def __init__(self, predictor, max_batch_size, max_wait_ms):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = BatchStats()
+        self.queue = queue.Queue()
+        self.closed = False
+        # orders frames against the sentinel queued by close()
+        self.lock = threading.Lock()
+        self.lastreport = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        logger.info(
+            f"Batching up to {max_batch_size} frames, waiting at most {max_wait_ms} ms"
+        )
+
+    @property
+    def size(self):
+        return self.predictor.size
+
+    def infer(self, image, size=None):
+        future = Future()
+        with self.lock:
+            queued = not self.closed
+            if queued:
+                self.queue.put((time.monotonic(), image, size, future))
+        if not queued:
+            # a model switch retired this batcher while the frame was in flight
+            return self.predictor.infer(image, size)
+        return future.result()
+
+    def memory_footprint(self):
+        return self.predictor.memory_footprint()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join()
+        self.predictor.close()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = first[0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self.queue.get(timeout=timeout)
+                else:
+                    # window expired, but take whatever is already queued
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # put the sentinel back so the run loop exits after this batch
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._dispatch(self._collect(item))
+
+        # frames are not queued after the sentinel, but should one be, its
+        # handler must not wait for a result forever
+        leftovers = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                leftovers.append(item)
+        for first in range(0, len(leftovers), self.max_batch_size):
+            self._dispatch(leftovers[first : first + self.max_batch_size])
+
+    def _dispatch(self, batch):
+        start = time.monotonic()
+        # frames queued around a change of the inference size cannot
+        # share a forward pass
+        groups = defaultdict(list)
+        for item in batch:
+            groups[item[2]].append(item)
+        for size, group in groups.items():
+            images = [image for _, image, _, _ in group]
+            try:
+                results = self.predictor.infer_batch(images, size)
+            except Exception as e:
+                logger.exception("Batched inference failed")
+                for _, _, _, future in group:
+                    future.set_exception(e)
+            else:
+                for (_, _, _, future), result in zip(group, results):
+                    future.set_result(result)
+        self.stats.record([start - arrival for arrival, _, _, _ in batch])
+
+        if start - self.lastreport > REPORT_INTERVAL:
+            logger.info(f"Batching stats: {self.stats.snapshot()}")
+            self.lastreport = start
@@ -0,0 +1,126 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAX_CLIENTS = 256
+REPORT_INTERVAL = 30  # seconds
+
+
+def dhash(payload, hash_size=8):
+    """Difference hash of a JPEG payload.
+
+    The JPEG is decoded at 1/8 scale in grayscale, which skips most of the
+    IDCT work, and shrunk to (hash_size + 1) x hash_size pixels. Each bit
+    records whether a pixel is brighter than its left neighbour.
+    """
+    data = np.frombuffer(payload, dtype=np.uint8)
+    gray = cv2.imdecode(data, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ResultCache:
+    """Remember recent results per client so that frames which look the
+    same as a recent one can skip inference.
+
+    Each scope (client and model) keeps at most max_entries hashes, entries
+    expire after ttl seconds, and the least recently used scopes are dropped
+    beyond MAX_CLIENTS.
+    """
+
+    def __init__(self, max_distance, ttl, max_entries):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.scopes = OrderedDict()  # scope -> OrderedDict(hash -> (time, value))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.miss_time = 0.0
+        self.lastreport = time.monotonic()
+        logger.info(
+            f"Caching results for frames within Hamming distance {max_distance},"
+            f" ttl {ttl}s"
+        )
+
+    def get(self, scope, key):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.lastreport > REPORT_INTERVAL:
+                logger.info(f"Result cache stats: {self.stats()}")
+                self.lastreport = now
+
+            entries = self.scopes.get(scope)
+            if entries is None:
+                self.misses += 1
+                return None
+            self.scopes.move_to_end(scope)
+
+            # entries are kept oldest first
+            while entries:
+                oldest, (timestamp, _) = next(iter(entries.items()))
+                if now - timestamp <= self.ttl:
+                    break
+                del entries[oldest]
+
+            for cached_key, (_, value) in entries.items():
+                if hamming(cached_key, key) <= self.max_distance:
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, scope, key, value, elapsed):
+        """Store value for key, elapsed is the time it took to compute"""
+        with self.lock:
+            self.miss_time += elapsed
+            entries = self.scopes.get(scope)
+            if entries is None:
+                entries = self.scopes[scope] = OrderedDict()
+                if len(self.scopes) > MAX_CLIENTS:
+                    self.scopes.popitem(last=False)
+            self.scopes.move_to_end(scope)
+
+            entries.pop(key, None)
+            entries[key] = (time.monotonic(), value)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            # estimated from the average time spent on frames that missed
+            "saved_s": self.hits * self.miss_time / self.misses if self.misses else 0.0,
+        }
@@ -0,0 +1,132 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import threading
+
+import cv2
+import numpy as np
+
+# libjpeg can scale by 1/2, 1/4 and 1/8 while decoding
+REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# start of frame markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(data):
+    """Return (height, width) from the frame header of a JPEG, or None if
+    data does not look like a JPEG."""
+    if data[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if 0xD0 <= marker <= 0xD7 or marker == 0x01:  # markers without a length
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return height, width
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+
+def choose_scale(height, width, target_size):
+    """Largest DCT scale that keeps the long side at least target_size"""
+    for scale in (8, 4, 2):
+        if max(height, width) // scale >= target_size:
+            return scale
+    return 1
+
+
+def decode_rgb(payload):
+    """Decode an image payload at full resolution into an RGB array"""
+    bgr = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError("Unable to decode image payload")
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+class BufferPool:
+    """Reuse frame sized arrays instead of allocating one for every frame.
+
+    Buffers are handed out by acquire() and must be given back with release()
+    once nothing references them anymore.
+    """
+
+    def __init__(self, max_buffers):
+        self.max_buffers = max_buffers
+        self.free = {}  # shape -> list of arrays
+        self.lock = threading.Lock()
+
+    def acquire(self, shape):
+        with self.lock:
+            buffers = self.free.get(shape)
+            if buffers:
+                return buffers.pop()
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, buffer):
+        with self.lock:
+            buffers = self.free.setdefault(buffer.shape, [])
+            if len(buffers) < self.max_buffers:
+                buffers.append(buffer)
+
+
+class FrameDecoder:
+    def __init__(self, max_buffers=8):
+        self.pool = BufferPool(max_buffers)
+
+    def decode(self, payload, target_size):
+        """Decode a JPEG payload into an RGB array no larger than needed for
+        a model with the given input size.
+
+        Returns the image and the (x, y) factors that map coordinates in the
+        decoded image back to the original resolution.
+        """
+        data = np.frombuffer(payload, dtype=np.uint8)
+        size = jpeg_size(payload)
+        scale = 1 if size is None else choose_scale(*size, target_size)
+
+        bgr = cv2.imdecode(data, REDUCED_COLOR[scale])
+        if bgr is None:
+            raise ValueError("Unable to decode image payload")
+        img = self.pool.acquire(bgr.shape)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=img)
+
+        if scale == 1:
+            return img, (1.0, 1.0)
+        height, width = size
+        if (height > width) != (img.shape[0] > img.shape[1]):
+            # EXIF orientation rotated the image while decoding
+            height, width = width, height
+        return img, (width / img.shape[1], height / img.shape[0])
+
+    def release(self, img):
+        self.pool.release(img)
@@ -24,6 +24,7 @@ import subprocess
 
 from gabriel_server.network_engine import engine_runner
 
+from . import metrics, retention, sink, tracing
 from .msface_engine import MSFaceEngine
 from .openface_engine import OpenFaceEngine
 from .timing_engine import TimingMSFaceEngine, TimingOpenFaceEngine
@@ -34,13 +35,13 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def main():
+def create_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
     parser.add_argument(
-        "--timing", action="store_true", help="Print timing information"
+        "--timing", action="store_true", help="Print per-stage timing every 5 seconds"
     )
 
     parser.add_argument(
@@ -72,6 +73,31 @@ def main():
         help="Endpoint for either OpenFace service or MS Face service",
     )
 
+    # arguments specific to the OpenFace service
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=2,
+        help="(OpenFace) Seconds to wait for a connection to the service.",
+    )
+
+    parser.add_argument(
+        "--request-timeout",
+        type=float,
+        default=10,
+        help="(OpenFace) Seconds to wait for the service to answer a request.",
+    )
+
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        help=(
+            "(OpenFace) Retries of requests that could not connect or got a"
+            " gateway error. Requests that timed out are not retried."
+        ),
+    )
+
     # arguments specific to MS Face Container
     parser.add_argument(
         "--msface",
@@ -85,6 +111,15 @@ def main():
         help="(MS Face Service) API key for cognitive service. Required for metering.",
     )
 
+    sink.add_arguments(parser)
+    metrics.add_arguments(parser)
+    tracing.add_arguments(parser)
+    retention.add_arguments(parser)
+    return parser
+
+
+def main():
+    parser = create_parser()
     args, _ = parser.parse_known_args()
 
     def face_engine_setup():
@@ -103,6 +138,10 @@ def main():
 
     logger.info("Starting filebeat...")
     subprocess.call(["service", "filebeat", "start"])
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    sink.exit_on_sigterm()
+
     logger.info("Starting face recognition cognitive engine..")
     engine_runner.run(
         engine=face_engine_setup(),
@@ -0,0 +1,303 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Engine instrumentation exported in the Prometheus text format.
+
+Latencies go into histograms with fixed, logarithmically spaced buckets, so
+memory use does not grow with the number of frames and recording a value is
+a bisect and two additions under a lock.
+"""
+
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# 0.25 ms up to ~46 s, two buckets per doubling
+LATENCY_BUCKETS = tuple(0.00025 * 2 ** (i / 2) for i in range(36))
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve Prometheus metrics over HTTP on this port.",
+    )
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A metric family, children are created for each set of label values"""
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            lines.extend(child.expose(self.name, self.labelnames, values))
+        return lines
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def expose(self, name, labelnames, values):
+        return [f"{name}{format_labels(labelnames, values)} {self.value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+    new_child = CounterValue
+
+
+class GaugeValue:
+    def __init__(self):
+        self.function = None
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from function when the metrics are scraped"""
+        self.function = function
+
+    def expose(self, name, labelnames, values):
+        value = self.function() if self.function else self.value
+        if value is None:
+            return []
+        return [f"{name}{format_labels(labelnames, values)} {value}"]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    new_child = GaugeValue
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def totals(self):
+        """Number and sum of the observed values"""
+        with self.lock:
+            return sum(self.counts), self.sum
+
+    def snapshot(self):
+        """Copy of the per-bucket counts and the sum of the observed values"""
+        with self.lock:
+            return list(self.counts), self.sum
+
+    def expose(self, name, labelnames, values):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else f"{bound:.6g}"
+            labels = format_labels(labelnames, values, f'le="{le}"')
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = format_labels(labelnames, values)
+        lines.append(f"{name}_sum{labels} {total}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+
+class Timer:
+    """Context manager observing the time spent in its block"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """Return the registered metric with the same name, or metric"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def expose(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class EngineMetrics:
+    """Frame, detection and error counters and per-stage latency histograms
+    for the engine named engine."""
+
+    def __init__(self, engine, registry=REGISTRY):
+        self.engine = engine
+        self.registry = registry
+        self.frames = registry.register(
+            Counter("openscout_frames_total", "Frames handled", ("engine",))
+        ).labels(engine)
+        self.detections = registry.register(
+            Counter("openscout_detections_total", "Detections returned", ("engine",))
+        ).labels(engine)
+        self.errors = registry.register(
+            Counter(
+                "openscout_errors_total", "Frames that raised an error", ("engine",)
+            )
+        ).labels(engine)
+        self.latency = registry.register(
+            Histogram(
+                "openscout_stage_latency_seconds",
+                "Time spent per frame in each processing stage",
+                ("engine", "stage"),
+            )
+        )
+
+    def stage(self, name):
+        """Histogram for the latency of stage name"""
+        return self.latency.labels(self.engine, name)
+
+    def time(self, name):
+        return self.stage(name).time()
+
+    def stage_totals(self):
+        """Number and sum of the latencies recorded for each stage"""
+        return {
+            stage: histogram.totals()
+            for (engine, stage), histogram in list(self.latency.children.items())
+            if engine == self.engine
+        }
+
+    def gauge(self, name, help, function):
+        """Export the value returned by function as openscout_<name>"""
+        self.registry.register(Gauge(f"openscout_{name}", help, ("engine",))).labels(
+            self.engine
+        ).set_function(function)
+
+
+def instrumented(handle):
+    """Decorate an engine handle method to count frames and errors and record
+    the total time spent in it, the engine needs a metrics attribute."""
+
+    @functools.wraps(handle)
+    def wrapper(self, input_frame):
+        start = time.perf_counter()
+        try:
+            return handle(self, input_frame)
+        except Exception:
+            self.metrics.errors.inc()
+            raise
+        finally:
+            self.metrics.frames.inc()
+            self.metrics.stage("handle").observe(time.perf_counter() - start)
+
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are frequent, keep them out of the engine log
+        pass
+
+
+def serve(port, registry=REGISTRY):
+    """Serve the metrics in registry on port from a daemon thread"""
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer(("", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
@@ -18,12 +18,12 @@
 #
 #
 
+import atexit
 import logging
 import os
 import time
 from io import BytesIO
 
-import importlib_resources
 from azure.cognitiveservices.vision.face import FaceClient
 from azure.cognitiveservices.vision.face.models import (
     APIErrorException,
@@ -33,20 +33,19 @@ from gabriel_protocol import gabriel_pb2
 from gabriel_server import cognitive_engine
 from msrest.authentication import CognitiveServicesCredentials
 from msrest.exceptions import ValidationError
-from PIL import Image, ImageDraw
 
+from .annotate import Annotator
+from .decode import decode_rgb
+from .metrics import EngineMetrics, instrumented
 from .protocol import openscout_pb2
+from .retention import RetentionManager
+from .sink import DetectionSink
+from .storage import ImageStore, payload_digest, save_payload
+from .tracing import Tracer, traced
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-detection_log = logging.getLogger("msface-engine")
-fh = logging.FileHandler("/openscout-server/openscout-msface-engine.log")
-fh.setLevel(logging.INFO)
-formatter = logging.Formatter("%(message)s")
-fh.setFormatter(formatter)
-detection_log.addHandler(fh)
-
 
 class MSFaceEngine(cognitive_engine.Engine):
     ENGINE_NAME = "openscout-face"
@@ -58,6 +57,13 @@ class MSFaceEngine(cognitive_engine.Engine):
         self.endpoint = args.endpoint
         self.threshold = args.threshold
         self.store_detections = args.store
+        self.detection_log = DetectionSink.from_args(
+            "openscout-msface-engine.ndjson", args
+        )
+        atexit.register(self.detection_log.close)
+        self.metrics = EngineMetrics(self.ENGINE_NAME)
+        self.tracer = Tracer.from_args(self.ENGINE_NAME, args)
+        atexit.register(self.tracer.close)
         # Create an authenticated FaceClient.
         self.face_client = FaceClient(
             args.endpoint, CognitiveServicesCredentials(args.apikey)
@@ -74,16 +80,13 @@ class MSFaceEngine(cognitive_engine.Engine):
         logger.info(f"Cognitive server endpoint: {args.endpoint}")
         logger.info(f"Confidence Threshold: {self.threshold}")
         if self.store_detections:
-            watermark_path = importlib_resources.files("openscout").joinpath(
-                "watermark.png"
-            )
-            self.watermark = Image.open(watermark_path)
-            self.storage_path = os.getcwd() + "/images/"
-            try:
-                os.mkdir(self.storage_path)
-            except FileExistsError:
-                logger.info("Images directory already exists.")
-            logger.info(f"Storing detection images at {self.storage_path}")
+            self.annotator = Annotator()
+            self.images = ImageStore(os.getcwd() + "/images")
+            atexit.register(self.images.close)
+            self.retention = RetentionManager.from_args(self.images.root, args)
+            if self.retention is not None:
+                self.retention.start()
+            logger.info(f"Storing detection images at {self.images.root}")
 
     def train(self):
         training_dir = os.getcwd() + "/training/"
@@ -139,7 +142,8 @@ class MSFaceEngine(cognitive_engine.Engine):
     def detection(self, image):
         """Allow timing engine to override this"""
         # Detect a face in an image that contains a single face
-        detected_faces = self.face_client.face.detect_with_stream(image=image)
+        with self.tracer.span("http", call="detect"):
+            detected_faces = self.face_client.face.detect_with_stream(image=image)
         if not detected_faces:
             logger.debug("No face detected from image.")
 
@@ -147,7 +151,8 @@ class MSFaceEngine(cognitive_engine.Engine):
 
     def recognition(self, face_ids):
         """Allow timing engine to override this"""
-        return self.face_client.face.identify(face_ids, self.PERSON_GROUP_ID)
+        with self.tracer.span("http", call="identify"):
+            return self.face_client.face.identify(face_ids, self.PERSON_GROUP_ID)
 
     # Convert width height to a point in a rectangle
     def getRectangle(self, faceDictionary):
@@ -159,6 +164,8 @@ class MSFaceEngine(cognitive_engine.Engine):
 
         return ((left, top), (right, bottom))
 
+    @instrumented
+    @traced
     def handle(self, input_frame):
         if input_frame.payload_type == gabriel_pb2.PayloadType.TEXT:
             # if the payload is TEXT, say from a CNC client, we ignore
@@ -168,6 +175,7 @@ class MSFaceEngine(cognitive_engine.Engine):
             return result_wrapper
 
         extras = cognitive_engine.unpack_extras(openscout_pb2.Extras, input_frame)
+        self.tracer.tag(client_id=extras.client_id)
 
         image = self.preprocess_image(input_frame.payloads[0])
 
@@ -181,10 +189,10 @@ class MSFaceEngine(cognitive_engine.Engine):
                 os.mkdir(training_dir)
             except FileExistsError:
                 logger.info("Directory already exists.")
-            img = Image.open(image)
-            path = training_dir + str(time.time()) + ".png"
+            path = save_payload(
+                training_dir + str(time.time()), input_frame.payloads[0]
+            )
             logger.info(f"Stored training image: {path}")
-            img.save(path)
             self.new_faces = True
         else:
             # if we received new images for training and training has ended...
@@ -196,7 +204,8 @@ class MSFaceEngine(cognitive_engine.Engine):
                 result.payload = "Retraining complete.".encode(encoding="utf-8")
                 result_wrapper.results.append(result)
             else:
-                detections = self.detection(image)
+                with self.metrics.time("detection"):
+                    detections = self.detection(image)
 
                 face_ids = []
                 for face in detections:
@@ -210,17 +219,21 @@ class MSFaceEngine(cognitive_engine.Engine):
                     )
                     # Identify faces
                     try:
-                        identities = self.recognition(face_ids)
+                        with self.metrics.time("recognition"):
+                            identities = self.recognition(face_ids)
                     except ValidationError as v:
                         logger.error(v.message)
 
-                    for person in identities:
+                    frame_rgb = None
+                    for i, person in enumerate(identities):
                         logger.debug(person)
                         if len(person.candidates) > 0:
                             if person.candidates[0].confidence > self.threshold:
-                                match = self.face_client.person_group_person.get(
-                                    self.PERSON_GROUP_ID, person.candidates[0].person_id
-                                )
+                                with self.tracer.span("http", call="get_person"):
+                                    match = self.face_client.person_group_person.get(
+                                        self.PERSON_GROUP_ID,
+                                        person.candidates[0].person_id,
+                                    )
                                 logger.info(
                                     "Recognized: {} - Score: {:.3f}".format(
                                         match.name, person.candidates[0].confidence
@@ -232,60 +245,65 @@ class MSFaceEngine(cognitive_engine.Engine):
                                     match.name, person.candidates[0].confidence
                                 ).encode(encoding="utf-8")
                                 result_wrapper.results.append(result)
+                                self.metrics.detections.inc()
 
                                 if self.store_detections:
-                                    bb_img = Image.open(image)
-                                    draw = ImageDraw.Draw(bb_img)
-                                    for face in detections:
-                                        draw.rectangle(
-                                            self.getRectangle(face),
-                                            width=4,
-                                            outline="red",
-                                        )
-                                        text = "{} ({:.3f})".format(
-                                            match.name, person.candidates[0].confidence
-                                        )
-                                        w, h = draw.textsize(text)
-                                        xy = (
-                                            (self.getRectangle(face)[0]),
-                                            (
-                                                self.getRectangle(face)[0][0] + w,
-                                                self.getRectangle(face)[0][1] + h,
-                                            ),
-                                        )
-                                        draw.rectangle(
-                                            xy, width=4, outline="red", fill="red"
-                                        )
-                                        draw.text(
-                                            self.getRectangle(face)[0],
-                                            text,
-                                            fill="black",
-                                        )
-
-                                    draw.bitmap((0, 0), self.watermark, fill=None)
-                                    filename = str(time.time()) + ".png"
-                                    path = self.storage_path + filename
-                                    logger.info(f"Stored image: {path}")
-                                    bb_img.save(path)
-                                    detection_log.info(
-                                        "{},{},{},{},{:.3f},{}".format(
+                                    # decode once per frame, not per person
+                                    if frame_rgb is None:
+                                        frame_rgb = decode_rgb(input_frame.payloads[0])
+                                    bb_img = frame_rgb.copy()
+                                    text = "{} ({:.3f})".format(
+                                        match.name, person.candidates[0].confidence
+                                    )
+                                    self.annotator.faces(
+                                        bb_img,
+                                        [
+                                            (*top_left, *bottom_right)
+                                            for top_left, bottom_right in map(
+                                                self.getRectangle, detections
+                                            )
+                                        ],
+                                        [text] * len(detections),
+                                    )
+                                    with self.tracer.span("store"):
+                                        filename = self.images.save_image(
+                                            "faces",
+                                            payload_digest(input_frame.payloads[0]),
                                             extras.client_id,
-                                            extras.location.latitude,
-                                            extras.location.longitude,
-                                            match.name,
-                                            person.candidates[0].confidence,
-                                            os.environ["WEBSERVER"] + "/" + filename,
+                                            int(time.time() * 1000),
+                                            bb_img,
+                                            ".png",
+                                            label=i,
                                         )
+                                    logger.info(f"Stored image: {filename}")
+                                    self.detection_log.write(
+                                        {
+                                            "detection_time": int(time.time() * 1000),
+                                            "client_id": extras.client_id,
+                                            "latitude": extras.location.latitude,
+                                            "longitude": extras.location.longitude,
+                                            "entity": match.name,
+                                            "confidence": round(
+                                                person.candidates[0].confidence, 3
+                                            ),
+                                            "image": os.environ["WEBSERVER"]
+                                            + "/"
+                                            + filename,
+                                        }
                                     )
                                 else:
-                                    detection_log.info(
-                                        "{},{},{},{},{:.3f}".format(
-                                            extras.client_id,
-                                            extras.location.latitude,
-                                            extras.location.longitude,
-                                            match.name,
-                                            person.candidates[0].confidence,
-                                        )
+                                    self.detection_log.write(
+                                        {
+                                            "detection_time": int(time.time() * 1000),
+                                            "client_id": extras.client_id,
+                                            "latitude": extras.location.latitude,
+                                            "longitude": extras.location.longitude,
+                                            "entity": match.name,
+                                            "confidence": round(
+                                                person.candidates[0].confidence, 3
+                                            ),
+                                            "image": None,
+                                        }
                                     )
                             else:
                                 logger.debug("Confidence did not exceed threshold.")
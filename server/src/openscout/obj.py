@@ -24,8 +24,14 @@ import subprocess
 
 from gabriel_server.network_engine import engine_runner
 
-from .object_engine import OpenScoutObjectEngine
+from . import autotune, metrics, retention, sink, tracing
+from .backends import BACKENDS, OnnxBackend
+from .object_engine import OpenScoutObjectEngine, model_path
+from .postprocess import MAX_DETECTIONS, parse_class_thresholds
+from .quantize import QUANTIZATION_MODES
+from .storage import OVERFLOW_POLICIES
 from .timing_engine import TimingObjectEngine
+from .workers import WorkerPool
 
 SOURCE = "openscout"
 
@@ -33,13 +39,13 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def main():
+def create_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
 
     parser.add_argument(
-        "--timing", action="store_true", help="Print timing information"
+        "--timing", action="store_true", help="Print per-stage timing every 5 seconds"
     )
 
     parser.add_argument("-p", "--port", type=int, default=9099, help="Set port number")
@@ -85,27 +91,320 @@ def main():
             " Consult model/<model_name>/label_map.pbtxt."
         ),
     )
+    parser.add_argument(
+        "--class-thresholds",
+        type=parse_class_thresholds,
+        help=(
+            "Comma separated list of CLASS_ID=THRESHOLD pairs overriding the"
+            " confidence threshold for those classes, e.g. 0=0.6,2=0.4."
+        ),
+    )
+    parser.add_argument(
+        "--max-det",
+        type=int,
+        default=MAX_DETECTIONS,
+        help="Maximum number of detections kept per frame.",
+    )
+
+    parser.add_argument(
+        "--backend",
+        choices=list(BACKENDS),
+        default="torch",
+        help=(
+            "Inference backend. 'onnx' runs the model with ONNX Runtime on the CPU,"
+            " using models/<model>.onnx or exporting it from models/<model>.pt."
+        ),
+    )
+
+    parser.add_argument(
+        "--quantize",
+        choices=QUANTIZATION_MODES,
+        help=(
+            "(onnx backend) Run an INT8 quantized version of the model, cached as"
+            " models/<model>.int8-<mode>.onnx."
+        ),
+    )
+
+    parser.add_argument(
+        "--calibration-dir",
+        help="Directory of sample frames used to calibrate static quantization.",
+    )
+
+    parser.add_argument(
+        "--max-models",
+        type=int,
+        default=2,
+        help="Maximum number of models kept loaded for clients requesting them.",
+    )
+
+    parser.add_argument(
+        "--max-model-memory",
+        type=int,
+        default=0,
+        help=(
+            "Maximum estimated memory (MB) used by loaded models before the least"
+            " recently used one is evicted. 0 means no limit."
+        ),
+    )
+
+    parser.add_argument(
+        "--store-workers",
+        type=int,
+        default=2,
+        help="Number of background threads writing stored images.",
+    )
+
+    parser.add_argument(
+        "--store-queue",
+        type=int,
+        default=64,
+        help="Maximum number of frames waiting to be written to disk.",
+    )
+
+    parser.add_argument(
+        "--store-overflow",
+        choices=OVERFLOW_POLICIES,
+        default="block",
+        help="What to do with a frame to store when the write queue is full.",
+    )
+
+    parser.add_argument(
+        "--cache-distance",
+        type=int,
+        default=None,
+        help=(
+            "Reuse the detections of a recent frame from the same client when the"
+            " perceptual hashes differ in at most this many bits (0-64)."
+            " Caching is disabled unless this is set."
+        ),
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=5,
+        help="Seconds a cached result may be reused.",
+    )
+
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=8,
+        help="Number of recent frames remembered per client.",
+    )
+
+    parser.add_argument(
+        "--decode-buffers",
+        type=int,
+        default=8,
+        help="Number of decoded frame buffers of each size kept for reuse.",
+    )
+
+    parser.add_argument(
+        "--target-latency",
+        type=float,
+        default=None,
+        help=(
+            "Target p95 inference latency in ms. When set, the inference size is"
+            " lowered through --size-levels while the target is missed and raised"
+            " again once there is headroom."
+        ),
+    )
 
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help=(
+            "Inference size, the long side of the frames fed to the network."
+            " Defaults to 640."
+        ),
+    )
+
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=3,
+        help=(
+            "Inferences on synthetic frames run at every inference size when a"
+            " model loads, before the engine takes frames. 0 disables warm-up."
+        ),
+    )
+
+    parser.add_argument(
+        "--size-levels",
+        type=lambda levels: [int(level) for level in levels.split(",")],
+        default="320,416,512,640",
+        help="Comma separated inference sizes to choose from with --target-latency.",
+    )
+
+    parser.add_argument(
+        "--latency-window",
+        type=int,
+        default=50,
+        help="Number of recent frames the p95 inference latency is computed over.",
+    )
+
+    parser.add_argument(
+        "--track",
+        action="store_true",
+        help=(
+            "Track objects per client and log (and store) a detection only when"
+            " its track starts, changes class or is due to be reported again."
+        ),
+    )
+
+    parser.add_argument(
+        "--track-iou",
+        type=float,
+        default=0.3,
+        help="Minimum IoU for a detection to continue a track.",
+    )
+
+    parser.add_argument(
+        "--track-max-age",
+        type=float,
+        default=2,
+        help="Seconds a track survives without matching detections.",
+    )
+
+    parser.add_argument(
+        "--track-report-interval",
+        type=float,
+        default=60,
+        help="Seconds after which a live track is logged again, 0 to never repeat.",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of engine processes to run. Each one connects to the Gabriel"
+            " server under the same source and is restarted if it crashes. Note"
+            " that gabriel-server 2.1.1 sends every frame to each idle engine of a"
+            " source, so workers handle and answer the same frames."
+        ),
+    )
+
+    parser.add_argument(
+        "--pin-cpus",
+        action="store_true",
+        help="Pin each worker process to its own share of the available CPUs.",
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help=(
+            "Number of threads each engine process uses for inference. Defaults"
+            " to the number of CPUs a pinned worker has, or the torch and ONNX"
+            " Runtime defaults otherwise."
+        ),
+    )
+
+    parser.add_argument(
+        "--interop-threads",
+        type=int,
+        default=None,
+        help="Number of threads torch runs independent operations on.",
+    )
+
+    parser.add_argument(
+        "--opencv-threads",
+        type=int,
+        default=None,
+        help="Number of threads OpenCV decodes and resizes frames with.",
+    )
+
+    autotune.add_arguments(parser)
+    sink.add_arguments(parser)
+    metrics.add_arguments(parser)
+    tracing.add_arguments(parser)
+    retention.add_arguments(parser)
+    parser.set_defaults(worker=None)
+    return parser
+
+
+def main():
+    parser = create_parser()
     args, _ = parser.parse_known_args()
 
-    def object_engine_setup():
-        if args.timing:
-            engine = TimingObjectEngine(args)
-        else:
-            engine = OpenScoutObjectEngine(args)
+    if args.quantize and args.backend != "onnx":
+        parser.error("--quantize requires --backend onnx")
+    if args.quantize == "static" and args.calibration_dir is None:
+        parser.error("--quantize static requires --calibration-dir")
+    if any(level % 32 for level in args.size_levels):
+        parser.error("--size-levels must be multiples of 32")
+    if args.size is not None and args.size % 32:
+        parser.error("--size must be a multiple of 32")
+    if args.autotune_sizes and any(size % 32 for size in args.autotune_sizes):
+        parser.error("--autotune-sizes must be multiples of 32")
 
-        return engine
+    if args.autotune:
+        autotune.autotune(args)
+        return
+    autotune.apply_profile(parser, args)
+    # the profile may be hand edited or older than these checks
+    if args.size is not None and args.size % 32:
+        parser.error(
+            f"size {args.size} of the execution profile must be a multiple of 32,"
+            " fix or delete the profile, or pass --no-profile"
+        )
 
     logger.info("Starting filebeat...")
     subprocess.call(["service", "filebeat", "start"])
+
+    if args.workers > 1:
+        logger.warning(
+            "Every worker receives each frame from gabriel-server 2.1.1, frames"
+            " are handled, logged and answered up to --workers times"
+        )
+        if args.backend == "onnx":
+            # export and quantize once, instead of racing in every worker
+            OnnxBackend.prepare(
+                model_path(args.model), args.quantize, args.calibration_dir
+            )
+        pool = WorkerPool(run_worker, args.workers, (args,), args.pin_cpus)
+        pool.run()
+    else:
+        serve(args)
+
+
+def serve(args):
+    autotune.set_thread_counts(args)
+
+    if args.metrics_port:
+        # workers serve on consecutive ports
+        metrics.serve(args.metrics_port + (args.worker or 0))
+
+    sink.exit_on_sigterm()
+
     logger.info("Starting object detection cognitive engine..")
+    if args.timing:
+        engine = TimingObjectEngine(args)
+    else:
+        engine = OpenScoutObjectEngine(args)
+
+    # only register with the Gabriel server once the model is warmed up
+    logger.info(f"Engine ready, connecting to {args.gabriel}")
     engine_runner.run(
-        engine=object_engine_setup(),
+        engine=engine,
         source_name=args.source,
         server_address=args.gabriel,
         all_responses_required=True,
     )
 
 
+def run_worker(index, cpus, args):
+    """Entry point of the engine processes started with --workers"""
+    args.worker = index
+    if cpus and not args.threads:
+        # one inference thread per CPU the worker is pinned to
+        args.threads = len(cpus)
+    serve(args)
+
+
 if __name__ == "__main__":
     main()
@@ -18,84 +18,249 @@
 #
 #
 
+import atexit
 import logging
 import os
 import time
+from collections import OrderedDict
+from pathlib import Path
 
-import cv2
-import importlib_resources
 import numpy as np
 import torch
 from gabriel_protocol import gabriel_pb2
 from gabriel_server import cognitive_engine
-from pathlib import Path
-from PIL import Image, ImageDraw
+
+from .adaptive import ResolutionController
+from .annotate import Annotator
+from .backends import BACKENDS
+from .cache import ResultCache, dhash
+from .decode import FrameDecoder
+from .metrics import EngineMetrics, instrumented
+from .postprocess import DetectionFilter, to_detections
 from .protocol import openscout_pb2
+from .registry import ModelLoadError, ModelRegistry
+from .retention import RetentionManager
+from .sink import DetectionSink
+from .storage import AsyncImageWriter, ImageStore, payload_digest
+from .tracing import Tracer, traced
+from .tracker import ObjectTracker
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-detection_log = logging.getLogger("object-engine")
-fh = logging.FileHandler("/openscout-server/openscout-object-engine.log")
-fh.setLevel(logging.INFO)
-formatter = logging.Formatter("%(message)s")
-fh.setFormatter(formatter)
-detection_log.addHandler(fh)
+MAX_CLIENTS = 256  # clients whose last model is remembered
+
+
+def model_path(model):
+    return Path.cwd() / "models" / (model + ".pt")
+
+
+def backend_options(args):
+    """Options of the detector backend selected on the command line"""
+    options = {}
+    if args.quantize:
+        options["quantize"] = args.quantize
+        options["calibration_dir"] = args.calibration_dir
+    if args.backend == "onnx" and args.threads:
+        # torch threads are set process wide, ONNX Runtime has its own pool
+        options["threads"] = args.threads
+    return options
 
 
 class PytorchPredictor:
-    def __init__(self, model, threshold):
-        path_prefix = Path.cwd() / "models"
-        model_path = path_prefix / (model + ".pt")
-        logger.info(f"Loading new model {model} at {model_path}...")
-        self.detection_model = self.load_model(model_path)
-        self.detection_model.conf = threshold
-        self.output_dict = None
+    # long side of the images fed to the network
+    size = 640
+
+    def __init__(self, model, threshold, backend="torch", **options):
+        path = model_path(model)
+        logger.info(f"Loading new model {model} at {path} ({backend} backend)...")
+        self.backend = BACKENDS[backend](path, threshold, **options)
 
-    def load_model(self, model_path):
-        # Load model
-        model = torch.hub.load("ultralytics/yolov5", "custom", path=model_path)
-        return model
+    def infer(self, image, size=None):
+        return self.backend.infer([image], size or self.size)[0]
 
-    def infer(self, image):
-        return self.model(image)
+    def infer_batch(self, images, size=None):
+        return self.backend.infer(images, size or self.size)
+
+    def warmup(self, sizes, runs):
+        """Run runs inferences on synthetic frames at each of sizes, so that
+        lazy allocations, autotuning and other first call overheads do not
+        land on the first frames of clients"""
+        rng = np.random.default_rng(0)
+        for size in sizes:
+            # a landscape 16:9 frame, the decoder scales frames down to about
+            # the inference size
+            frame = rng.integers(0, 256, (size * 9 // 16, size, 3), dtype=np.uint8)
+            latencies = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                self.infer(frame, size)
+                latencies.append(time.perf_counter() - start)
+            logger.info(
+                f"Warmed up size {size} with {runs} frames: first"
+                f" {latencies[0] * 1000:.1f} ms, last {latencies[-1] * 1000:.1f} ms"
+            )
+
+    def memory_footprint(self):
+        """Estimated size in bytes of the model weights and buffers"""
+        return self.backend.memory_footprint()
+
+    def close(self):
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
 
 class OpenScoutObjectEngine(cognitive_engine.Engine):
     ENGINE_NAME = "openscout-object"
 
     def __init__(self, args):
-        self.detector = PytorchPredictor(args.model, args.threshold)
+        start = time.monotonic()
         self.threshold = args.threshold
+        self.warmup = args.warmup
+        self.size = args.size
         self.store_detections = args.store
+        self.backend = args.backend
+        # excluded classes and class thresholds are applied before NMS
+        self.filter = DetectionFilter.from_args(args)
+        self.backend_options = backend_options(args)
+        self.backend_options["detection_filter"] = self.filter
         self.model = args.model
 
-        if args.exclude:
-            self.exclusions = list(
-                map(int, args.exclude.split(","))
-            )  # split string to int list
-            logger.info(f"Excluding the following class ids: {self.exclusions}")
+        log_name = "openscout-object-engine"
+        if args.worker is not None:
+            # rotation is not safe with several processes sharing a file
+            log_name += f"-{args.worker}"
+        self.detection_log = DetectionSink.from_args(log_name + ".ndjson", args)
+        atexit.register(self.detection_log.close)
+        self.registry = ModelRegistry(
+            self.load_predictor, args.max_models, args.max_model_memory
+        )
+        self.client_models = OrderedDict()  # client id -> model last answered with
+        self.decoder = FrameDecoder(args.decode_buffers)
+
+        if args.target_latency is not None:
+            self.resolution = ResolutionController(
+                args.size_levels, args.target_latency, args.latency_window
+            )
+        else:
+            self.resolution = None
+
+        if args.cache_distance is not None:
+            self.cache = ResultCache(
+                args.cache_distance, args.cache_ttl, args.cache_size
+            )
+        else:
+            self.cache = None
+
+        if args.track:
+            self.tracker = ObjectTracker(
+                args.track_iou, args.track_max_age, args.track_report_interval
+            )
         else:
-            self.exclusions = None
+            self.tracker = None
 
         logger.info(
             f"Predictor initialized with the following model path: {args.model}"
         )
-        logger.info(f"Confidence Threshold: {self.threshold}")
+        logger.info(f"Keeping detections with {self.filter}")
 
         if self.store_detections:
-            watermark_path = importlib_resources.files("openscout").joinpath(
-                "watermark.png"
+            self.annotator = Annotator()
+            self.images = ImageStore(Path.cwd() / "images")
+            logger.info(f"Storing detection images at {self.images.root}")
+            self.writer = AsyncImageWriter(
+                args.store_workers, args.store_queue, args.store_overflow
             )
-            self.watermark = Image.open(watermark_path)
-            self.storage_path = Path.cwd() / "images"
-            try:
-                (self.storage_path / "received").mkdir(parents=True, exist_ok=True)
-                (self.storage_path / "detected").mkdir(parents=True, exist_ok=True)
-            except FileExistsError:
-                logger.info("Images directory already exists.")
-            logger.info(f"Storing detection images at {self.storage_path}")
+            atexit.register(self.writer.close)
+            atexit.register(self.images.close)
+            # one manager is enough for all the workers sharing the directory
+            self.retention = RetentionManager.from_args(self.images.root, args)
+            if self.retention is not None and args.worker in (None, 0):
+                self.retention.start()
 
+        self.metrics = EngineMetrics(self.ENGINE_NAME)
+        self.tracer = Tracer.from_args(self.ENGINE_NAME, args)
+        atexit.register(self.tracer.close)
+        # load and warm up the default model before the engine registers with
+        # the Gabriel server
+        self.registry.get(self.model)
+        self.startup_time = time.monotonic() - start
+        self.first_frame_time = None
+        logger.info(f"Engine ready in {self.startup_time:.2f}s")
+        self.export_state()
+
+    def export_state(self):
+        """Export the state of the engine components as metrics gauges"""
+        self.metrics.gauge(
+            "startup_seconds",
+            "Time to load and warm up the default model at engine start",
+            lambda: self.startup_time,
+        )
+        self.metrics.gauge(
+            "first_frame_seconds",
+            "Time the first frame after engine start took to handle",
+            lambda: self.first_frame_time or 0.0,
+        )
+        self.metrics.gauge(
+            "models_loaded", "Models in memory", lambda: len(self.registry.models)
+        )
+        self.metrics.gauge(
+            "models_loading",
+            "Models being loaded in the background",
+            lambda: len(self.registry.loading),
+        )
+        self.metrics.gauge(
+            "model_load_failures",
+            "Model loads that failed",
+            lambda: self.registry.failed_loads,
+        )
+        self.metrics.gauge(
+            "model_memory_bytes",
+            "Estimated memory used by loaded models",
+            self.registry.memory_used,
+        )
+        if self.resolution is not None:
+            self.metrics.gauge(
+                "inference_size",
+                "Current adaptive inference size",
+                lambda: self.resolution.size,
+            )
+            self.metrics.gauge(
+                "inference_size_changes",
+                "Adaptive inference size changes",
+                lambda: self.resolution.changes,
+            )
+        if self.cache is not None:
+            self.metrics.gauge(
+                "cache_hits",
+                "Frames answered from the result cache",
+                lambda: self.cache.hits,
+            )
+            self.metrics.gauge(
+                "cache_misses",
+                "Result cache lookups that missed",
+                lambda: self.cache.misses,
+            )
+        if self.tracker is not None:
+            self.metrics.gauge(
+                "reported_detections",
+                "Detections logged by the tracker",
+                lambda: self.tracker.reported,
+            )
+        if self.store_detections:
+            self.metrics.gauge(
+                "store_queue_depth",
+                "Frames waiting to be written to disk",
+                self.writer.queue.qsize,
+            )
+            self.metrics.gauge(
+                "store_dropped",
+                "Frames dropped because the write queue was full",
+                lambda: self.writer.dropped,
+            )
+
+    @instrumented
+    @traced
     def handle(self, input_frame):
         if input_frame.payload_type == gabriel_pb2.PayloadType.TEXT:
             # if the payload is TEXT, say from a CNC client, we ignore
@@ -108,105 +273,231 @@ class OpenScoutObjectEngine(cognitive_engine.Engine):
             result_wrapper.results.append(result)
             return result_wrapper
 
+        received = time.monotonic()
         extras = cognitive_engine.unpack_extras(openscout_pb2.Extras, input_frame)
 
+        model = self.model
         if extras.model != "" and extras.model != self.model:
-            if not os.path.exists("./models/" + extras.model):
+            if not BACKENDS[self.backend].exists(model_path(extras.model)):
                 logger.error(
                     f"Model named {extras.model} not found. "
-                    "Sticking with previous model."
+                    f"Using default model {self.model}."
                 )
             else:
-                self.detector = PytorchPredictor(extras.model, self.threshold)
-                self.model = extras.model
-        self.t0 = time.time()
-        results, image_np = self.process_image(input_frame.payloads[0])
-        timestamp_millis = int(time.time() * 1000)
+                model = extras.model
+        with self.tracer.span("load_model"):
+            try:
+                detector = self.registry.get(model, block=False)
+                if detector is None:
+                    # the model is loading in the background, keep answering
+                    # with the model the client was last answered with, or the
+                    # default one, so that its labels do not change meanwhile
+                    fallback = self.client_models.get(extras.client_id, self.model)
+                    detector = self.registry.loaded(fallback)
+                    if detector is not None:
+                        logger.debug(f"Model {model} is loading")
+                        model = fallback
+                    else:
+                        # evicted as well, reloading it would only queue up
+                        # behind the requested model, so wait for that one
+                        detector = self.registry.get(model)
+            except ModelLoadError as e:
+                logger.debug(e)
+                status = gabriel_pb2.ResultWrapper.Status.ENGINE_ERROR
+                result_wrapper = cognitive_engine.create_result_wrapper(status)
+                result_wrapper.result_producer_name.value = self.ENGINE_NAME
+                result = gabriel_pb2.ResultWrapper.Result()
+                result.payload_type = gabriel_pb2.PayloadType.TEXT
+                result.payload = str(e).encode(encoding="utf-8")
+                result_wrapper.results.append(result)
+                return result_wrapper
+        self.client_models[extras.client_id] = model
+        self.client_models.move_to_end(extras.client_id)
+        if len(self.client_models) > MAX_CLIENTS:
+            self.client_models.popitem(last=False)
+        self.tracer.tag(client_id=extras.client_id, model=model)
+        start = time.time()
+
+        cached = None
+        if self.cache is not None:
+            with self.tracer.span("cache_lookup"):
+                scope = (extras.client_id, model)
+                key = dhash(input_frame.payloads[0])
+                cached = self.cache.get(scope, key)
+
+        if cached is None:
+            results, image_np, scale = self.process_image(
+                input_frame.payloads[0], detector
+            )
+            # the backend results reference the decoded frame, a pooled
+            # buffer, so only the detections and class names are kept
+            pred, names = to_detections(results.pred[0], scale), results.names
+            timestamp_millis = int(time.time() * 1000)
+            elapsed = time.time() - start
+        else:
+            # near duplicate of a recent frame, reuse its detections and
+            # point the log at the image stored for that frame, if any
+            pred, names, filename, scale = cached
+            timestamp_millis = int(time.time() * 1000)
+
         status = gabriel_pb2.ResultWrapper.Status.SUCCESS
         result_wrapper = cognitive_engine.create_result_wrapper(status)
         result_wrapper.result_producer_name.value = self.ENGINE_NAME
 
-        if self.store_detections:
-            filename = str(timestamp_millis) + ".jpg"
-            img = Image.fromarray(image_np)
-            path = self.storage_path / "received" / filename
-            img.save(path, format="JPEG")
-
-        if len(results.pred) > 0:
-            df = results.pandas().xyxy[0]  # pandas dataframe
-            logger.debug(df)
-            # convert dataframe to python lists
-            classes = df["class"].values.tolist()
-            scores = df["confidence"].values.tolist()
-            names = df["name"].values.tolist()
+        with self.metrics.time("postprocess"), self.tracer.span("postprocess"):
+            # cached results and backends that cannot apply the whole filter
+            detections = self.filter.apply(pred)
+            if self.tracker is not None:
+                track_ids, report = self.tracker.update(
+                    (extras.client_id, model), detections
+                )
+            else:
+                track_ids, report = None, np.ones(len(detections), dtype=bool)
+        self.metrics.detections.inc(len(detections))
+        logger.debug(detections)
 
+        if cached is None:
+            # with tracking, only frames that report something are stored
+            if self.store_detections and (self.tracker is None or report.any()):
+                filename = self.queue_images(
+                    input_frame.payloads[0],
+                    extras.client_id,
+                    timestamp_millis,
+                    image_np,
+                    detections,
+                    names,
+                    scale,
+                )
+            else:
+                self.decoder.release(image_np)
+                filename = None
+            if self.cache is not None:
+                self.cache.put(scope, key, (pred, names, filename, scale), elapsed)
+
+        if filename is not None:
+            image_url = os.environ["WEBSERVER"] + "/" + filename
+        else:
+            image_url = None
+
+        if len(detections) > 0:
             result = gabriel_pb2.ResultWrapper.Result()
             result.payload_type = gabriel_pb2.PayloadType.TEXT
 
-            detections_above_threshold = False
             r = []
-            for i in range(0, len(classes)):
-                if scores[i] > self.threshold:
-                    if self.exclusions is None or classes[i] not in self.exclusions:
-                        detections_above_threshold = True
-                        logger.info(f"Detected : {names[i]} - Score: {scores[i]:.3f}")
-                        r.append(f"Detected {names[i]} ({scores[i]:.3f})")
-                        if self.store_detections:
-                            detection_log.info(
-                                "{},{},{},{},{},{:.3f},{}".format(
-                                    timestamp_millis,
-                                    extras.client_id,
-                                    extras.location.latitude,
-                                    extras.location.longitude,
-                                    names[i],
-                                    scores[i],
-                                    os.environ["WEBSERVER"] + "/detected/" + filename,
-                                )
-                            )
-                        else:
-                            detection_log.info(
-                                "{},{},{},{},{},{:.3f},".format(
-                                    timestamp_millis,
-                                    extras.client_id,
-                                    extras.location.latitude,
-                                    extras.location.longitude,
-                                    names[i],
-                                    scores[i],
-                                )
-                            )
-
-            if detections_above_threshold:
-                result.payload = ','.join(r).encode(encoding="utf-8")
-                result_wrapper.results.append(result)
+            for i, detection in enumerate(detections):
+                name = names[int(detection["class"])]
+                score = float(detection["confidence"])
+                logger.info(f"Detected : {name} - Score: {score:.3f}")
+                r.append(f"Detected {name} ({score:.3f})")
+                if not report[i]:
+                    # already logged for this track
+                    continue
+                self.detection_log.write(
+                    {
+                        "detection_time": timestamp_millis,
+                        "client_id": extras.client_id,
+                        "latitude": extras.location.latitude,
+                        "longitude": extras.location.longitude,
+                        "entity": name,
+                        "confidence": round(score, 3),
+                        "track_id": (
+                            int(track_ids[i]) if track_ids is not None else None
+                        ),
+                        "image": image_url,
+                    }
+                )
 
-                if self.store_detections:
-                    try:
-                        # results._run(
-                        #     save=True,
-                        #     labels=True,
-                        #     save_dir=Path("openscout-vol/")
-                        # )
-                        results.render()
-                        img = Image.fromarray(results.ims[0])
-                        draw = ImageDraw.Draw(img)
-                        draw.bitmap((0, 0), self.watermark, fill=None)
-                        path = self.storage_path / "detected" / filename
-                        img.save(path, format="JPEG")
-                        logger.info(f"Stored image: {path}")
-                    except IndexError:
-                        logger.exception("IndexError while getting bounding boxes")
-                        return result_wrapper
+            result.payload = ",".join(r).encode(encoding="utf-8")
+            result_wrapper.results.append(result)
 
+        if self.first_frame_time is None:
+            self.first_frame_time = time.monotonic() - received
+            logger.info(f"First frame handled in {self.first_frame_time * 1000:.1f} ms")
         return result_wrapper
 
-    def process_image(self, image):
-        np_data = np.fromstring(image, dtype=np.uint8)
-        img = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    def queue_images(
+        self, payload, client_id, timestamp_millis, image_np, detections, names, scale
+    ):
+        """Hand the frame off to the writer threads, annotating it only if
+        something was detected. Returns the path the annotated image will be
+        written to, or None if there is none or it was dropped."""
+        digest = payload_digest(payload)
+        if len(detections) == 0:
+            # the received frame is written as sent, the decoded image is
+            # only needed to draw detections on
+            self.decoder.release(image_np)
+            image_np = None
+        queued = self.writer.submit(
+            self.store_images,
+            digest,
+            client_id,
+            timestamp_millis,
+            payload,
+            image_np,
+            detections,
+            names,
+            scale,
+            self.tracer.current(),
+        )
+        if not queued or image_np is None:
+            return None
+        return self.images.location("detected", digest, client_id, timestamp_millis)
+
+    def store_images(
+        self,
+        digest,
+        client_id,
+        timestamp_millis,
+        payload,
+        image_np,
+        detections,
+        names,
+        scale,
+        frame=None,
+    ):
+        try:
+            with self.tracer.span("store", frame):
+                key = (digest, client_id, timestamp_millis)
+                self.images.save_payload("received", *key, payload)
+                if image_np is not None:
+                    self.annotator.detections(image_np, detections, names, scale)
+                    path = self.images.save_image("detected", *key, image_np)
+                    logger.info(f"Stored image: {path}")
+        finally:
+            if image_np is not None:
+                self.decoder.release(image_np)
+
+    def load_predictor(self, model):
+        predictor = PytorchPredictor(
+            model, self.threshold, self.backend, **self.backend_options
+        )
+        if self.warmup:
+            # every size the adaptive resolution may pick
+            if self.resolution is not None:
+                sizes = self.resolution.levels
+            else:
+                sizes = [self.size or predictor.size]
+            start = time.monotonic()
+            predictor.warmup(sizes, self.warmup)
+            logger.info(f"Warmed up model {model} in {time.monotonic() - start:.2f}s")
+        return predictor
+
+    def process_image(self, image, detector):
+        if self.resolution is not None:
+            size = self.resolution.size
+        else:
+            size = self.size or detector.size
 
-        output_dict = self.inference(img)
-        return output_dict, img
+        # decode at the smallest scale that still covers the model input,
+        # detections are scaled back to the original resolution afterwards
+        with self.metrics.time("decode"), self.tracer.span("decode"):
+            img, scale = self.decoder.decode(image, size)
 
-    def inference(self, img):
-        """Allow timing engine to override this"""
-        return self.detector.detection_model(img)
+        start = time.perf_counter()
+        with self.tracer.span("inference", size=size):
+            results = detector.infer(img, size)
+        elapsed = time.perf_counter() - start
+        self.metrics.stage("inference").observe(elapsed)
+        if self.resolution is not None:
+            self.resolution.record(size, elapsed)
+        return results, img, scale
@@ -18,29 +18,77 @@
 #
 #
 
+import atexit
 import json
 import logging
 import os
+import threading
 import time
-from io import BytesIO
 
-import importlib_resources
 import requests
 from gabriel_protocol import gabriel_pb2
 from gabriel_server import cognitive_engine
-from PIL import Image, ImageDraw
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .annotate import Annotator
+from .decode import decode_rgb
+from .metrics import EngineMetrics, instrumented
 from .protocol import openscout_pb2
+from .retention import RetentionManager
+from .sink import DetectionSink
+from .storage import ImageStore, payload_digest, save_payload
+from .tracing import Tracer, traced
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-detection_log = logging.getLogger("openface-engine")
-fh = logging.FileHandler("/openscout-server/openscout-openface-engine.log")
-fh.setLevel(logging.INFO)
-formatter = logging.Formatter("%(message)s")
-fh.setFormatter(formatter)
-detection_log.addHandler(fh)
+RETRY_STATUSES = (502, 503, 504)
+RETRY_BACKOFF = 0.2  # seconds, doubled on every retry
+
+
+class OpenFaceClient:
+    """Keep-alive HTTP client of the OpenFace service.
+
+    Every request has a connect and a read timeout. Connection failures and
+    gateway errors are retried up to retries times, a request that timed
+    out while the service was working on it is not.
+    """
+
+    def __init__(self, endpoint, connect_timeout=2, read_timeout=10, retries=2):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=retries,
+            read=0,
+            backoff_factor=RETRY_BACKOFF,
+            status_forcelist=RETRY_STATUSES,
+            # recognizing a frame has no side effects, so POSTs are retried too
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def train(self):
+        response = self.session.get(f"{self.endpoint}/train", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def infer(self, payload):
+        response = self.session.post(
+            f"{self.endpoint}/infer",
+            data=payload,
+            headers={"content-type": "image/jpeg"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.text
+
+    def close(self):
+        self.session.close()
 
 
 class OpenFaceEngine(cognitive_engine.Engine):
@@ -48,36 +96,55 @@ class OpenFaceEngine(cognitive_engine.Engine):
 
     def __init__(self, args):
         self.new_faces = False
+        self.training_lock = threading.Lock()
         self.endpoint = args.endpoint
+        self.client = OpenFaceClient(
+            args.endpoint,
+            args.connect_timeout,
+            args.request_timeout,
+            args.retries,
+        )
+        atexit.register(self.client.close)
         self.threshold = args.threshold
         self.store_detections = args.store
+        self.detection_log = DetectionSink.from_args(
+            "openscout-openface-engine.ndjson", args
+        )
+        atexit.register(self.detection_log.close)
+        self.metrics = EngineMetrics(self.ENGINE_NAME)
+        self.tracer = Tracer.from_args(self.ENGINE_NAME, args)
+        atexit.register(self.tracer.close)
 
         logger.info(f"OpenFace server: {args.endpoint}")
         logger.info(f"Confidence Threshold: {self.threshold}")
         if self.store_detections:
-            watermark_path = importlib_resources.files("openscout").joinpath(
-                "watermark.png"
-            )
-            self.watermark = Image.open(watermark_path)
-            self.storage_path = os.getcwd() + "/images/"
-            try:
-                os.mkdir(self.storage_path)
-            except FileExistsError:
-                logger.info("Images directory already exists.")
-            logger.info(f"Storing detection images at {self.storage_path}")
+            self.annotator = Annotator()
+            self.images = ImageStore(os.getcwd() + "/images")
+            atexit.register(self.images.close)
+            self.retention = RetentionManager.from_args(self.images.root, args)
+            if self.retention is not None:
+                self.retention.start()
+            logger.info(f"Storing detection images at {self.images.root}")
         self.train()
 
     def train(self):
-        response = requests.get("{}/{}".format(self.endpoint, "train")).json()
+        with self.tracer.span("http", endpoint="train"):
+            response = self.client.train()
         logger.info(response)
 
-    def infer(self, img):
-        headers = {"content-type": "image/jpeg"}
-        # send http request with image and receive response
-        response = requests.post(
-            "{}/{}".format(self.endpoint, "infer"), data=img, headers=headers
-        )
-        return response.text
+    def infer(self, payload):
+        with self.tracer.span("http", endpoint="infer"):
+            return self.client.infer(payload)
+
+    def error_result(self, message):
+        status = gabriel_pb2.ResultWrapper.Status.ENGINE_ERROR
+        result_wrapper = cognitive_engine.create_result_wrapper(status)
+        result_wrapper.result_producer_name.value = self.ENGINE_NAME
+        result = gabriel_pb2.ResultWrapper.Result()
+        result.payload_type = gabriel_pb2.PayloadType.TEXT
+        result.payload = message.encode(encoding="utf-8")
+        result_wrapper.results.append(result)
+        return result_wrapper
 
     def getRectangle(self, person):
         return (
@@ -85,6 +152,8 @@ class OpenFaceEngine(cognitive_engine.Engine):
             (person["bb-br-x"], person["bb-br-y"]),
         )
 
+    @instrumented
+    @traced
     def handle(self, input_frame):
         if input_frame.payload_type == gabriel_pb2.PayloadType.TEXT:
             # if the payload is TEXT, say from a CNC client, we ignore
@@ -98,8 +167,7 @@ class OpenFaceEngine(cognitive_engine.Engine):
             return result_wrapper
 
         extras = cognitive_engine.unpack_extras(openscout_pb2.Extras, input_frame)
-
-        image = self.preprocess_image(input_frame.payloads[0])
+        self.tracer.tag(client_id=extras.client_id)
 
         status = gabriel_pb2.ResultWrapper.Status.SUCCESS
         result_wrapper = cognitive_engine.create_result_wrapper(status)
@@ -111,23 +179,36 @@ class OpenFaceEngine(cognitive_engine.Engine):
                 os.mkdir(training_dir)
             except FileExistsError:
                 logger.info("Directory already exists.")
-            img = Image.open(image)
-            path = training_dir + str(time.time()) + ".png"
+            path = save_payload(
+                training_dir + str(time.time()), input_frame.payloads[0]
+            )
             logger.info(f"Stored training image: {path}")
-            img.save(path)
-            self.new_faces = True
+            with self.training_lock:
+                self.new_faces = True
         else:
             # if we received new images for training and training has ended...
-            if self.new_faces:
-                self.train()
-                self.new_faces = False
+            with self.training_lock:
+                retrain, self.new_faces = self.new_faces, False
+            if retrain:
+                try:
+                    self.train()
+                except requests.RequestException as e:
+                    logger.error(f"Retraining failed: {e}")
+                    with self.training_lock:
+                        self.new_faces = True
+                    return self.error_result(f"Retraining failed: {e}")
                 result = gabriel_pb2.ResultWrapper.Result()
                 result.payload_type = gabriel_pb2.PayloadType.TEXT
                 result.payload = "Retraining complete.".encode(encoding="utf-8")
                 result_wrapper.results.append(result)
             else:
                 faces_recognized = False
-                response = self.infer(image)
+                with self.metrics.time("inference"):
+                    try:
+                        response = self.infer(input_frame.payloads[0])
+                    except requests.RequestException as e:
+                        logger.error(f"OpenFace request failed: {e}")
+                        return self.error_result(f"Face recognition failed: {e}")
                 if response is not None:
                     identities = json.loads(response)
                     if len(identities) > 0:
@@ -152,64 +233,62 @@ class OpenFaceEngine(cognitive_engine.Engine):
                                     person["name"], person["confidence"]
                                 ).encode(encoding="utf-8")
                                 result_wrapper.results.append(result)
+                                self.metrics.detections.inc()
                             else:
                                 logger.debug("Confidence did not exceed threshold.")
                         if faces_recognized:
                             if self.store_detections:
-                                bb_img = Image.open(image)
-
-                                draw = ImageDraw.Draw(bb_img)
-                                for person in identities:
-                                    draw.rectangle(
-                                        self.getRectangle(person),
-                                        width=4,
-                                        outline="red",
-                                    )
-                                    text = "{} ({:.3f})".format(
-                                        person["name"], person["confidence"]
-                                    )
-                                    w, h = draw.textsize(text)
-                                    xy = (
-                                        (self.getRectangle(person)[0]),
-                                        (
-                                            self.getRectangle(person)[0][0] + w,
-                                            self.getRectangle(person)[0][1] + h,
-                                        ),
-                                    )
-                                    draw.rectangle(
-                                        xy, width=4, outline="red", fill="red"
-                                    )
-                                    draw.text(
-                                        self.getRectangle(person)[0], text, fill="black"
-                                    )
-
-                                draw.bitmap((0, 0), self.watermark, fill=None)
-                                filename = str(time.time()) + ".png"
-                                path = self.storage_path + filename
-                                logger.info(f"Stored image: {path}")
-                                bb_img.save(path)
-                                bio = BytesIO()
-                                bb_img.save(bio, format="JPEG")
-
-                                detection_log.info(
-                                    "{},{},{},{},{:.3f},{}".format(
+                                bb_img = decode_rgb(input_frame.payloads[0])
+                                self.annotator.faces(
+                                    bb_img,
+                                    [
+                                        (*top_left, *bottom_right)
+                                        for top_left, bottom_right in map(
+                                            self.getRectangle, identities
+                                        )
+                                    ],
+                                    [
+                                        "{} ({:.3f})".format(
+                                            person["name"], person["confidence"]
+                                        )
+                                        for person in identities
+                                    ],
+                                )
+                                with self.tracer.span("store"):
+                                    filename = self.images.save_image(
+                                        "faces",
+                                        payload_digest(input_frame.payloads[0]),
                                         extras.client_id,
-                                        extras.location.latitude,
-                                        extras.location.longitude,
-                                        person["name"],
-                                        person["confidence"],
-                                        os.environ["WEBSERVER"] + "/" + filename,
+                                        int(time.time() * 1000),
+                                        bb_img,
+                                        ".png",
                                     )
+                                logger.info(f"Stored image: {filename}")
+
+                                self.detection_log.write(
+                                    {
+                                        "detection_time": int(time.time() * 1000),
+                                        "client_id": extras.client_id,
+                                        "latitude": extras.location.latitude,
+                                        "longitude": extras.location.longitude,
+                                        "entity": person["name"],
+                                        "confidence": round(person["confidence"], 3),
+                                        "image": os.environ["WEBSERVER"]
+                                        + "/"
+                                        + filename,
+                                    }
                                 )
                             else:
-                                detection_log.info(
-                                    "{},{},{},{},{:.3f},".format(
-                                        extras.client_id,
-                                        extras.location.latitude,
-                                        extras.location.longitude,
-                                        person["name"],
-                                        person["confidence"],
-                                    )
+                                self.detection_log.write(
+                                    {
+                                        "detection_time": int(time.time() * 1000),
+                                        "client_id": extras.client_id,
+                                        "latitude": extras.location.latitude,
+                                        "longitude": extras.location.longitude,
+                                        "entity": person["name"],
+                                        "confidence": round(person["confidence"], 3),
+                                        "image": None,
+                                    }
                                 )
                         else:
                             logger.debug(
@@ -222,6 +301,3 @@ class OpenFaceEngine(cognitive_engine.Engine):
                         result.payload_type = gabriel_pb2.PayloadType.TEXT
                         result.payload = "No faces detected.".encode(encoding="utf-8")
         return result_wrapper
-
-    def preprocess_image(self, image):
-        return BytesIO(image)
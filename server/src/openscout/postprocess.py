@@ -0,0 +1,153 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import threading
+
+import numpy as np
+
+MAX_DETECTIONS = 1000  # detections kept per image by default
+
+DETECTION_DTYPE = np.dtype(
+    [
+        ("xmin", np.float32),
+        ("ymin", np.float32),
+        ("xmax", np.float32),
+        ("ymax", np.float32),
+        ("confidence", np.float32),
+        ("class", np.int32),
+    ]
+)
+
+
+def to_detections(pred, scale=(1.0, 1.0)):
+    """Convert an (n, 6) xyxy, confidence, class prediction tensor or array
+    into a structured array of detections.
+
+    Box coordinates are multiplied by the (x, y) scale factors.
+    """
+    if hasattr(pred, "cpu"):
+        pred = pred.cpu().numpy()
+    pred = np.asarray(pred, dtype=np.float32).reshape(-1, 6)
+
+    detections = np.empty(len(pred), dtype=DETECTION_DTYPE)
+    for i, field in enumerate(DETECTION_DTYPE.names):
+        detections[field] = pred[:, i]
+
+    sx, sy = scale
+    if sx != 1.0 or sy != 1.0:
+        detections["xmin"] *= sx
+        detections["xmax"] *= sx
+        detections["ymin"] *= sy
+        detections["ymax"] *= sy
+    return detections
+
+
+def parse_class_thresholds(text):
+    """Parse "ID=CONF,..." into a {class id: threshold} dict"""
+    thresholds = {}
+    for item in text.split(","):
+        cls, _, threshold = item.partition("=")
+        thresholds[int(cls)] = float(threshold)
+    return thresholds
+
+
+class DetectionFilter:
+    """Which detections of an image are kept: those scoring above the
+    threshold of their class, which is not excluded, at most max_det of them
+    by confidence.
+
+    Backends apply it to the candidates before NMS, so that excluded and low
+    scoring boxes cost nothing there and cannot take up max_det slots. The
+    engine applies it again to whatever a backend could not filter.
+    """
+
+    def __init__(
+        self, threshold, class_thresholds=None, exclusions=None, max_det=MAX_DETECTIONS
+    ):
+        self.threshold = threshold
+        self.class_thresholds = dict(class_thresholds or {})
+        self.exclusions = set() if exclusions is None else set(map(int, exclusions))
+        self.max_det = max_det
+        self.lookups = {}  # number of classes -> thresholds array
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args):
+        exclusions = list(map(int, args.exclude.split(","))) if args.exclude else None
+        return cls(args.threshold, args.class_thresholds, exclusions, args.max_det)
+
+    @property
+    def min_threshold(self):
+        """Lowest threshold any class is kept at"""
+        return min([self.threshold, *self.class_thresholds.values()])
+
+    def thresholds(self, num_classes):
+        """Threshold of every class id below num_classes, infinite for the
+        excluded ones"""
+        with self.lock:
+            lookup = self.lookups.get(num_classes)
+            if lookup is None:
+                lookup = np.full(num_classes, self.threshold, dtype=np.float32)
+                for cls, threshold in self.class_thresholds.items():
+                    if cls < num_classes:
+                        lookup[cls] = threshold
+                for cls in self.exclusions:
+                    if cls < num_classes:
+                        lookup[cls] = np.inf
+                self.lookups[num_classes] = lookup
+            return lookup
+
+    def kept_classes(self, num_classes):
+        """Class ids that are not excluded, or None if all are kept"""
+        if not self.exclusions:
+            return None
+        return [cls for cls in range(num_classes) if cls not in self.exclusions]
+
+    def apply(self, detections):
+        """Filter a structured array of detections"""
+        if len(detections) == 0:
+            return detections
+        classes = detections["class"]
+        lookup = self.thresholds(max(int(classes.max()) + 1, 1))
+        detections = detections[detections["confidence"] > lookup[classes]]
+        if len(detections) > self.max_det:
+            order = np.argsort(-detections["confidence"], kind="stable")
+            detections = detections[np.sort(order[: self.max_det])]
+        return detections
+
+    def __str__(self):
+        return (
+            f"threshold {self.threshold}, class thresholds {self.class_thresholds},"
+            f" excluded classes {sorted(self.exclusions)}, max {self.max_det}"
+        )
+
+
+def box_iou(a, b):
+    """Pairwise IoU of the (n, 4) and (m, 4) xyxy boxes a and b"""
+    a = a[:, None, :]
+    b = b[None, :, :]
+    w = np.clip(
+        np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None
+    )
+    h = np.clip(
+        np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None
+    )
+    inter = w * h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / (area_a + area_b - inter + 1e-9)
@@ -0,0 +1,116 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import logging
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATION_MODES = ("dynamic", "static")
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+
+
+def quantized_path(onnx_path, mode):
+    return onnx_path.with_name(f"{onnx_path.stem}.int8-{mode}.onnx")
+
+
+def load_calibration_frames(directory, size):
+    """Letterboxed NCHW float32 inputs for the frames in directory"""
+    from .backends import letterbox
+
+    frames = []
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+        if img is None:
+            logger.warning(f"Skipping unreadable calibration frame {path}")
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        padded, _, _ = letterbox(img, (size, size))
+        frames.append(padded.transpose(2, 0, 1)[None].astype(np.float32) / 255)
+    if not frames:
+        raise ValueError(f"No calibration frames found in {directory}")
+    return frames
+
+
+def quantize_model(onnx_path, mode, calibration_dir=None, size=640):
+    """Return the path of an INT8 version of onnx_path, creating it first if
+    it is not cached in the models directory yet."""
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static,
+    )
+
+    output_path = quantized_path(onnx_path, mode)
+    if output_path.exists():
+        logger.info(f"Using cached quantized model {output_path}")
+        return output_path
+
+    start = time.monotonic()
+    if mode == "dynamic":
+        logger.info(f"Quantizing {onnx_path} (dynamic)...")
+        quantize_dynamic(str(onnx_path), str(output_path), weight_type=QuantType.QUInt8)
+    elif mode == "static":
+        if calibration_dir is None:
+            raise ValueError("Static quantization needs a calibration directory")
+        frames = load_calibration_frames(calibration_dir, size)
+        logger.info(
+            f"Quantizing {onnx_path} (static, calibrating on {len(frames)} frames)..."
+        )
+        input_name = onnx.load(str(onnx_path)).graph.input[0].name
+
+        class FrameReader(CalibrationDataReader):
+            def __init__(self):
+                self.frames = iter(frames)
+
+            def get_next(self):
+                frame = next(self.frames, None)
+                return None if frame is None else {input_name: frame}
+
+        quantize_static(
+            str(onnx_path),
+            str(output_path),
+            FrameReader(),
+            quant_format=QuantFormat.QDQ,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            per_channel=True,
+        )
+    else:
+        raise ValueError(f"Unknown quantization mode {mode}")
+
+    # carry over the class names stored at export time
+    source = onnx.load(str(onnx_path))
+    quantized = onnx.load(str(output_path))
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, str(output_path))
+
+    logger.info(
+        f"Stored quantized model {output_path} in {time.monotonic() - start:.1f}s"
+    )
+    return output_path
@@ -0,0 +1,150 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+RETRY_INTERVAL = 60  # seconds before a model that failed to load is retried
+
+
+class ModelLoadError(Exception):
+    pass
+
+
+class ModelRegistry:
+    """Keep recently used predictors loaded so that clients asking for
+    different models do not force a reload on every frame.
+
+    Models are loaded on a background thread while the loaded ones keep
+    serving, and swapped in once ready. Concurrent requests for a model
+    share its load. A model that failed to load is not retried for
+    retry_interval seconds.
+
+    The registry holds at most max_models predictors and, when max_memory_mb
+    is set, evicts least recently used predictors until the estimated size of
+    the loaded models fits. The most recently used model is never evicted.
+    """
+
+    def __init__(
+        self, loader, max_models, max_memory_mb=0, retry_interval=RETRY_INTERVAL
+    ):
+        self.loader = loader
+        self.max_models = max(1, max_models)
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.retry_interval = retry_interval
+        self.models = OrderedDict()  # name -> (predictor, estimated bytes)
+        self.loading = {}  # name -> Future of the load in progress
+        self.failures = {}  # name -> (time, exception) of the last failed load
+        # one load at a time, to not hold several new models in memory at once
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="model-loader")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.failed_loads = 0
+        self.load_time = 0.0
+
+    def get(self, model, block=True):
+        """Predictor for model, loading it if needed. Without block None is
+        returned while it loads. Raises ModelLoadError if the model failed to
+        load within the last retry_interval seconds."""
+        with self.lock:
+            entry = self.models.get(model)
+            if entry is not None:
+                self.models.move_to_end(model)
+                self.hits += 1
+                return entry[0]
+
+            future = self.loading.get(model)
+            if future is None:
+                failure = self.failures.get(model)
+                if failure and time.monotonic() - failure[0] < self.retry_interval:
+                    raise ModelLoadError(f"Loading model {model} failed: {failure[1]}")
+                self.misses += 1
+                future = self.executor.submit(self._load, model)
+                self.loading[model] = future
+
+        if not block:
+            return None
+        return future.result()
+
+    def loaded(self, model):
+        """Predictor for model if it is loaded, or else None, without loading
+        it"""
+        with self.lock:
+            entry = self.models.get(model)
+            return None if entry is None else entry[0]
+
+    def _load(self, model):
+        start = time.monotonic()
+        try:
+            predictor = self.loader(model)
+            size = predictor.memory_footprint()
+        except Exception as e:
+            logger.exception(f"Failed to load model {model}")
+            with self.lock:
+                del self.loading[model]
+                self.failures[model] = (time.monotonic(), e)
+                self.failed_loads += 1
+            raise ModelLoadError(f"Loading model {model} failed: {e}") from e
+        elapsed = time.monotonic() - start
+
+        with self.lock:
+            # frames pick the new model up from here on
+            self.models[model] = (predictor, size)
+            del self.loading[model]
+            self.failures.pop(model, None)
+            self.load_time += elapsed
+            evicted = self._evict()
+        logger.info(f"Loaded model {model} ({size / 2**20:.1f} MB) in {elapsed:.2f}s")
+        for name, old in evicted:
+            logger.info(f"Evicting least recently used model {name}")
+            old.close()
+        logger.info(f"Model registry: {self.stats()}")
+        return predictor
+
+    def _evict(self):
+        evicted = []
+        while len(self.models) > 1 and (
+            len(self.models) > self.max_models
+            or (self.max_memory and self.memory_used() > self.max_memory)
+        ):
+            model, (predictor, _) = self.models.popitem(last=False)
+            self.evictions += 1
+            evicted.append((model, predictor))
+        return evicted
+
+    def memory_used(self):
+        return sum(size for _, size in self.models.values())
+
+    def stats(self):
+        return {
+            "models": list(self.models),
+            "loading": list(self.loading),
+            "memory_mb": self.memory_used() / 2**20,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "failed_loads": self.failed_loads,
+            "load_time_s": self.load_time,
+        }
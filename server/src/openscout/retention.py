@@ -0,0 +1,348 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Size and age bounded retention of stored images.
+
+The images of each category (received, detected, faces) are deleted oldest
+first once the category grows beyond its maximum size or they get older
+than its maximum age. The tree is scanned once at startup, after that new
+images are picked up by following the index files the ImageStore appends
+to, so a pass only touches the files it deletes. This works the same in an
+engine process and in the openscout-retention sidecar.
+"""
+
+import argparse
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ("received", "detected", "faces")
+DELETES_PER_PASS = 1000  # deletions before pausing, to not hog the disk
+UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+AGE_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_size(text):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?", text.strip().lower())
+    if match is None:
+        raise ValueError(f"Invalid size {text!r}")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def parse_age(text):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smhd]?)", text.strip().lower())
+    if match is None:
+        raise ValueError(f"Invalid age {text!r}")
+    return float(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+def parse_policy(text):
+    """CATEGORY=SIZE[,AGE] into (category, max_bytes, max_age), a size or
+    age of 0 means unlimited"""
+    try:
+        category, limits = text.split("=", 1)
+        size, _, age = limits.partition(",")
+        if category not in CATEGORIES:
+            raise ValueError(f"Unknown category {category!r}")
+        return category, parse_size(size), parse_age(age) if age else 0
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            f"{e}, expected CATEGORY=SIZE[,AGE] with CATEGORY one of"
+            f" {', '.join(CATEGORIES)}, e.g. received=20G,7d"
+        )
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--retain",
+        type=parse_policy,
+        action="append",
+        default=[],
+        metavar="CATEGORY=SIZE[,AGE]",
+        help="Delete the oldest stored images of a category beyond SIZE bytes"
+        " (K, M, G, T suffixes) or older than AGE (s, m, h, d suffixes), e.g."
+        " received=20G,7d. Repeat for each category, 0 means unlimited.",
+    )
+    parser.add_argument(
+        "--retention-interval",
+        type=float,
+        default=60,
+        help="Seconds between retention passes.",
+    )
+
+
+class Category:
+    """Stored images of a category, a heap ordered oldest first. Hard links
+    to the same file (deduplicated received frames) count once, their bytes
+    are freed with the last link."""
+
+    def __init__(self, name, max_bytes, max_age):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.heap = []  # (timestamp, path, size, inode)
+        self.known = set()
+        self.links = {}  # inode -> paths known
+        self.bytes = 0
+        self.deleted = 0
+        self.deleted_bytes = 0
+
+    def add(self, timestamp, path, stat):
+        if path in self.known:
+            return
+        self.known.add(path)
+        inode = (stat.st_dev, stat.st_ino)
+        heapq.heappush(self.heap, (timestamp, path, stat.st_size, inode))
+        self.links[inode] = self.links.get(inode, 0) + 1
+        if self.links[inode] == 1:
+            self.bytes += stat.st_size
+
+    def expired(self, now):
+        """Whether the oldest image has to go"""
+        if not self.heap:
+            return False
+        if self.max_bytes and self.bytes > self.max_bytes:
+            return True
+        return bool(self.max_age) and self.heap[0][0] < now - self.max_age
+
+    def pop(self):
+        """Oldest path and the bytes deleting it frees"""
+        timestamp, path, size, inode = heapq.heappop(self.heap)
+        self.known.discard(path)
+        self.links[inode] -= 1
+        if self.links[inode]:
+            return path, 0
+        del self.links[inode]
+        self.bytes -= size
+        return path, size
+
+    def oldest(self):
+        return self.heap[0][0] if self.heap else None
+
+
+class RetentionManager:
+    """Enforce the retention policies on the images stored under root from a
+    background thread, or from run() in the sidecar."""
+
+    def __init__(self, root, policies, interval=60):
+        self.root = Path(root)
+        self.interval = interval
+        self.categories = {
+            name: Category(name, max_bytes, max_age)
+            for name, max_bytes, max_age in policies
+        }
+        self.offsets = {}  # index file -> bytes read
+        self.closed = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def from_args(cls, root, args):
+        """Manager for the --retain policies, or None if there are none"""
+        if not args.retain:
+            return None
+        return cls(root, args.retain, args.retention_interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        for category in self.categories.values():
+            logger.info(
+                f"Retaining {category.name} images up to"
+                f" {category.max_bytes / 2**30:.1f} GiB"
+                f" and {category.max_age / 86400:.1f} days (0 is unlimited)"
+            )
+        # anything indexed from here on is picked up by follow_index()
+        self.follow_index(skip=True)
+        self.scan()
+        while not self.closed.is_set():
+            try:
+                self.follow_index()
+                self.collect()
+            except Exception:
+                logger.exception("Retention pass failed")
+            self.closed.wait(self.interval)
+
+    def scan(self):
+        """Account for the images already on disk"""
+        start = time.monotonic()
+        for category in self.categories.values():
+            for entry in walk(self.root / category.name):
+                stat = os.stat(entry.path)
+                relative = os.path.relpath(entry.path, self.root)
+                category.add(stat.st_mtime, relative, stat)
+            logger.info(
+                f"Found {len(category.heap)} {category.name} images,"
+                f" {category.bytes / 2**20:.1f} MiB"
+            )
+        logger.info(f"Scanned stored images in {time.monotonic() - start:.1f}s")
+
+    def follow_index(self, skip=False):
+        """Account for the images appended to the index files since the last
+        call, with skip only remember where the index files end"""
+        index = self.root / "index"
+        if not index.is_dir():
+            return
+        for path in sorted(index.glob("*.tsv")):
+            offset = self.offsets.get(path, 0)
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+            # a line may still be being written
+            end = data.rfind(b"\n") + 1
+            self.offsets[path] = offset + end
+            if skip:
+                continue
+            for line in data[:end].decode("utf-8", "replace").splitlines():
+                fields = line.split("\t")
+                if len(fields) != 6:
+                    continue
+                timestamp_ms, _, kind, _, relative, _ = fields
+                category = self.categories.get(kind)
+                if category is None or relative in category.known:
+                    continue
+                try:
+                    # stat for the inode, the index does not tell links apart
+                    stat = os.stat(self.root / relative)
+                    category.add(int(timestamp_ms) / 1000, relative, stat)
+                except FileNotFoundError:
+                    continue
+                except ValueError:
+                    logger.warning(f"Skipping malformed line in {path}: {line!r}")
+
+    def collect(self):
+        """Delete images until every category is within its limits, pausing
+        every DELETES_PER_PASS deletions"""
+        now = time.time()
+        for category in self.categories.values():
+            deleted = deleted_bytes = 0
+            while category.expired(now) and not self.closed.is_set():
+                relative, size = category.pop()
+                path = self.root / relative
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                deleted += 1
+                deleted_bytes += size
+                remove_empty_parents(path.parent, self.root / category.name)
+                if deleted % DELETES_PER_PASS == 0:
+                    self.closed.wait(0.1)
+            category.deleted += deleted
+            category.deleted_bytes += deleted_bytes
+            if deleted:
+                logger.info(
+                    f"Deleted {deleted} {category.name} images,"
+                    f" {deleted_bytes / 2**20:.1f} MiB, keeping"
+                    f" {len(category.heap)}, {category.bytes / 2**20:.1f} MiB"
+                )
+        self.collect_index()
+
+    def collect_index(self):
+        """Delete index files of days before the oldest image retained"""
+        oldest = [category.oldest() for category in self.categories.values()]
+        if None in oldest or len(self.categories) < len(CATEGORIES):
+            # nothing known about the age of some images
+            return
+        first_day = time.strftime("%Y-%m-%d", time.gmtime(min(oldest)))
+        for path in (self.root / "index").glob("*.tsv"):
+            if path.stem < first_day:
+                path.unlink()
+                self.offsets.pop(path, None)
+
+    def stats(self):
+        return {
+            name: {
+                "images": len(category.heap),
+                "bytes": category.bytes,
+                "deleted": category.deleted,
+                "deleted_bytes": category.deleted_bytes,
+            }
+            for name, category in self.categories.items()
+        }
+
+
+def walk(directory):
+    """Files below directory, as os.DirEntry"""
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry
+
+
+def remove_empty_parents(directory, top):
+    """Remove directory and its parents up to, not including, top while they
+    are empty"""
+    while directory != top:
+        try:
+            directory.rmdir()
+        except OSError:
+            return
+        directory = directory.parent
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Delete the oldest stored images beyond size and age limits",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--root", default="images", help="Directory the engines store images in."
+    )
+    add_arguments(parser)
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Scan, delete what exceeds the limits and exit.",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if not args.retain:
+        parser.error("no --retain policy given")
+    manager = RetentionManager(args.root, args.retain, args.retention_interval)
+    if args.once:
+        manager.scan()
+        manager.collect()
+        logger.info(f"Retention stats: {manager.stats()}")
+        return
+    try:
+        manager.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import gzip
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LOG_DIR = Path("/openscout-server")
+FLUSH_RECORDS = 4096  # flush early once this many records are pending
+
+
+def add_arguments(parser):
+    """Add the detection log options shared by the engines to parser"""
+    parser.add_argument(
+        "--log-dir",
+        default=str(LOG_DIR),
+        help="Directory the detection logs are written to.",
+    )
+    parser.add_argument(
+        "--log-flush-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between writes of buffered detection records to disk.",
+    )
+    parser.add_argument(
+        "--log-max-bytes",
+        type=int,
+        default=64 * 2**20,
+        help="Rotate the detection log once it reaches this size.",
+    )
+    parser.add_argument(
+        "--log-rotate-interval",
+        type=float,
+        default=24 * 3600,
+        help="Rotate the detection log after this many seconds, 0 to disable.",
+    )
+
+
+def exit_on_sigterm():
+    """Exit through SystemExit on SIGTERM, as sent by docker stop, so that
+    the atexit handlers flush buffered detection records and queued image
+    writes. Must be called from the main thread."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+class DetectionSink:
+    """Append detection records to path as newline-delimited JSON.
+
+    write() only queues the record, a background thread serializes and
+    writes queued records every flush_interval seconds (or sooner when many
+    are pending) with a single write call. The file is rotated when it
+    reaches max_bytes or is older than rotate_interval seconds. The previous
+    rotated file is gzipped at the next rotation, which gives log shippers
+    still reading it time to finish.
+    """
+
+    def __init__(self, path, flush_interval=1.0, max_bytes=0, rotate_interval=0):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.pending = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.written = 0
+        self.rotations = 0
+        self.compressing = set()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._open()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_args(cls, name, args):
+        """Sink for name in the log directory, configured from the
+        add_arguments options"""
+        return cls(
+            Path(args.log_dir) / name,
+            args.log_flush_interval,
+            args.log_max_bytes,
+            args.log_rotate_interval,
+        )
+
+    def write(self, record):
+        with self.lock:
+            self.pending.append(record)
+            if len(self.pending) >= FLUSH_RECORDS:
+                self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        self.file.write(data.encode("utf-8"))
+        self.file.flush()
+        self.written += len(records)
+
+        size = self.file.tell()
+        age = time.time() - self.opened
+        if (self.max_bytes and size >= self.max_bytes) or (
+            self.rotate_interval and age >= self.rotate_interval
+        ):
+            self._rotate()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+    def _open(self):
+        self.file = open(self.path, "ab")
+        self.opened = time.time()
+
+    def _rotate(self):
+        self.file.close()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        rotated = self.path.with_name(f"{self.path.name}.{stamp}")
+        counter = 1
+        while rotated.exists() or rotated.with_name(rotated.name + ".gz").exists():
+            rotated = self.path.with_name(f"{self.path.name}.{stamp}-{counter}")
+            counter += 1
+        os.rename(self.path, rotated)
+        self._open()
+        self.rotations += 1
+        logger.info(f"Rotated detection log to {rotated}")
+
+        for previous in self.path.parent.glob(f"{self.path.name}.*"):
+            if previous == rotated or previous.suffix == ".gz":
+                continue
+            if previous not in self.compressing:
+                self.compressing.add(previous)
+                threading.Thread(target=compress, args=(previous,)).start()
+
+    def _run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except OSError:
+                logger.exception(f"Failed to write detection log {self.path}")
+
+
+def compress(path):
+    with open(path, "rb") as src, gzip.open(f"{path}.gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.unlink(path)
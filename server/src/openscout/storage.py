@@ -0,0 +1,327 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import hashlib
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+REPORT_INTERVAL = 30  # seconds
+DEDUP_ENTRIES = 65536  # digests of recent payloads remembered for de-duplication
+IMAGE_SIGNATURES = {b"\xff\xd8\xff": ".jpg", b"\x89PNG\r\n\x1a\n": ".png"}
+
+
+def image_suffix(payload):
+    """File suffix for the format of an image payload, or None if it is not
+    a JPEG or PNG"""
+    for signature, suffix in IMAGE_SIGNATURES.items():
+        if payload[: len(signature)] == signature:
+            return suffix
+    return None
+
+
+def write_payload(path, payload):
+    """Write the payload bytes to path as they are, without decoding them or
+    copying them into another buffer"""
+    view = memoryview(payload)
+    with open(path, "wb", buffering=0) as f:
+        while view:
+            view = view[f.write(view) :]
+
+
+def save_payload(stem, payload):
+    """Store an image payload at stem plus the suffix of its format. JPEG and
+    PNG payloads are written as they were received, anything else is
+    converted to PNG. Returns the path written."""
+    suffix = image_suffix(payload)
+    if suffix is None:
+        path = f"{stem}.png"
+        Image.open(BytesIO(payload)).save(path)
+    else:
+        path = f"{stem}{suffix}"
+        write_payload(path, payload)
+    return path
+
+
+class AsyncImageWriter:
+    """Run image storage jobs on a pool of background threads so that slow
+    disks do not hold up inference.
+
+    Jobs wait in a bounded queue. When the queue is full the overflow policy
+    decides whether submit() blocks, discards the oldest queued job or
+    discards the job being submitted.
+    """
+
+    def __init__(self, workers=1, queue_size=64, overflow="block"):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        self.overflow = overflow
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.lastreport = time.monotonic()
+        self.closed = False
+
+        self.threads = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+        logger.info(
+            f"Storing images with {workers} writer(s), queue size {queue_size},"
+            f" overflow policy {overflow}"
+        )
+
+    def submit(self, job, *args):
+        """Queue job(*args) to run on a writer thread, returns whether it
+        was queued"""
+        if self.closed:
+            logger.error("Image writer is closed, dropping job")
+            return False
+        item = (job, args)
+        with self.lock:
+            self.submitted += 1
+
+        if self.overflow == "block":
+            self.queue.put(item)
+        elif self.overflow == "drop-newest":
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self._drop()
+                return False
+        else:
+            while True:
+                try:
+                    self.queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    pass
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self.queue.task_done()
+                self._drop()
+        return True
+
+    def _drop(self):
+        with self.lock:
+            self.dropped += 1
+
+    def close(self):
+        """Write out everything still queued and stop the writer threads"""
+        if self.closed:
+            return
+        self.closed = True
+        logger.info(f"Flushing {self.queue.qsize()} queued image writes...")
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        logger.info(f"Image writer stats: {self.stats()}")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+
+            job, args = item
+            start = time.monotonic()
+            try:
+                job(*args)
+                failed = False
+            except Exception:
+                logger.exception("Failed to store image")
+                failed = True
+            latency = time.monotonic() - start
+            self.queue.task_done()
+
+            with self.lock:
+                if failed:
+                    self.failed += 1
+                else:
+                    self.written += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                report = start - self.lastreport > REPORT_INTERVAL
+                if report:
+                    self.lastreport = start
+            if report:
+                logger.info(f"Image writer stats: {self.stats()}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "submitted": self.submitted,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "mean_write_ms": (
+                    self.total_latency / self.written * 1000 if self.written else 0.0
+                ),
+                "max_write_ms": self.max_latency * 1000,
+            }
+
+
+def payload_digest(payload):
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+class ImageStore:
+    """Stored images, sharded by kind, day and content hash under root.
+
+    An image is stored at
+
+        <kind>/<YYYY-MM-DD>/<digest[:2]>/<digest[:16]>-<client>-<ms>.<suffix>
+
+    where digest is the hash of the frame payload it came from. The path
+    relative to root is also the path of its URL on the web server, and it
+    only depends on the frame, so the URL can be logged before the image is
+    written. A payload identical to a recently stored one is hard linked to
+    it rather than written again. Every stored image gets a line in the
+    index/<YYYY-MM-DD>.tsv file of its day:
+
+        <ms> <client_id> <kind> <digest> <path> <bytes>
+    """
+
+    def __init__(self, root, dedup_entries=DEDUP_ENTRIES):
+        self.root = Path(root)
+        self.dedup_entries = dedup_entries
+        self.recent = OrderedDict()  # (kind, digest) -> path of the first copy
+        self.directories = set()
+        self.lock = threading.Lock()
+        self.index_day = None
+        self.index_file = None
+        self.stored = 0
+        self.deduplicated = 0
+        self._mkdir(self.root / "index")
+
+    def location(
+        self, kind, digest, client_id, timestamp_ms, suffix=".jpg", label=None
+    ):
+        """Path of an image relative to root, label tells apart several
+        images of kind stored for the same frame"""
+        day = time.strftime("%Y-%m-%d", time.gmtime(timestamp_ms / 1000))
+        client = re.sub(r"[^A-Za-z0-9_-]", "", client_id)[:8] or "anon"
+        name = f"{digest[:16]}-{client}-{timestamp_ms}"
+        if label is not None:
+            name += f"-{label}"
+        return f"{kind}/{day}/{digest[:2]}/{name}{suffix}"
+
+    def save_payload(self, kind, digest, client_id, timestamp_ms, payload):
+        """Store payload as it was received, returns its relative path"""
+        relative = self.location(
+            kind, digest, client_id, timestamp_ms, image_suffix(payload) or ".jpg"
+        )
+        path = self.root / relative
+        self._mkdir(path.parent)
+        with self.lock:
+            first = self.recent.get((kind, digest))
+        if first is None or not self._link(first, path):
+            self._write(path, write_payload, payload)
+            self._remember((kind, digest), relative)
+        self._index(timestamp_ms, client_id, kind, digest, relative, len(payload))
+        return relative
+
+    def save_image(
+        self, kind, digest, client_id, timestamp_ms, image, suffix=".jpg", label=None
+    ):
+        """Encode the RGB array image in the format of suffix and store it,
+        returns its relative path"""
+        relative = self.location(kind, digest, client_id, timestamp_ms, suffix, label)
+        path = self.root / relative
+        self._mkdir(path.parent)
+        self._write(path, Image.fromarray(image).save)
+        self._index(
+            timestamp_ms, client_id, kind, digest, relative, path.stat().st_size
+        )
+        return relative
+
+    def _mkdir(self, directory):
+        if directory not in self.directories:
+            directory.mkdir(parents=True, exist_ok=True)
+            self.directories.add(directory)
+
+    def _write(self, path, write, *args):
+        try:
+            write(path, *args)
+        except FileNotFoundError:
+            # the directory was removed when retention emptied it
+            self.directories.discard(path.parent)
+            self._mkdir(path.parent)
+            write(path, *args)
+
+    def _link(self, first, path):
+        try:
+            os.link(self.root / first, path)
+        except FileExistsError:
+            pass  # the same frame stored twice
+        except OSError:
+            # the first copy was removed, or links are not supported
+            return False
+        with self.lock:
+            self.deduplicated += 1
+        return True
+
+    def _remember(self, key, relative):
+        with self.lock:
+            self.recent[key] = relative
+            self.recent.move_to_end(key)
+            if len(self.recent) > self.dedup_entries:
+                self.recent.popitem(last=False)
+
+    def _index(self, timestamp_ms, client_id, kind, digest, relative, size):
+        day = relative.split("/", 2)[1]
+        client = client_id.replace("\t", " ").replace("\n", " ")
+        line = f"{timestamp_ms}\t{client}\t{kind}\t{digest}\t{relative}\t{size}\n"
+        with self.lock:
+            self.stored += 1
+            if day != self.index_day:
+                if self.index_file is not None:
+                    self.index_file.close()
+                self.index_file = open(self.root / "index" / f"{day}.tsv", "a")
+                self.index_day = day
+            self.index_file.write(line)
+            self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.index_file is not None:
+                self.index_file.close()
+                self.index_file = None
+                self.index_day = None
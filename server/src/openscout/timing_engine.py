@@ -21,137 +21,50 @@
 import time
 
 from .msface_engine import MSFaceEngine
-from .openface_engine import OpenFaceEngine
 from .object_engine import OpenScoutObjectEngine
+from .openface_engine import OpenFaceEngine
 
+REPORT_INTERVAL = 5  # seconds
 
-# TODO: these timing engines need work as the metrics here are still
-# inherited from OpenRTiST
-class TimingOpenFaceEngine(OpenFaceEngine):
-    def __init__(self, args):
-        super().__init__(args)
-        self.count = 0
-        self.lasttime = time.time()
-        self.lastcount = 0
-        self.lastprint = self.lasttime
-
-    def handle(self, from_client):
-        self.t0 = time.time()
-        result = super().handle(from_client)
-        self.t3 = time.time()
-
-        self.count += 1
-        if self.t3 - self.lastprint > 5:
-            print(f"pre {(self.t1 - self.t0) * 1000:.1f} ms, ", end="")
-            print(f"infer {(self.t2 - self.t1) * 1000:.1f} ms, ", end="")
-            print(f"post {(self.t3 - self.t2) * 1000:.1f} ms, ", end="")
-            print(f"wait {(self.t0 - self.lasttime) * 1000:.1f} ms, ", end="")
-            print(f"fps {1.0 / (self.t3 - self.lasttime):.2f}")
-            print(
-                "avg fps: {:.2f}".format(
-                    (self.count - self.lastcount) / (self.t3 - self.lastprint)
-                )
-            )
-            print()
-            self.lastcount = self.count
-            self.lastprint = self.t3
-
-        self.lasttime = self.t3
-
-        return result
-
-    def infer(self, image):
-        self.t1 = time.time()
-        results = super().infer(image)
-        self.t2 = time.time()
-
-        return results
 
+class TimingMixin:
+    """Print the mean time spent per stage and the frame rate every
+    REPORT_INTERVAL seconds, based on the engine latency metrics."""
 
-class TimingMSFaceEngine(MSFaceEngine):
     def __init__(self, args):
         super().__init__(args)
-        self.count = 0
-        self.lasttime = time.time()
-        self.lastcount = 0
-        self.lastprint = self.lasttime
+        self.lastprint = time.monotonic()
+        self.lasttotals = self.metrics.stage_totals()
 
     def handle(self, from_client):
-        self.t0 = time.time()
         result = super().handle(from_client)
-        self.t3 = time.time()
 
-        self.count += 1
-        if self.t3 - self.lastprint > 5:
-            print(f"pre {(self.t1 - self.t0) * 1000:.1f} ms, ", end="")
-            print(f"infer {(self.t2 - self.t1) * 1000:.1f} ms, ", end="")
-            print(f"post {(self.t3 - self.t2) * 1000:.1f} ms, ", end="")
-            print(f"wait {(self.t0 - self.lasttime) * 1000:.1f} ms, ", end="")
-            print(f"fps {1.0 / (self.t3 - self.lasttime):.2f}")
-            print(
-                "avg fps: {:.2f}".format(
-                    (self.count - self.lastcount) / (self.t3 - self.lastprint)
-                )
-            )
+        now = time.monotonic()
+        if now - self.lastprint > REPORT_INTERVAL:
+            totals = self.metrics.stage_totals()
+            stages = []
+            for stage, (count, total) in totals.items():
+                lastcount, lasttotal = self.lasttotals.get(stage, (0, 0.0))
+                if count > lastcount:
+                    mean = (total - lasttotal) / (count - lastcount)
+                    stages.append(f"{stage} {mean * 1000:.1f} ms")
+            frames = totals["handle"][0] - self.lasttotals.get("handle", (0, 0.0))[0]
+            print(", ".join(stages))
+            print(f"avg fps: {frames / (now - self.lastprint):.2f}")
             print()
-            self.lastcount = self.count
-            self.lastprint = self.t3
-
-        self.lasttime = self.t3
+            self.lastprint = now
+            self.lasttotals = totals
 
         return result
 
-    def detection(self, image):
-        self.t1 = time.time()
-        results = super().detection(image)
-        self.t2 = time.time()
-
-        return results
 
-    def recognition(self, image):
-        self.t2 = time.time()
-        results = super().detection(image)
-        self.t3 = time.time()
+class TimingOpenFaceEngine(TimingMixin, OpenFaceEngine):
+    pass
 
-        return results
 
+class TimingMSFaceEngine(TimingMixin, MSFaceEngine):
+    pass
 
-class TimingObjectEngine(OpenScoutObjectEngine):
-    def __init__(self, args):
-        super().__init__(args)
-        self.count = 0
-        self.lasttime = time.time()
-        self.lastcount = 0
-        self.lastprint = self.lasttime
-
-    def handle(self, from_client):
-        self.t0 = time.time()
-        result = super().handle(from_client)
-        self.t3 = time.time()
-
-        self.count += 1
-        if self.t3 - self.lastprint > 5:
-            print(f"pre {(self.t1 - self.t0) * 1000:.1f} ms, ", end="")
-            print(f"infer {(self.t2 - self.t1) * 1000:.1f} ms, ", end="")
-            print(f"post {(self.t3 - self.t2) * 1000:.1f} ms, ", end="")
-            print(f"wait {(self.t0 - self.lasttime) * 1000:.1f} ms, ", end="")
-            print(f"fps {1.0 / (self.t3 - self.lasttime):.2f}")
-            print(
-                "avg fps: {:.2f}".format(
-                    (self.count - self.lastcount) / (self.t3 - self.lastprint)
-                )
-            )
-            print()
-            self.lastcount = self.count
-            self.lastprint = self.t3
-
-        self.lasttime = self.t3
-
-        return result
-
-    def inference(self, preprocessed):
-        self.t1 = time.time()
-        results = super().inference(preprocessed)
-        self.t2 = time.time()
 
-        return results
+class TimingObjectEngine(TimingMixin, OpenScoutObjectEngine):
+    pass
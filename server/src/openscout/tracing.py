@@ -0,0 +1,232 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+"""Sampled per-frame span tracing, exported as Chrome trace-event JSON.
+
+A sampled frame gets a span covering the whole handle() call, every span
+opened while handling it is recorded as a nested span of that frame. The
+resulting files can be opened in https://ui.perfetto.dev or chrome://tracing.
+"""
+
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+FRAMES_PER_FILE = 500
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--trace-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of frames to trace, 0 disables tracing.",
+    )
+    parser.add_argument(
+        "--trace-dir",
+        default="traces",
+        help="Directory the Chrome trace-event JSON files are written to.",
+    )
+
+
+def now_us():
+    return time.perf_counter_ns() // 1000
+
+
+class Frame:
+    """A sampled frame, its tags are added to all of its spans"""
+
+    def __init__(self, frame_id, tags):
+        self.id = frame_id
+        self.tags = tags
+
+
+class Span:
+    def __init__(self, tracer, name, frame, tags):
+        self.tracer = tracer
+        self.name = name
+        self.frame = frame
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = now_us()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = now_us()
+        args = dict(self.frame.tags, frame=self.frame.id, **self.tags)
+        if exc_type is not None:
+            args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.start, end - self.start, args)
+
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer:
+    """Record spans of a sample_rate fraction of the frames and write them to
+    directory every FRAMES_PER_FILE sampled frames and at close."""
+
+    def __init__(self, name, sample_rate=0.0, directory="traces"):
+        self.name = name
+        self.sample_rate = sample_rate
+        self.enabled = sample_rate > 0
+        self.directory = Path(directory)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.events = []
+        self.frames = 0
+        self.threads = set()
+        self.frame_ids = itertools.count(1)
+        self.files = itertools.count(1)
+        if self.enabled:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            logger.info(
+                f"Tracing {sample_rate:.1%} of frames to {self.directory.resolve()}"
+            )
+
+    @classmethod
+    def from_args(cls, name, args):
+        return cls(name, args.trace_rate, args.trace_dir)
+
+    def current(self):
+        """The sampled frame being handled by this thread, or None"""
+        return getattr(self.local, "frame", None)
+
+    def tag(self, **tags):
+        """Add tags, such as the client_id, to the current frame"""
+        frame = self.current()
+        if frame is not None:
+            frame.tags.update(tags)
+
+    def span(self, name, frame=None, **tags):
+        """Context manager recording a span of the current frame, or of frame
+        when the work was handed off to another thread"""
+        frame = frame or self.current()
+        if frame is None:
+            return NO_SPAN
+        return Span(self, name, frame, tags)
+
+    def record(self, name, start, duration, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start,
+            "dur": duration,
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": args,
+        }
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": thread.ident,
+                        "args": {"name": thread.name},
+                    }
+                )
+            self.events.append(event)
+
+    def start_frame(self):
+        if random.random() >= self.sample_rate:
+            return None
+        frame = Frame(next(self.frame_ids), {})
+        self.local.frame = frame
+        return frame
+
+    def end_frame(self, frame, start, error=None):
+        self.local.frame = None
+        args = dict(frame.tags, frame=frame.id)
+        if error is not None:
+            args["error"] = error
+        self.record(self.name, start, now_us() - start, args)
+
+        with self.lock:
+            self.frames += 1
+            if self.frames < FRAMES_PER_FILE:
+                return
+            events = self._take()
+        threading.Thread(target=self._write, args=(events,)).start()
+
+    def close(self):
+        with self.lock:
+            events = self._take()
+        if self.frames or events:
+            self._write(events)
+
+    def _take(self):
+        events, self.events = self.events, []
+        self.frames = 0
+        # thread names are needed again in the next file
+        self.threads = set()
+        return events
+
+    def _write(self, events):
+        if not events:
+            return
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = self.directory / (
+            f"trace-{self.name}-{os.getpid()}-{stamp}-{next(self.files)}.json"
+        )
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logger.info(f"Wrote trace {path}")
+
+
+def traced(handle):
+    """Decorate an engine handle method to trace a sample of the frames, the
+    engine needs a tracer attribute."""
+
+    @functools.wraps(handle)
+    def wrapper(self, input_frame):
+        tracer = self.tracer
+        if not tracer.enabled:
+            return handle(self, input_frame)
+        start = now_us()
+        frame = tracer.start_frame()
+        if frame is None:
+            return handle(self, input_frame)
+        try:
+            result = handle(self, input_frame)
+        except Exception as e:
+            tracer.end_frame(frame, start, type(e).__name__)
+            raise
+        tracer.end_frame(frame, start)
+        return result
+
+    return wrapper
@@ -0,0 +1,170 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .postprocess import box_iou
+
+logger = logging.getLogger(__name__)
+
+MAX_CLIENTS = 256
+REPORT_INTERVAL = 30  # seconds
+
+
+class Tracks:
+    """Track state of a single client, one array entry per track"""
+
+    def __init__(self):
+        self.boxes = np.zeros((0, 4), dtype=np.float32)
+        self.classes = np.zeros(0, dtype=np.int32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.last_seen = np.zeros(0)
+        self.last_report = np.zeros(0)
+
+    def keep(self, mask):
+        self.boxes = self.boxes[mask]
+        self.classes = self.classes[mask]
+        self.ids = self.ids[mask]
+        self.last_seen = self.last_seen[mask]
+        self.last_report = self.last_report[mask]
+
+
+def match(iou, iou_threshold):
+    """Greedily pair rows and columns of the IoU matrix, highest IoU first.
+    Returns the matched (row, column) index arrays."""
+    rows, cols = np.nonzero(iou >= iou_threshold)
+    order = np.argsort(-iou[rows, cols], kind="stable")
+    used_rows, used_cols = set(), set()
+    matched_rows, matched_cols = [], []
+    for row, col in zip(rows[order], cols[order]):
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        matched_rows.append(row)
+        matched_cols.append(col)
+    return np.array(matched_rows, dtype=np.intp), np.array(matched_cols, dtype=np.intp)
+
+
+class ObjectTracker:
+    """Give detections of the same object in consecutive frames of a client a
+    stable track id and decide which of them are worth reporting.
+
+    Detections are matched to the tracks of the scope (client and model) by
+    IoU, regardless of class, so that a class change can be seen. A track
+    that has not been matched for max_age seconds is dropped. A detection is
+    reported when it starts a new track, when the class of its track changes,
+    and again every report_interval seconds while the track lives (never if
+    report_interval is 0).
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=2.0, report_interval=60):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.report_interval = report_interval
+        self.scopes = OrderedDict()  # scope -> Tracks
+        self.next_id = itertools.count(1)
+        self.lock = threading.Lock()
+        self.detections = 0
+        self.reported = 0
+        self.tracks_created = 0
+        self.lastreport = time.monotonic()
+        logger.info(
+            f"Tracking objects with IoU >= {iou_threshold}, re-reporting every"
+            f" {report_interval}s"
+        )
+
+    def update(self, scope, detections, now=None):
+        """Match the detections (DETECTION_DTYPE records) against the tracks
+        of scope. Returns their track ids and a mask of those to report."""
+        now = time.monotonic() if now is None else now
+        boxes = np.stack(
+            [
+                detections["xmin"],
+                detections["ymin"],
+                detections["xmax"],
+                detections["ymax"],
+            ],
+            axis=1,
+        )
+        classes = detections["class"]
+
+        with self.lock:
+            tracks = self.scopes.get(scope)
+            if tracks is None:
+                tracks = self.scopes[scope] = Tracks()
+                if len(self.scopes) > MAX_CLIENTS:
+                    self.scopes.popitem(last=False)
+            self.scopes.move_to_end(scope)
+
+            tracks.keep(now - tracks.last_seen <= self.max_age)
+
+            ids = np.empty(len(detections), dtype=np.int64)
+            report = np.ones(len(detections), dtype=bool)
+            rows, cols = match(box_iou(tracks.boxes, boxes), self.iou_threshold)
+
+            # continuing tracks
+            changed = tracks.classes[rows] != classes[cols]
+            due = now - tracks.last_report[rows] >= self.report_interval
+            if self.report_interval <= 0:
+                due[:] = False
+            report[cols] = changed | due
+            ids[cols] = tracks.ids[rows]
+            tracks.boxes[rows] = boxes[cols]
+            tracks.classes[rows] = classes[cols]
+            tracks.last_seen[rows] = now
+            tracks.last_report[rows[report[cols]]] = now
+
+            # new tracks for the unmatched detections
+            new = np.ones(len(detections), dtype=bool)
+            new[cols] = False
+            count = int(new.sum())
+            ids[new] = [next(self.next_id) for _ in range(count)]
+            tracks.boxes = np.concatenate([tracks.boxes, boxes[new]])
+            tracks.classes = np.concatenate([tracks.classes, classes[new]])
+            tracks.ids = np.concatenate([tracks.ids, ids[new]])
+            tracks.last_seen = np.concatenate([tracks.last_seen, np.full(count, now)])
+            tracks.last_report = np.concatenate(
+                [tracks.last_report, np.full(count, now)]
+            )
+
+            self.detections += len(detections)
+            self.reported += int(report.sum())
+            self.tracks_created += count
+            if now - self.lastreport > REPORT_INTERVAL:
+                logger.info(f"Tracker stats: {self.stats()}")
+                self.lastreport = now
+
+        return ids, report
+
+    def stats(self):
+        return {
+            "detections": self.detections,
+            "reported": self.reported,
+            "tracks": self.tracks_created,
+            # fraction of detection log lines saved by tracking
+            "reduction": (
+                1 - self.reported / self.detections if self.detections else 0.0
+            ),
+        }
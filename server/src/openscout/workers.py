@@ -0,0 +1,140 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1  # seconds
+MIN_UPTIME = 10  # workers exiting sooner than this are restarted with backoff
+MAX_BACKOFF = 60  # seconds
+SHUTDOWN_TIMEOUT = 10  # seconds
+
+
+def partition_cpus(workers):
+    """Split the CPUs this process may run on into one contiguous set per
+    worker. With more workers than CPUs, some workers share a CPU."""
+    cpus = sorted(os.sched_getaffinity(0))
+    if workers >= len(cpus):
+        return [{cpus[i % len(cpus)]} for i in range(workers)]
+    chunk, extra = divmod(len(cpus), workers)
+    sets, start = [], 0
+    for i in range(workers):
+        end = start + chunk + (1 if i < extra else 0)
+        sets.append(set(cpus[start:end]))
+        start = end
+    return sets
+
+
+class WorkerPool:
+    """Run target(index, cpus, *args) in count child processes and restart
+    any that exit until the pool is stopped.
+
+    Children are started with the spawn method so that each gets a fresh
+    interpreter, without inherited CUDA or thread pool state. When pin_cpus
+    is set, cpus is the set of CPUs the worker is pinned to, otherwise None.
+    """
+
+    def __init__(self, target, count, args=(), pin_cpus=False):
+        self.target = target
+        self.count = count
+        self.args = args
+        self.cpus = partition_cpus(count) if pin_cpus else [None] * count
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = [None] * count
+        self.started = [0.0] * count
+        self.backoff = [0.0] * count
+        self.restarts = 0
+        self.stopping = False
+
+    def _start(self, index):
+        process = self.context.Process(
+            target=_run_worker,
+            args=(self.target, index, self.cpus[index], self.args),
+            name=f"engine-worker-{index}",
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        cpus = f" on CPUs {sorted(self.cpus[index])}" if self.cpus[index] else ""
+        logger.info(f"Started worker {index} (pid {process.pid}){cpus}")
+
+    def run(self):
+        """Start the workers and supervise them until SIGTERM or SIGINT"""
+
+        def stop(signum, frame):
+            self.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        for index in range(self.count):
+            self._start(index)
+
+        restart_at = [None] * self.count
+        while not self.stopping:
+            time.sleep(POLL_INTERVAL)
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if restart_at[index] is not None:
+                    if now >= restart_at[index]:
+                        restart_at[index] = None
+                        self.restarts += 1
+                        self._start(index)
+                    continue
+                if process.is_alive():
+                    continue
+
+                # a worker that keeps crashing right after startup is
+                # restarted with exponential backoff
+                if now - self.started[index] < MIN_UPTIME:
+                    self.backoff[index] = min(
+                        max(2 * self.backoff[index], 1), MAX_BACKOFF
+                    )
+                else:
+                    self.backoff[index] = 0.0
+                logger.error(
+                    f"Worker {index} (pid {process.pid}) exited with code"
+                    f" {process.exitcode}, restarting in {self.backoff[index]:.0f}s"
+                )
+                restart_at[index] = now + self.backoff[index]
+
+        self.stop()
+
+    def stop(self):
+        logger.info("Stopping workers...")
+        alive = [p for p in self.processes if p is not None and p.is_alive()]
+        for process in alive:
+            process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for process in alive:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Killing worker pid {process.pid}")
+                process.kill()
+                process.join()
+
+
+def _run_worker(target, index, cpus, args):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    target(index, cpus, *args)
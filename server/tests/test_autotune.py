@@ -0,0 +1,47 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import json
+
+from openscout import autotune, obj
+
+
+def apply(tmp_path, settings, *argv):
+    parser = obj.create_parser()
+    args = parser.parse_args(["--profile-dir", str(tmp_path), *argv])
+    profile = {autotune.profile_key(args): {"settings": settings}}
+    autotune.profile_path(tmp_path).write_text(json.dumps(profile))
+    autotune.apply_profile(parser, args)
+    return args
+
+
+def test_profile_applies_tuned_settings(tmp_path):
+    args = apply(tmp_path, {"threads": 3, "opencv_threads": 1, "size": 416})
+    assert (args.threads, args.opencv_threads, args.size) == (3, 1, 416)
+
+
+def test_profile_keeps_command_line_settings(tmp_path):
+    args = apply(tmp_path, {"threads": 3, "size": 416}, "--size", "320")
+    assert (args.threads, args.size) == (3, 320)
+
+
+def test_profile_batch_size_is_ignored(tmp_path):
+    # written by older autotuners, frames reach the engine one at a time
+    args = apply(tmp_path, {"threads": 3, "batch_size": 4})
+    assert args.threads == 3
+    assert vars(args).get("batch_size", 1) == 1
@@ -0,0 +1,74 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import numpy as np
+import pytest
+
+from openscout.backends import OnnxBackend
+from openscout.postprocess import DetectionFilter
+
+NUM_CLASSES = 2
+
+
+class StaticBatchSession:
+    """Stands in for an ONNX Runtime session of a model exported with a
+    static batch size, giving every image one box of the class equal to its
+    pixel value"""
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.batches = []
+
+    def run(self, outputs, feeds):
+        (batch,) = feeds.values()
+        assert batch.shape[0] == self.batch_size
+        self.batches.append(batch.shape[0])
+        output = np.zeros((len(batch), 1, 5 + NUM_CLASSES), dtype=np.float32)
+        output[:, 0, :4] = [32, 32, 16, 16]
+        output[:, 0, 4] = 1.0
+        for i, image in enumerate(batch):
+            output[i, 0, 5 + round(image[0, 0, 0] * 255)] = 1.0
+        return [output]
+
+
+def static_backend(batch_size):
+    backend = OnnxBackend.__new__(OnnxBackend)
+    backend.filter = DetectionFilter(0.5)
+    backend.names = {i: str(i) for i in range(NUM_CLASSES)}
+    backend.class_thresholds = backend.filter.thresholds(NUM_CLASSES)
+    backend.session = StaticBatchSession(batch_size)
+    backend.input_name = "images"
+    backend.fixed_batch = batch_size
+    backend.fixed_shape = (64, 64)
+    return backend
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 5])
+def test_static_batch_is_padded(count):
+    backend = static_backend(2)
+    images = [
+        np.full((64, 64, 3), i % NUM_CLASSES, dtype=np.uint8) for i in range(count)
+    ]
+
+    results = backend.infer(images, 64)
+
+    assert len(results) == count
+    for i, result in enumerate(results):
+        assert result.ims[0] is images[i]
+        assert result.pred[0][:, 5].tolist() == [i % NUM_CLASSES]
+    assert backend.session.batches == [2] * ((count + 1) // 2)
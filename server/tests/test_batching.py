@@ -0,0 +1,108 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import queue
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import numpy as np
+
+from openscout import batching
+from openscout.batching import BatchingPredictor
+
+TIMEOUT = 5  # seconds, a frame that is lost waits forever
+
+
+class EchoPredictor:
+    """Returns the images it is given as their results"""
+
+    size = 640
+
+    def infer(self, image, size=None):
+        return image
+
+    def infer_batch(self, images, size=None):
+        return list(images)
+
+    def close(self):
+        pass
+
+
+class RacingQueue(queue.Queue):
+    """Queue that lets close() run between infer() deciding to queue a frame
+    and the frame being queued"""
+
+    closing = None
+
+    def put(self, item, block=True, timeout=None):
+        if item is not None:
+            self.closing.set()
+            # unless close() waits for infer(), it queues the sentinel ahead
+            # of this frame in the meantime
+            threading.Event().wait(0.2)
+        super().put(item, block, timeout)
+
+
+def in_thread(function, *args):
+    """Run function in a daemon thread, returns a future of its result"""
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(function(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def test_infer_during_close(monkeypatch):
+    closing = threading.Event()
+    monkeypatch.setattr(RacingQueue, "closing", closing)
+    monkeypatch.setattr(
+        batching, "queue", SimpleNamespace(Queue=RacingQueue, Empty=queue.Empty)
+    )
+    batcher = BatchingPredictor(EchoPredictor(), 4, 10)
+    image = np.zeros((4, 4, 3), dtype=np.uint8)
+
+    result = in_thread(batcher.infer, image)
+    assert closing.wait(TIMEOUT)
+    closed = in_thread(batcher.close)
+
+    assert result.result(TIMEOUT) is image
+    closed.result(TIMEOUT)
+    # frames arriving after close() are run without batching
+    assert batcher.infer(image) is image
+
+
+def test_frames_queued_after_sentinel_get_results():
+    batcher = BatchingPredictor(EchoPredictor(), 2, 10)
+    images = [np.full((4, 4, 3), i, dtype=np.uint8) for i in range(3)]
+    batcher.closed = True
+    batcher.queue.put(None)
+    futures = []
+    for image in images:
+        future = Future()
+        batcher.queue.put((0.0, image, None, future))
+        futures.append(future)
+    batcher.thread.join(TIMEOUT)
+
+    for future, image in zip(futures, images):
+        assert future.result(TIMEOUT) is image
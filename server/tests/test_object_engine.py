@@ -0,0 +1,202 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import gc
+import json
+import threading
+import time
+import weakref
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+from gabriel_protocol import gabriel_pb2
+
+from openscout import obj
+from openscout.backends import BACKENDS, Detections
+from openscout.object_engine import OpenScoutObjectEngine
+from openscout.protocol import openscout_pb2
+
+TIMEOUT = 5  # seconds
+
+
+class StubBackend:
+    """Returns one fixed box per image, labelled with the name of the model,
+    and remembers the images it saw. Loading a model with a gate waits for
+    the gate to be opened."""
+
+    images = []
+    gates = {}  # model -> threading.Event
+
+    def __init__(self, model_path, threshold, **options):
+        self.model = Path(model_path).stem
+        gate = self.gates.get(self.model)
+        if gate is not None:
+            gate.wait(TIMEOUT)
+
+    def infer(self, images, size):
+        results = []
+        for image in images:
+            self.images.append(weakref.ref(image))
+            pred = np.array([[10, 10, 50, 50, 0.99, 0]], dtype=np.float32)
+            results.append(Detections(image, pred, {0: self.model}))
+        return results
+
+    def memory_footprint(self):
+        return 0
+
+    @staticmethod
+    def exists(model_path):
+        return True
+
+
+@pytest.fixture
+def make_engine(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("WEBSERVER", "http://webserver")
+    monkeypatch.setitem(BACKENDS, "stub", StubBackend)
+    monkeypatch.setattr(StubBackend, "images", [])
+    monkeypatch.setattr(StubBackend, "gates", {})
+    engines = []
+
+    def make_engine(*argv):
+        args = obj.create_parser().parse_args(
+            [
+                "--backend",
+                "stub",
+                "--warmup",
+                "0",
+                "--cache-distance",
+                "0",
+                # keep the detection log and traces out of the deployment
+                "--log-dir",
+                str(tmp_path),
+                "--trace-dir",
+                str(tmp_path),
+                *argv,
+            ]
+        )
+        engines.append(OpenScoutObjectEngine(args))
+        return engines[-1]
+
+    yield make_engine
+    for engine in engines:
+        if engine.store_detections:
+            engine.writer.close()
+        engine.detection_log.close()
+        engine.tracer.close()
+
+
+@pytest.fixture
+def engine(make_engine):
+    # decoded frames are not pooled, so that they are freed once nothing
+    # references them
+    return make_engine("--decode-buffers", "0")
+
+
+def logged_images(engine):
+    engine.writer.close()
+    engine.detection_log.close()
+    with open(engine.detection_log.path) as f:
+        return [json.loads(line)["image"] for line in f]
+
+
+def make_frame(client_id="client", left=100, model=""):
+    image = np.zeros((360, 640, 3), dtype=np.uint8)
+    cv2.rectangle(image, (left, 100), (left + 200, 250), (255, 255, 255), -1)
+    frame = gabriel_pb2.InputFrame()
+    frame.payload_type = gabriel_pb2.PayloadType.IMAGE
+    frame.payloads.append(cv2.imencode(".jpg", image)[1].tobytes())
+    extras = openscout_pb2.Extras()
+    extras.client_id = client_id
+    extras.model = model
+    frame.extras.Pack(extras)
+    return frame
+
+
+def test_cache_hit_does_not_keep_frame(engine):
+    frame = make_frame()
+    first = engine.handle(frame)
+    second = engine.handle(frame)
+
+    assert engine.cache.hits == 1
+    assert len(StubBackend.images) == 1
+    assert second.results[0].payload == first.results[0].payload
+    gc.collect()
+    assert StubBackend.images[0]() is None
+
+
+def test_cache_hit_logs_only_stored_images(make_engine, tmp_path):
+    engine = make_engine("--store", "--track", "--track-report-interval", "0.2")
+    first, second = make_frame(left=100), make_frame(left=300)
+
+    engine.handle(first)  # new track, stored
+    engine.handle(second)  # continues the track, not stored
+    time.sleep(0.3)
+    engine.handle(second)  # cached, reported again
+    time.sleep(0.3)
+    engine.handle(first)  # cached, reported again
+
+    assert engine.cache.hits == 2
+    images = logged_images(engine)
+    assert len(images) == 3
+    assert images[0] is not None and images[2] == images[0]
+    assert images[1] is None
+    assert (tmp_path / "images" / images[0].split("/", 3)[3]).exists()
+
+
+def answered_by(engine, client_id, model):
+    result = engine.handle(make_frame(client_id, model=model))
+    return result.results[0].payload.decode().split()[1]
+
+
+def wait_loaded(engine, model):
+    deadline = time.monotonic() + TIMEOUT
+    while engine.registry.loaded(model) is None:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_loading_model_answers_with_client_model(make_engine):
+    engine = make_engine()
+    StubBackend.gates.update(birds=threading.Event(), cars=threading.Event())
+
+    assert answered_by(engine, "a", "birds") == "coco"
+    StubBackend.gates["birds"].set()
+    wait_loaded(engine, "birds")
+    assert answered_by(engine, "a", "birds") == "birds"
+
+    # while cars loads, each client keeps the model it was answered with
+    assert answered_by(engine, "a", "cars") == "birds"
+    assert answered_by(engine, "b", "cars") == "coco"
+    StubBackend.gates["cars"].set()
+    wait_loaded(engine, "cars")
+    assert answered_by(engine, "b", "cars") == "cars"
+
+
+def test_loading_model_waits_when_default_is_evicted(make_engine):
+    engine = make_engine("--max-models", "1")
+    StubBackend.gates["birds"] = threading.Event()
+
+    assert answered_by(engine, "a", "birds") == "coco"
+    StubBackend.gates["birds"].set()
+    wait_loaded(engine, "birds")
+    assert engine.registry.loaded("coco") is None
+    # not the labels of another client's model
+    assert answered_by(engine, "b", "cars") == "cars"
@@ -0,0 +1,144 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import os
+import time
+
+import pytest
+
+from openscout.retention import RetentionManager
+from openscout.storage import ImageStore, payload_digest
+
+DAY = 86400
+NOW = time.time()
+
+
+@pytest.fixture
+def images(tmp_path):
+    images = ImageStore(tmp_path)
+    yield images
+    images.close()
+
+
+def store(images, age_days, payload, kind="received"):
+    """Store payload as received age_days ago, returns its relative path"""
+    timestamp = NOW - age_days * DAY
+    relative = images.save_payload(
+        kind, payload_digest(payload), "client", int(timestamp * 1000), payload
+    )
+    # scan() dates images by their modification time
+    os.utime(images.root / relative, (timestamp, timestamp))
+    return relative
+
+
+def payload(i, size=100):
+    return bytes([i]) * size
+
+
+def day(age_days):
+    return time.strftime("%Y-%m-%d", time.gmtime(NOW - age_days * DAY))
+
+
+def test_size_limit_deletes_oldest_first(images):
+    paths = [store(images, age, payload(age)) for age in (5, 4, 3, 2, 1)]
+    manager = RetentionManager(images.root, [("received", 250, 0)])
+    manager.scan()
+    manager.collect()
+
+    assert [(images.root / path).exists() for path in paths] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+    ]
+    assert manager.categories["received"].bytes == 200
+    # emptied day directories are removed
+    assert not (images.root / "received" / day(5)).exists()
+    assert (images.root / "received" / day(1)).exists()
+
+
+def test_age_limit_deletes_older_images(images):
+    paths = [store(images, age, payload(age)) for age in (5, 4, 3, 2, 1)]
+    manager = RetentionManager(images.root, [("received", 0, 2.5 * DAY)])
+    manager.scan()
+    manager.collect()
+
+    assert [(images.root / path).exists() for path in paths] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_linked_images_count_once(images):
+    linked = [store(images, age, payload(1)) for age in (3, 2, 1)]
+    other = store(images, 0.5, payload(2))
+    assert images.deduplicated == 2
+
+    manager = RetentionManager(images.root, [("received", 150, 0)])
+    manager.scan()
+    category = manager.categories["received"]
+    assert len(category.heap) == 4
+    assert category.bytes == 200
+
+    # deleting a link frees nothing until the last one goes
+    manager.collect()
+    assert not any((images.root / path).exists() for path in linked)
+    assert (images.root / other).exists()
+    assert category.bytes == 100
+
+
+def test_follow_index_picks_up_new_images(images):
+    paths = [store(images, age, payload(age)) for age in (5, 4)]
+    manager = RetentionManager(images.root, [("received", 250, 0)])
+    manager.follow_index(skip=True)
+    manager.scan()
+    paths += [store(images, age, payload(age)) for age in (3, 2, 1)]
+    manager.follow_index()
+
+    category = manager.categories["received"]
+    # images found by the scan are not counted again
+    assert len(category.heap) == 5
+    assert category.bytes == 500
+    manager.collect()
+    assert [(images.root / path).exists() for path in paths] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+    ]
+
+
+def test_index_of_retained_days_is_kept(images):
+    for age in (5, 3, 1):
+        store(images, age, payload(age))
+    store(images, 1, payload(10), kind="detected")
+    store(images, 1, payload(11), kind="faces")
+    manager = RetentionManager(
+        images.root,
+        [("received", 0, 4 * DAY), ("detected", 0, 0), ("faces", 0, 0)],
+    )
+    manager.scan()
+    manager.collect()
+
+    index = sorted(path.stem for path in (images.root / "index").glob("*.tsv"))
+    assert index == [day(3), day(1)]
@@ -0,0 +1,99 @@
+# OpenScout
+#   - Distributed Automated Situational Awareness
+#
+#   Copyright (C) 2023 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+#
+
+import numpy as np
+
+from openscout.postprocess import to_detections
+from openscout.tracker import ObjectTracker
+
+SCOPE = ("client", "coco")
+
+
+def detections(*boxes):
+    """Detections of (xmin, ymin, xmax, ymax, class) boxes"""
+    pred = np.array(
+        [[*box[:4], 0.9, box[4]] for box in boxes], dtype=np.float32
+    ).reshape(-1, 6)
+    return to_detections(pred)
+
+
+def test_new_track_is_reported():
+    tracker = ObjectTracker(report_interval=60)
+    ids, report = tracker.update(
+        SCOPE, detections((0, 0, 10, 10, 0), (50, 50, 60, 60, 1)), now=0
+    )
+    assert report.tolist() == [True, True]
+    assert ids[0] != ids[1]
+
+
+def test_continuing_track_is_not_reported():
+    tracker = ObjectTracker(report_interval=60)
+    first, _ = tracker.update(SCOPE, detections((0, 0, 10, 10, 0)), now=0)
+    ids, report = tracker.update(SCOPE, detections((1, 1, 11, 11, 0)), now=1)
+    assert report.tolist() == [False]
+    assert ids[0] == first[0]
+
+
+def test_class_change_is_reported():
+    tracker = ObjectTracker(report_interval=60)
+    first, _ = tracker.update(SCOPE, detections((0, 0, 10, 10, 0)), now=0)
+    ids, report = tracker.update(SCOPE, detections((1, 1, 11, 11, 2)), now=1)
+    assert report.tolist() == [True]
+    assert ids[0] == first[0]
+
+
+def test_track_is_reported_again_after_interval():
+    tracker = ObjectTracker(max_age=5, report_interval=10)
+    box = detections((0, 0, 10, 10, 0))
+    reports = [tracker.update(SCOPE, box, now=now)[1][0] for now in (0, 4, 8, 11, 13)]
+    assert reports == [True, False, False, True, False]
+
+
+def test_track_is_never_reported_again_without_interval():
+    tracker = ObjectTracker(max_age=5, report_interval=0)
+    box = detections((0, 0, 10, 10, 0))
+    reports = [tracker.update(SCOPE, box, now=now)[1][0] for now in range(0, 100, 4)]
+    assert reports[0] and not any(reports[1:])
+
+
+def test_track_expires_after_max_age():
+    tracker = ObjectTracker(max_age=2, report_interval=60)
+    box = detections((0, 0, 10, 10, 0))
+    first, _ = tracker.update(SCOPE, box, now=0)
+    ids, report = tracker.update(SCOPE, box, now=3)
+    assert report.tolist() == [True]
+    assert ids[0] != first[0]
+
+
+def test_empty_detections_keep_tracks():
+    tracker = ObjectTracker(max_age=2, report_interval=60)
+    box = detections((0, 0, 10, 10, 0))
+    first, _ = tracker.update(SCOPE, box, now=0)
+    ids, report = tracker.update(SCOPE, detections(), now=1)
+    assert len(ids) == 0 and len(report) == 0
+    ids, report = tracker.update(SCOPE, box, now=1.5)
+    assert report.tolist() == [False]
+    assert ids[0] == first[0]
+
+
+def test_clients_are_tracked_separately():
+    tracker = ObjectTracker(report_interval=60)
+    box = detections((0, 0, 10, 10, 0))
+    tracker.update(SCOPE, box, now=0)
+    _, report = tracker.update(("other", "coco"), box, now=1)
+    assert report.tolist() == [True]